@@ -1,13 +1,48 @@
-from openai import OpenAI
-from openai import AzureOpenAI
+import time
+import random
+import asyncio
+import threading
+import weakref
+import openai
+from openai import OpenAI, AsyncOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from functools import wraps
+from typing import Dict, List, Optional, Union
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-def except_retry_dec(retry_num: int = 3):
+def backoff_delay(attempt: int, base_delay: float = 1.0, max_delay: float = 30.0) -> float:
+    """Exponential backoff with full jitter, so clients failing together do not retry together."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def except_retry_dec(retry_num: int = 3, base_delay: float = 1.0, max_delay: float = 30.0):
+    """Retry a sync or async function on transient errors, sleeping `backoff_delay` between attempts."""
+    def should_retry(e, i):
+        # error define: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+        if isinstance(e, (openai.BadRequestError, openai.AuthenticationError)) or i >= retry_num:
+            return False
+        logger.error(f"{e}")
+        logger.warning(f"do retry, time: {i}")
+        return True
+
     def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapped_func(*args, **kwargs):
+                i = 0
+                while True:
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:  # pylint: disable=W0703
+                        if not should_retry(e, i):
+                            raise
+                        await asyncio.sleep(backoff_delay(i, base_delay, max_delay))
+                        i += 1
+
+            return async_wrapped_func
+
         @wraps(func)
         def wrapped_func(*args, **kwargs):
             i = 0
@@ -17,61 +52,201 @@ def except_retry_dec(retry_num: int = 3):
                     ret = func(*args, **kwargs)
                     logger.info("openai agent post finished")
                     return ret
-                # error define: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
-                except (
-                    openai.BadRequestError,
-                    openai.AuthenticationError,
-                ) as e:
-                    raise
                 except Exception as e:  # pylint: disable=W0703
-                    logger.error(f"{e}")
-                    logger.info(f"sleep {i + 1}")
-                    time.sleep(i + 1)
-                    if i >= retry_num:
+                    if not should_retry(e, i):
                         raise
-                    logger.warning(f"do retry, time: {i}")
+                    time.sleep(backoff_delay(i, base_delay, max_delay))
                     i += 1
 
         return wrapped_func
 
     return decorator
 
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second on average and bursts of `capacity`.
+
+    `reserve` takes a token and returns how long the caller must wait for it, so one bucket serves threads
+    (`acquire`) and any number of event loops (`acquire_async`) alike.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # tokens may go negative, queueing later callers behind earlier reservations
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        time.sleep(self.reserve())
+
+    async def acquire_async(self) -> None:
+        await asyncio.sleep(self.reserve())
+
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(source: str, requests_per_minute: float) -> TokenBucket:
+    """The bucket shared by every `Agent` of `source`, set to the latest `requests_per_minute`."""
+    with _rate_limiters_lock:
+        bucket = _rate_limiters.get(source)
+        if bucket is None:
+            bucket = _rate_limiters[source] = TokenBucket(requests_per_minute / 60)
+        else:
+            bucket.rate = requests_per_minute / 60
+        return bucket
+
+
+def _run_sync(coroutine):
+    """Run a coroutine to completion from sync code, also when called inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    result = {}
+    def run():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:  # pylint: disable=W0703
+            result["error"] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
 class Agent:
     def __init__(
-        self, model, source, api_dict, temperature: float = 0.0):
+        self, model, source, api_dict, temperature: float = 0.0,
+        max_concurrency: int = 8, requests_per_minute: Optional[float] = None):
+        """
+        Args:
+            api_dict: `api_key`, plus `endpoint` and `api_version` for azure, `base_url` for deepseek
+                (and optionally for openai, e.g. a local server)
+            max_concurrency: requests in flight at once in `generate_many`
+            requests_per_minute: limit shared by all agents of the same `source`, see `TokenBucket`
+        """
         self.model = model
         self.temperature = temperature
+        self.source = source
+        self.api_dict = api_dict
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = get_rate_limiter(source, requests_per_minute) if requests_per_minute else None
+        # async clients are bound to the event loop they first run on
+        self._async_clients = weakref.WeakKeyDictionary()
 
+        # retries are left to `except_retry_dec`, the clients' own retries would multiply them
         if source == "azure":
             self.client = AzureOpenAI(
-                azure_endpoint = api_dict["endpoint"], 
+                azure_endpoint = api_dict["endpoint"],
                 api_version=api_dict["api_version"],
                 api_key=api_dict["api_key"],
+                max_retries=0,
                 )
-            
+
         elif source == "openai":
             self.client = OpenAI(
                     # This is the default and can be omitted
                     api_key=api_dict["api_key"],
+                    base_url=api_dict.get("base_url"),
+                    max_retries=0,
                 )
         elif source == "deepseek":
             self.client = OpenAI(
                     # This is the default and can be omitted
                     base_url=api_dict["base_url"],
                     api_key=api_dict["api_key"],
+                    max_retries=0,
                 )
         print(f"You are using {self.model} from {source}")
-        
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            if self.source == "azure":
+                client = AsyncAzureOpenAI(
+                    azure_endpoint=self.api_dict["endpoint"],
+                    api_version=self.api_dict["api_version"],
+                    api_key=self.api_dict["api_key"],
+                    max_retries=0,
+                )
+            else:
+                client = AsyncOpenAI(
+                    base_url=self.api_dict.get("base_url"), api_key=self.api_dict["api_key"], max_retries=0)
+            self._async_clients[loop] = client
+        return client
+
+    def _messages(self, prompt: str) -> List[Dict]:
+        return [
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ]
+
+    def generate(self, prompt: Union[str, List[str]], max_new_tokens:int=None, **generation_kwargs) -> List[str]:
+        """One response per prompt; several prompts are sent concurrently, see `generate_many`.
+
+        Local-model arguments such as `batch_size` or `repetition_penalty` are ignored.
+        """
+        if isinstance(prompt, str):
+            return self._generate(prompt)
+        return self.generate_many(prompt, max_new_tokens=max_new_tokens)
+
     @except_retry_dec()
-    def generate(self, prompt: str, max_new_tokens:int=None) -> str:
+    def _generate(self, prompt: str) -> List[str]:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
         _completion = self.client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
+                messages=self._messages(prompt),
                 temperature=self.temperature,
                 model=self.model,
             )
         return [_completion.choices[0].message.content]
+
+    @except_retry_dec()
+    async def agenerate(self, prompt: str, max_new_tokens:int=None) -> List[str]:
+        """Async version of `generate` for a single prompt."""
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async()
+        _completion = await self._async_client().chat.completions.create(
+                messages=self._messages(prompt),
+                temperature=self.temperature,
+                model=self.model,
+            )
+        return [_completion.choices[0].message.content]
+
+    async def agenerate_many(self, prompts: List[str], max_new_tokens:int=None, max_concurrency: Optional[int] = None) -> List[str]:
+        """Responses to `prompts` in order, with at most `max_concurrency` requests in flight."""
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+
+        async def one(prompt):
+            async with semaphore:
+                return (await self.agenerate(prompt, max_new_tokens))[0]
+
+        return list(await asyncio.gather(*[one(prompt) for prompt in prompts]))
+
+    def generate_many(self, prompts: List[str], max_new_tokens:int=None, max_concurrency: Optional[int] = None) -> List[str]:
+        """Sync entry point of `agenerate_many`."""
+        async def run():
+            try:
+                return await self.agenerate_many(prompts, max_new_tokens, max_concurrency)
+            finally:
+                # the event loop ends with this call
+                client = self._async_clients.pop(asyncio.get_running_loop(), None)
+                if client is not None:
+                    await client.close()
+
+        return _run_sync(run())
@@ -0,0 +1,120 @@
+import os
+import json
+import torch
+import numpy as np
+from typing import Callable, Optional
+from transformers.utils import logging
+from .cache import content_hash
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    onnxruntime = None
+
+logger = logging.get_logger(__name__)
+
+ENCODER_BACKENDS = ("eager", "compile", "onnx")
+DEFAULT_BACKEND_DIR = os.path.join(os.path.expanduser("~"), ".cache", "memorag", "onnx")
+
+
+class _LastHiddenState(torch.nn.Module):
+    """Expose only `last_hidden_state`, with the encoder inputs as positional arguments for export."""
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).last_hidden_state
+
+
+class OnnxEncoder:
+    """The encoder exported to ONNX and dynamically quantized to int8 weights, run by ONNX Runtime on CPU.
+
+    The export is cached in `backend_dir` by model name and configuration, so it only happens once per host.
+
+    Args:
+        model: a float32 transformers encoder on CPU
+        model_name: identifies the export in the cache
+        input_names: the tokenizer's `model_input_names`
+        quantize: apply dynamic int8 quantization to the exported weights
+        num_threads: ONNX Runtime intra-op threads, defaults to torch's
+    """
+    def __init__(
+        self,
+        model,
+        model_name: str,
+        input_names,
+        backend_dir: Optional[str] = None,
+        quantize: bool = True,
+        num_threads: Optional[int] = None) -> None:
+        if onnxruntime is None:
+            raise ImportError("The onnx encoder backend requires `pip install onnx onnxruntime`.")
+        self.input_names = list(input_names)
+
+        config = {"model": model_name, "inputs": self.input_names, "quantize": quantize, "torch": torch.__version__}
+        path = os.path.join(backend_dir or DEFAULT_BACKEND_DIR, content_hash(json.dumps(config, sort_keys=True)))
+        model_path = os.path.join(path, "model.int8.onnx" if quantize else "model.onnx")
+        if not os.path.exists(model_path):
+            self._export(model, path, quantize)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+    def _export(self, model, path, quantize):
+        os.makedirs(path, exist_ok=True)
+        logger.info(f"exporting the encoder to ONNX at {path}...")
+        dummy = tuple(torch.ones(2, 8, dtype=torch.long) for _ in self.input_names)
+        dynamic_axes = {name: {0: "batch", 1: "length"} for name in self.input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "length"}
+        # written under temporary names, so an interrupted export is redone rather than loaded
+        tmp_path = os.path.join(path, f"model.{os.getpid()}.onnx")
+        torch.onnx.export(
+            _LastHiddenState(model, self.input_names).eval(),
+            dummy,
+            tmp_path,
+            input_names=self.input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False)
+        if quantize:
+            quantized_path = os.path.join(path, f"model.int8.{os.getpid()}.onnx")
+            quantize_dynamic(tmp_path, quantized_path, weight_type=QuantType.QInt8)
+            os.replace(quantized_path, os.path.join(path, "model.int8.onnx"))
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, os.path.join(path, "model.onnx"))
+
+    def __call__(self, **inputs) -> torch.Tensor:
+        feed = {name: inputs[name].cpu().numpy().astype(np.int64) for name in self.input_names if name in inputs}
+        last_hidden_state, = self.session.run(["last_hidden_state"], feed)
+        return torch.from_numpy(last_hidden_state)
+
+
+def build_encoder_backend(
+    model,
+    backend: str,
+    model_name: str,
+    input_names,
+    backend_dir: Optional[str] = None) -> Callable[..., torch.Tensor]:
+    """A callable mapping tokenized inputs to the encoder's `last_hidden_state`.
+
+    Args:
+        backend: "eager" runs the model as is, "compile" through `torch.compile` with dynamic shapes,
+            "onnx" through ONNX Runtime with int8 weights (CPU only), see `OnnxEncoder`
+    """
+    if backend == "eager":
+        return lambda **inputs: model(**inputs).last_hidden_state
+    elif backend == "compile":
+        compiled = torch.compile(model, dynamic=True)
+        return lambda **inputs: compiled(**inputs).last_hidden_state
+    elif backend == "onnx":
+        if model.device.type != "cpu":
+            raise ValueError("The onnx encoder backend runs on CPU only.")
+        return OnnxEncoder(model, model_name, input_names, backend_dir)
+    else:
+        raise NotImplementedError(f"Encoder backend {backend} not implemented! Choose from {ENCODER_BACKENDS}")
@@ -0,0 +1,812 @@
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import torch
+import numpy as np
+import faiss
+import transformers
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from typing import Dict, List, Optional
+from transformers import DynamicCache
+from .retrieval import DenseRetriever, FaissIndex, ShardedFaissIndex, select_index_factory, _ivf_pq_factory
+from .store import save_kv_cache, load_kv_cache
+from .memorag import Memory, MemoRAG, Model
+from .memorag_lite import MemoRAGLite
+from .chunking import ParallelChunker
+from .resources import _cpu_count
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _percentile_ms(latencies: List[float], q: float) -> float:
+    return round(float(np.percentile(latencies, q)) * 1000, 3)
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def synthetic_embeddings(num: int, ndim: int, seed: int = 0, num_clusters: int = 256) -> np.ndarray:
+    """Clustered unit vectors, closer to real sentence embeddings than isotropic noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, ndim)).astype(np.float32)
+    assign = rng.integers(0, num_clusters, num)
+    x = centers[assign] + 0.5 * rng.standard_normal((num, ndim)).astype(np.float32)
+    return np.ascontiguousarray(_normalize(x), dtype=np.float32)
+
+
+def benchmark_index_configs(
+    doc_embeddings: np.ndarray,
+    queries: np.ndarray,
+    hits: int = 10,
+    index_factories: Optional[List[str]] = None,
+    metric: str = "cos") -> List[Dict]:
+    """Measure build time, recall@k against exact search, and per-query search latency for each index.
+
+    Returns:
+        one record per index factory
+    """
+    ntotal, ndim = doc_embeddings.shape
+    if index_factories is None:
+        index_factories = ["Flat", "HNSW32", _ivf_pq_factory(ntotal, ndim)]
+
+    exact = faiss.IndexFlatIP(ndim) if metric in ["ip", "cos"] else faiss.IndexFlatL2(ndim)
+    exact.add(doc_embeddings)
+    _, truth = exact.search(queries, hits)
+
+    records = []
+    for index_factory in index_factories:
+        index = FaissIndex("cpu", background_retrain=False)
+        tic = time.perf_counter()
+        index.build(doc_embeddings, index_factory, metric)
+        build_time = time.perf_counter() - tic
+
+        latencies = []
+        found = np.zeros_like(truth)
+        for i in range(len(queries)):
+            tic = time.perf_counter()
+            _, indices = index.search(queries[i: i + 1], hits)
+            latencies.append(time.perf_counter() - tic)
+            found[i] = indices[0]
+
+        recall = np.mean([len(set(f) & set(t)) / hits for f, t in zip(found.tolist(), truth.tolist())])
+        records.append({
+            "ntotal": ntotal,
+            "ndim": ndim,
+            "index_factory": index_factory,
+            "auto_selected": index_factory == select_index_factory(ntotal, ndim),
+            "build_s": round(build_time, 3),
+            f"recall@{hits}": round(float(recall), 4),
+            "p50_ms": _percentile_ms(latencies, 50),
+            "p99_ms": _percentile_ms(latencies, 99),
+        })
+    return records
+
+
+def benchmark_index_tradeoff(
+    sizes: List[int],
+    ndim: int = 1024,
+    num_queries: int = 200,
+    hits: int = 10) -> List[Dict]:
+    """Run `benchmark_index_configs` on synthetic corpora of every size in `sizes`."""
+    records = []
+    for ntotal in sizes:
+        corpus = synthetic_embeddings(ntotal + num_queries, ndim, seed=ntotal)
+        records.extend(benchmark_index_configs(corpus[num_queries:], corpus[:num_queries], hits=hits))
+    return records
+
+
+def benchmark_sharded_search(
+    doc_embeddings: np.ndarray,
+    queries: np.ndarray,
+    shard_counts: List[int] = (1, 2, 4, 8, 16, 32),
+    executor: str = "thread",
+    index_factory: str = "auto",
+    hits: int = 10,
+    batch_size: int = 64,
+    metric: str = "cos") -> List[Dict]:
+    """Build time, single-query and batched search throughput, and recall@k of sharded indexes.
+
+    One shard is a plain `FaissIndex`, the baseline of `speedup`. With the "process" executor the shards are 
+    saved to a temporary directory and served from there.
+
+    Returns:
+        one record per shard count
+    """
+    ndim = doc_embeddings.shape[1]
+    exact = faiss.IndexFlatIP(ndim) if metric in ["ip", "cos"] else faiss.IndexFlatL2(ndim)
+    exact.add(doc_embeddings)
+    _, truth = exact.search(queries, hits)
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_shards in shard_counts:
+            if num_shards == 1:
+                index = FaissIndex("cpu", background_retrain=False)
+            else:
+                index = ShardedFaissIndex("cpu", num_shards, executor=executor, background_retrain=False)
+            tic = time.perf_counter()
+            index.build(doc_embeddings, index_factory, metric)
+            build_time = time.perf_counter() - tic
+            if executor == "process" and num_shards > 1:
+                index.save(os.path.join(tmp_dir, f"index.{num_shards}.bin"))
+                # start the workers outside the timed loops
+                index.search(queries[:1], hits)
+
+            found = np.zeros_like(truth)
+            tic = time.perf_counter()
+            for i in range(len(queries)):
+                found[i] = index.search(queries[i: i + 1], hits)[1][0]
+            single_qps = len(queries) / (time.perf_counter() - tic)
+
+            tic = time.perf_counter()
+            for i in range(0, len(queries), batch_size):
+                index.search(queries[i: i + batch_size], hits)
+            batch_qps = len(queries) / (time.perf_counter() - tic)
+            if num_shards > 1:
+                index.close()
+
+            recall = np.mean([len(set(f) & set(t)) / hits for f, t in zip(found.tolist(), truth.tolist())])
+            records.append({
+                "ntotal": len(doc_embeddings),
+                "num_shards": num_shards,
+                "executor": executor if num_shards > 1 else None,
+                "build_s": round(build_time, 3),
+                "single_qps": round(single_qps, 1),
+                "batch_qps": round(batch_qps, 1),
+                f"recall@{hits}": round(float(recall), 4),
+            })
+    for record in records:
+        record["single_speedup"] = round(record["single_qps"] / records[0]["single_qps"], 3)
+        record["batch_speedup"] = round(record["batch_qps"] / records[0]["batch_qps"], 3)
+    return records
+
+
+def benchmark_key_encoding(retriever, docs: List[str], batch_size: int = 32, max_tokens: Optional[int] = None) -> Dict:
+    """Compare key encoding throughput of fixed input-order batches with length-bucketed batches."""
+    def padded_tokens(batches):
+        return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+
+    lengths = [len(ids) for ids in retriever.tokenizer(
+        docs, padding=False, truncation=True, max_length=retriever.key_max_length)["input_ids"]]
+    fixed_batches = [list(range(i, min(i + batch_size, len(docs)))) for i in range(0, len(docs), batch_size)]
+    bucketed_batches = [positions for positions, _ in retriever._length_buckets(docs, batch_size, max_tokens)]
+
+    tic = time.perf_counter()
+    for batch in fixed_batches:
+        retriever.encode([docs[i] for i in batch]).cpu()
+    fixed_time = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    retriever.encode_keys(docs, batch_size=batch_size, max_tokens=max_tokens, use_cache=False)
+    bucketed_time = time.perf_counter() - tic
+
+    return {
+        "num_docs": len(docs),
+        "batch_size": batch_size,
+        "max_tokens": max_tokens,
+        "real_tokens": sum(lengths),
+        "fixed_padded_tokens": padded_tokens(fixed_batches),
+        "bucketed_padded_tokens": padded_tokens(bucketed_batches),
+        "fixed_docs_per_s": round(len(docs) / fixed_time, 2),
+        "bucketed_docs_per_s": round(len(docs) / bucketed_time, 2),
+        "speedup": round(fixed_time / bucketed_time, 3),
+    }
+
+
+def encoder_parity(embeddings: np.ndarray, reference: np.ndarray) -> Dict:
+    """Cosine agreement of two encodings of the same texts, row by row."""
+    cosine = (embeddings * reference).sum(axis=1) / (
+        np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1)).clip(min=1e-12)
+    return {"min_cosine": round(float(cosine.min()), 5), "mean_cosine": round(float(cosine.mean()), 5)}
+
+
+def benchmark_encoder_backends(
+    encoder: str,
+    queries: List[str],
+    docs: List[str],
+    backends: List[str] = ("eager", "compile", "onnx"),
+    batch_size: int = 32,
+    backend_dir: Optional[str] = None) -> List[Dict]:
+    """Per-query latency, key encoding throughput, and cosine agreement with eager float32 of each backend.
+
+    The first backend is the parity reference, so keep "eager" first.
+    """
+    reference = None
+    records = []
+    for backend in backends:
+        tic = time.perf_counter()
+        retriever = DenseRetriever(encoder, dtype="fp32", encoder_backend=backend, backend_dir=backend_dir, sparse=False)
+        # compiles or exports on first use, single queries and batches may compile separately
+        retriever.encode(queries[0], field="query")
+        retriever.encode(queries[:2], field="query")
+        setup_time = time.perf_counter() - tic
+
+        latencies = []
+        for query in queries:
+            tic = time.perf_counter()
+            retriever.encode(query, field="query")
+            latencies.append(time.perf_counter() - tic)
+
+        tic = time.perf_counter()
+        keys = retriever.encode_keys(docs, batch_size=batch_size, use_cache=False)
+        key_time = time.perf_counter() - tic
+
+        embeddings = np.concatenate([retriever.encode(queries, field="query").float().cpu().numpy(), keys])
+        if reference is None:
+            reference = embeddings
+        records.append({
+            "backend": backend,
+            "setup_s": round(setup_time, 3),
+            "query_p50_ms": _percentile_ms(latencies, 50),
+            "query_p99_ms": _percentile_ms(latencies, 99),
+            "keys_per_s": round(len(docs) / key_time, 2),
+            **encoder_parity(embeddings, reference),
+        })
+        del retriever
+    return records
+
+
+def synthetic_docs(num: int, min_words: int = 8, max_words: int = 400, seed: int = 0) -> List[str]:
+    """Docs of skewed random lengths, mimicking the tail of short chunks a splitter produces."""
+    rng = np.random.default_rng(seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    lengths = np.clip(rng.lognormal(np.log(max_words / 4), 0.8, num), min_words, max_words).astype(int)
+    return [" ".join(rng.choice(vocab, n)) for n in lengths]
+
+
+# (rtol, atol as a fraction of the largest magnitude) of a quantized KV round trip: int8 rounds to half a step
+# of the per-position scale, fp8 e4m3 keeps 3 mantissa bits, and the result is rounded to the cache dtype again
+KV_ROUNDTRIP_TOLERANCE = {"int8": (1e-2, 1 / 127), "fp8": (0.07, 1e-3)}
+
+
+def benchmark_kv_serialization(
+    context_length: int = 32768,
+    num_layers: int = 32,
+    num_kv_heads: int = 8,
+    head_dim: int = 128,
+    dtype: str = "bfloat16",
+    save_dir: Optional[str] = None) -> List[Dict]:
+    """Compare file size, save and load time of the pickled memory with the KV file format.
+
+    `load_s` only maps the file; `load_touch_s` also reads every layer, as decoding on CPU would, and checks
+    that the loaded keys and values equal the saved ones, within `KV_ROUNDTRIP_TOLERANCE` when quantized.
+    """
+    cache = DynamicCache.from_legacy_cache(tuple(
+        (torch.randn(1, num_kv_heads, context_length, head_dim, dtype=getattr(torch, dtype)),
+         torch.randn(1, num_kv_heads, context_length, head_dim, dtype=getattr(torch, dtype)))
+        for _ in range(num_layers)))
+    reference = cache.to_legacy_cache()
+    save_dir = save_dir or tempfile.mkdtemp()
+    path = os.path.join(save_dir, "memory.bin")
+
+    def touch(loaded, quantize):
+        max_error = 0.0
+        for layer, reference_layer in zip(loaded.to_legacy_cache(), reference):
+            for x, rx in zip(layer, reference_layer):
+                if quantize is None:
+                    assert x.dtype == rx.dtype and torch.equal(x, rx), "the KV round trip changed the cache"
+                else:
+                    rtol, atol = KV_ROUNDTRIP_TOLERANCE[quantize]
+                    assert torch.allclose(x.float(), rx.float(), rtol=rtol, atol=atol * rx.abs().max().item()), \
+                        f"the {quantize} KV round trip is off by more than its quantization error"
+                max_error = max(max_error, (x.float() - rx.float()).abs().max().item())
+        return max_error
+
+    records = []
+    for fmt in ["pickle", "kv", "kv-int8", "kv-fp8"]:
+        tic = time.perf_counter()
+        if fmt == "pickle":
+            torch.save({"memory": cache}, path)
+        else:
+            save_kv_cache(path, cache, quantize=fmt[3:] or None)
+        save_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        if fmt == "pickle":
+            loaded = torch.load(path, weights_only=False)["memory"]
+        else:
+            loaded, _, _ = load_kv_cache(path)
+        load_time = time.perf_counter() - tic
+        max_error = touch(loaded, None if fmt in ("pickle", "kv") else fmt[3:])
+        load_touch_time = time.perf_counter() - tic
+
+        records.append({
+            "format": fmt,
+            "context_length": context_length,
+            "file_mb": round(os.path.getsize(path) / 1024 ** 2, 1),
+            "save_s": round(save_time, 3),
+            "load_s": round(load_time, 3),
+            "load_touch_s": round(load_touch_time, 3),
+            "max_abs_error": round(max_error, 4),
+        })
+        del loaded
+        os.remove(path)
+    return records
+
+
+def benchmark_memorize_reload(
+    memory: Memory,
+    context: str,
+    query: str = "What is the article about?",
+    repeats: int = 3,
+    max_new_tokens: int = 32) -> List[Dict]:
+    """Memorize wall time of a `longllm` memory when the weights are reloaded after the sparse prefill, and
+    when the MInference patch is undone in place, plus whether both decode the same answer afterwards.
+
+    Sparse prefill needs CUDA; without it neither mode patches nor reloads, and the times only differ by noise.
+    """
+    records, answers = [], {}
+    for mode in ["reload", "restore"]:
+        times = []
+        for _ in range(repeats):
+            memory.reset()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            tic = time.perf_counter()
+            memory.memorize(context, reload_model=mode == "reload")
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - tic)
+        answers[mode] = memory.answer(query, max_new_tokens=max_new_tokens)
+        records.append({
+            "mode": mode,
+            "sparse_prefill": torch.cuda.is_available(),
+            "context_tokens": memory.context_inputs["input_ids"].shape[1],
+            "memorize_s": round(float(np.median(times)), 3),
+        })
+    for record in records:
+        record["speedup"] = round(records[0]["memorize_s"] / record["memorize_s"], 3)
+        record["same_answer"] = answers[record["mode"]] == answers["reload"]
+    return records
+
+
+def build_stub_models(out_dir: Optional[str] = None, vocab_size: int = 5000, max_context_tokens: int = 262144) -> Dict[str, str]:
+    """Save a tiny random Llama and BERT with word-level tokenizers over the `w{i}` vocabulary of
+    `synthetic_context`, so pipelines can be benchmarked offline on CPU. Existing models are reused.
+
+    The paths must not contain "memorag" or "chinese", which the pipelines read as model families.
+
+    Returns:
+        {"llm": path, "encoder": path}
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import BertConfig, BertModel, BertTokenizerFast, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    out_dir = out_dir or os.path.join(tempfile.gettempdir(), "stub-models")
+    paths = {"llm": os.path.join(out_dir, "stub-llm"), "encoder": os.path.join(out_dir, "stub-encoder")}
+    if any(name in path.lower() for path in paths.values() for name in ("memorag", "chinese")):
+        raise ValueError(f"{out_dir} would be taken for a memorag or chinese model, pick another directory!")
+    words = [f"w{i}" for i in range(vocab_size)]
+    punctuation = list(".,?:#<>|_")
+    torch.manual_seed(0)
+
+    if not os.path.exists(os.path.join(paths["llm"], "config.json")):
+        tokens = ["<pad>", "<s>", "</s>", "<unk>", "<|im_start|>", "<|im_end|>", "user", "assistant"] + words + punctuation
+        word_level = Tokenizer(models.WordLevel({t: i for i, t in enumerate(tokens)}, unk_token="<unk>"))
+        word_level.pre_tokenizer = pre_tokenizers.Whitespace()
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=word_level, bos_token="<s>", eos_token="</s>", unk_token="<unk>", pad_token="<pad>", 
+            padding_side="left", model_input_names=["input_ids", "attention_mask"])
+        tokenizer.chat_template = (
+            "{% for m in messages %}<|im_start|> {{ m['role'] }} {{ m['content'] }} <|im_end|> {% endfor %}"
+            "{% if add_generation_prompt %}<|im_start|> assistant {% endif %}")
+        tokenizer.save_pretrained(paths["llm"])
+        LlamaForCausalLM(LlamaConfig(
+            vocab_size=len(tokens), hidden_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, 
+            intermediate_size=128, max_position_embeddings=max_context_tokens + 8192, 
+            bos_token_id=1, eos_token_id=2, pad_token_id=0)).save_pretrained(paths["llm"])
+
+    if not os.path.exists(os.path.join(paths["encoder"], "config.json")):
+        os.makedirs(paths["encoder"], exist_ok=True)
+        vocab_path = os.path.join(paths["encoder"], "vocab.txt")
+        with open(vocab_path, "w") as f:
+            f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words + punctuation))
+        tokenizer = BertTokenizerFast(vocab_path)
+        tokenizer.save_pretrained(paths["encoder"])
+        BertModel(BertConfig(
+            vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=2, 
+            intermediate_size=128)).save_pretrained(paths["encoder"])
+    return paths
+
+
+def synthetic_context(num_tokens: int, vocab_size: int = 5000, seed: int = 0) -> str:
+    """Paragraphs of sentences of Zipf-distributed `w{i}` words, about `num_tokens` tokens of the stub models
+    (one per word or period)."""
+    rng = np.random.default_rng(seed)
+    paragraphs, total = [], 0
+    while total < num_tokens:
+        sentences = []
+        for _ in range(rng.integers(2, 8)):
+            length = int(min(rng.integers(6, 30), max(1, num_tokens - total - 1)))
+            sentences.append(" ".join(f"w{w}" for w in rng.zipf(1.3, length) % vocab_size) + ".")
+            total += length + 1
+            if total >= num_tokens:
+                break
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def synthetic_queries(context: str, num_queries: int, seed: int = 0) -> List[str]:
+    """Questions quoting a few words of random sentences of `context`."""
+    rng = np.random.default_rng(seed)
+    sentences = [s.split() for s in context.replace("\n\n", " ").split(".") if len(s.split()) >= 4]
+    return [
+        f"What follows {' '.join(sentences[i][:4])}?"
+        for i in rng.choice(len(sentences), num_queries, replace=len(sentences) < num_queries)]
+
+
+class StageTimer:
+    """Wall time per stage. Time spent in a stage nested inside another counts only towards the inner one,
+    so the stages of a run add up to at most its total time."""
+    def __init__(self) -> None:
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._local = threading.local()
+
+    @contextmanager
+    def __call__(self, stage: str):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - tic
+            self.seconds[stage] += elapsed - stack.pop()
+            self.calls[stage] += 1
+            if stack:
+                stack[-1] += elapsed
+
+    @contextmanager
+    def patch(self, owner, name: str, stage: str, outputs: Optional[List] = None):
+        """Time every call of method `name` of class `owner` as `stage` while the context is active, 
+        appending what each call returns to `outputs` if given."""
+        original = owner.__dict__.get(name)
+        method = getattr(owner, name)
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            with self(stage):
+                result = method(*args, **kwargs)
+            if outputs is not None:
+                outputs.append(result)
+            return result
+
+        setattr(owner, name, timed)
+        try:
+            yield
+        finally:
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+
+# methods timed while memorizing, per pipeline; `MemoRAGLite.memorize` itself is the prefill of the gists
+_MEMORIZE_STAGES = {
+    "memorag": [
+        (Memory, "memorize", "memorize_prefill"),
+    ],
+    "lite": [
+        (MemoRAGLite, "memorize", "memorize_prefill"),
+        (MemoRAGLite, "_form_gists", "gist"),
+    ],
+}
+_COMMON_MEMORIZE_STAGES = [
+    (ParallelChunker, "split", "chunk"),
+    (ParallelChunker, "chunks", "chunk"),
+    (DenseRetriever, "encode_keys", "encode"),
+    (DenseRetriever, "add", "index_build"),
+]
+# methods timed while answering, per pipeline; `MemoRAGLite._handle_rag` prompts `Model.generate` directly
+_QUERY_STAGES = {
+    "memorag": [
+        (Memory, "recall_and_rewrite", "recall_rewrite"),
+        (MemoRAG, "_retrieve", "retrieve"),
+        (MemoRAG, "_generate_response", "generate"),
+    ],
+    "lite": [
+        (MemoRAGLite, "recall_and_rewrite", "recall_rewrite"),
+        (MemoRAGLite, "_retrieve", "retrieve"),
+        (Model, "generate", "generate"),
+    ],
+}
+PIPELINE_STAGES = ["chunk", "encode", "index_build", "memorize_prefill", "gist", "recall_rewrite", "retrieve", "generate"]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _build_pipeline(pipeline: str, models: Dict[str, str], chunk_workers: Optional[int] = None):
+    if pipeline == "memorag":
+        return MemoRAG(
+            mem_model_name_or_path=models["llm"], ret_model_name_or_path=models["encoder"], 
+            gen_model_name_or_path=models["llm"], chunk_workers=chunk_workers)
+    elif pipeline == "lite":
+        return MemoRAGLite(
+            gen_model_name_or_path=models["llm"], ret_model_name_or_path=models["encoder"], 
+            calibration_cache=None, chunk_workers=chunk_workers)
+    raise NotImplementedError(f"Pipeline {pipeline} not implemented!")
+
+
+def benchmark_pipeline(
+    pipeline: str,
+    models: Dict[str, str],
+    context_tokens: int,
+    num_queries: int = 4,
+    max_new_tokens: int = 64,
+    gist_batch_size: int = 8,
+    chunk_workers: Optional[int] = None,
+    seed: int = 0) -> Dict:
+    """Memorize a synthetic context of `context_tokens` tokens with `MemoRAG` ("memorag") or `MemoRAGLite` 
+    ("lite"), then answer `num_queries` questions, timing every stage of `PIPELINE_STAGES`.
+
+    Queries go through the pipeline's own `__call__`; both memorize and query stages are timed by wrapping 
+    the methods doing them. Generated tokens are counted by re-tokenizing the outputs of the wrapped methods.
+    Peak RSS is that of the whole process, run each case in a fresh process (see `benchmark_pipelines`) to
+    compare it between cases.
+    """
+    tic = time.perf_counter()
+    pipe = _build_pipeline(pipeline, models, chunk_workers)
+    # load the weights up front, the registry hands them to the retrievers `memorize` creates
+    generator = pipe.gen_model
+    generator.model
+    (pipe.retriever if pipeline == "memorag" else pipe._new_retriever()).encoder
+    if pipeline == "memorag":
+        pipe.mem_model.model
+    load_time = time.perf_counter() - tic
+
+    context = synthetic_context(context_tokens, seed=seed)
+    queries = synthetic_queries(context, num_queries, seed=seed)
+    timer = StageTimer()
+
+    tic = time.perf_counter()
+    with ExitStack() as stack:
+        for owner, name, stage in _MEMORIZE_STAGES[pipeline] + _COMMON_MEMORIZE_STAGES:
+            stack.enter_context(timer.patch(owner, name, stage))
+        if pipeline == "memorag":
+            pipe.memorize(context)
+        else:
+            pipe.memorize(context, print_stats=False, batch_size=gist_batch_size)
+    memorize_time = time.perf_counter() - tic
+    prefill_tokens = (pipe.mem_model.context_inputs if pipeline == "memorag" else pipe.context_inputs)["input_ids"].shape[1]
+
+    outputs = {stage: [] for _, _, stage in _QUERY_STAGES[pipeline]}
+    tic = time.perf_counter()
+    with ExitStack() as stack:
+        for owner, name, stage in _QUERY_STAGES[pipeline]:
+            stack.enter_context(timer.patch(owner, name, stage, outputs[stage]))
+        for query in queries:
+            pipe(query, max_new_tokens=max_new_tokens)
+    query_time = time.perf_counter() - tic
+
+    tokenizer = generator.tokenizer
+    texts = {
+        "recall_rewrite": [text for pair in outputs["recall_rewrite"] for text in pair],
+        # a string from `_generate_response`, a list of them from `Model.generate`
+        "generate": [text for output in outputs["generate"] for text in ([output] if isinstance(output, str) else output)],
+    }
+    generated = {
+        stage: sum(len(tokenizer.encode(text, add_special_tokens=False)) for text in stage_texts) 
+        for stage, stage_texts in texts.items()}
+    decode_time = sum(timer.seconds[stage] for stage in generated)
+    return {
+        "pipeline": pipeline,
+        "context_tokens": context_tokens,
+        "prefill_tokens": prefill_tokens,
+        "num_chunks": len(pipe.retrieval_corpus),
+        "num_queries": num_queries,
+        "load_s": round(load_time, 3),
+        "memorize_s": round(memorize_time, 3),
+        "query_s": round(query_time, 3),
+        "stages_s": {stage: round(timer.seconds[stage], 4) for stage in PIPELINE_STAGES if stage in timer.seconds},
+        "generated_tokens": generated,
+        "prefill_tokens_per_s": round(prefill_tokens / max(timer.seconds["memorize_prefill"], 1e-9), 1),
+        "decode_tokens_per_s": round(sum(generated.values()) / max(decode_time, 1e-9), 1),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_pipeline_case(kwargs: Dict) -> Dict:
+    return benchmark_pipeline(**kwargs)
+
+
+def environment_info() -> Dict:
+    """What a pipeline report depends on besides the code: commit, library versions and host."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), 
+            capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "faiss": faiss.__version__,
+        "platform": platform.platform(),
+        "cpu_count": _cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+
+def benchmark_pipelines(
+    pipelines: Optional[List[str]] = None,
+    context_tokens: Optional[List[int]] = None,
+    model_dir: Optional[str] = None,
+    isolate: bool = True,
+    **kwargs) -> Dict:
+    """Run `benchmark_pipeline` for every pipeline and context size on the stub models of `build_stub_models`.
+
+    Args:
+        isolate: run each case in a fresh spawned process, so peak RSS and model loading are per case
+        kwargs: passed to `benchmark_pipeline`
+
+    Returns:
+        {"environment": ..., "config": ..., "records": [...]}, JSON-serializable for diffing between commits
+    """
+    pipelines = pipelines or ["memorag", "lite"]
+    context_tokens = context_tokens or [8192, 32768, 131072, 262144]
+    models = build_stub_models(model_dir, max_context_tokens=max(context_tokens))
+    cases = [
+        dict(pipeline=pipeline, models=models, context_tokens=n, **kwargs) 
+        for pipeline in pipelines for n in context_tokens]
+    records = []
+    for case in cases:
+        print(f"benchmarking {case['pipeline']} on {case['context_tokens']} context tokens", file=sys.stderr)
+        if isolate:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                records.append(pool.submit(_run_pipeline_case, case).result())
+        else:
+            records.append(_run_pipeline_case(case))
+    return {
+        "environment": environment_info(),
+        "config": {"pipelines": pipelines, "context_tokens": context_tokens, "isolate": isolate, **kwargs},
+        "records": records,
+    }
+
+
+def compare_pipeline_reports(baseline: Dict, current: Dict) -> List[Dict]:
+    """Per case and stage, the time of `current` relative to `baseline` (ratio > 1 is slower)."""
+    baseline_records = {(r["pipeline"], r["context_tokens"]): r for r in baseline["records"]}
+    rows = []
+    for record in current["records"]:
+        reference = baseline_records.get((record["pipeline"], record["context_tokens"]))
+        if reference is None:
+            continue
+        metrics = {f"stage:{k}": v for k, v in record["stages_s"].items()}
+        metrics.update({k: record[k] for k in ("memorize_s", "query_s", "peak_rss_mb")})
+        reference_metrics = {f"stage:{k}": v for k, v in reference["stages_s"].items()}
+        reference_metrics.update({k: reference.get(k) for k in ("memorize_s", "query_s", "peak_rss_mb")})
+        for metric, value in metrics.items():
+            before = reference_metrics.get(metric)
+            rows.append({
+                "pipeline": record["pipeline"],
+                "context_tokens": record["context_tokens"],
+                "metric": metric,
+                "baseline": before,
+                "current": value,
+                "ratio": round(value / before, 3) if before and value is not None else None,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MemoRAG retrieval benchmarks")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    index_parser = subparsers.add_parser("index", help="recall and latency of faiss index types by corpus size")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    index_parser.add_argument("--ndim", type=int, default=1024)
+    index_parser.add_argument("--num_queries", type=int, default=200)
+    index_parser.add_argument("--hits", type=int, default=10)
+
+    shard_parser = subparsers.add_parser("shards", help="sharded search throughput by shard count")
+    shard_parser.add_argument("--ntotal", type=int, default=1_000_000)
+    shard_parser.add_argument("--ndim", type=int, default=768)
+    shard_parser.add_argument("--num_queries", type=int, default=1000)
+    shard_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    shard_parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    shard_parser.add_argument("--index_factory", default="auto")
+    shard_parser.add_argument("--hits", type=int, default=10)
+
+    encode_parser = subparsers.add_parser("encode", help="key encoding throughput, fixed vs length-bucketed batches")
+    encode_parser.add_argument("--encoder", default="BAAI/bge-small-en-v1.5")
+    encode_parser.add_argument("--num_docs", type=int, default=2000)
+    encode_parser.add_argument("--batch_size", type=int, default=32)
+    encode_parser.add_argument("--max_tokens", type=int, default=None)
+    encode_parser.add_argument("--dtype", default="fp32")
+
+    backend_parser = subparsers.add_parser("backends", help="encoder backend latency and parity with eager float32")
+    backend_parser.add_argument("--encoder", default="BAAI/bge-small-en-v1.5")
+    backend_parser.add_argument("--backends", nargs="+", default=["eager", "compile", "onnx"])
+    backend_parser.add_argument("--num_queries", type=int, default=100)
+    backend_parser.add_argument("--num_docs", type=int, default=500)
+    backend_parser.add_argument("--batch_size", type=int, default=32)
+    backend_parser.add_argument("--min_cosine", type=float, default=None, help="exit with an error below this parity")
+
+    memorize_parser = subparsers.add_parser("memorize", help="longllm memorize time, weight reload vs in-place unpatch")
+    memorize_parser.add_argument("--model", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    memorize_parser.add_argument("--context_words", type=int, default=32000)
+    memorize_parser.add_argument("--repeats", type=int, default=3)
+
+    kv_parser = subparsers.add_parser("kv", help="memory file size and load time, pickle vs KV file format")
+    kv_parser.add_argument("--context_length", type=int, default=32768)
+    kv_parser.add_argument("--num_layers", type=int, default=32)
+    kv_parser.add_argument("--num_kv_heads", type=int, default=8)
+    kv_parser.add_argument("--head_dim", type=int, default=128)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="per-stage time, peak RSS and tokens/s of the full pipelines on offline stub models")
+    pipeline_parser.add_argument("--pipelines", nargs="+", choices=["memorag", "lite"], default=["memorag", "lite"])
+    pipeline_parser.add_argument("--context_tokens", type=int, nargs="+", default=[8192, 32768, 131072, 262144])
+    pipeline_parser.add_argument("--num_queries", type=int, default=4)
+    pipeline_parser.add_argument("--max_new_tokens", type=int, default=64)
+    pipeline_parser.add_argument("--chunk_workers", type=int, default=None)
+    pipeline_parser.add_argument("--model_dir", default=None, help="where the stub models are built, reused if present")
+    pipeline_parser.add_argument("--no_isolate", action="store_true", help="run all cases in this process")
+    pipeline_parser.add_argument("--output", default=None, help="also write the report to this JSON file")
+    pipeline_parser.add_argument("--baseline", default=None, help="report of an earlier commit to compare against")
+    args = parser.parse_args()
+
+    if args.bench == "index":
+        records = benchmark_index_tradeoff(args.sizes, args.ndim, args.num_queries, args.hits)
+    elif args.bench == "shards":
+        corpus = synthetic_embeddings(args.ntotal + args.num_queries, args.ndim)
+        records = benchmark_sharded_search(
+            corpus[args.num_queries:], corpus[:args.num_queries], args.shards, executor=args.executor, 
+            index_factory=args.index_factory, hits=args.hits)
+    elif args.bench == "encode":
+        retriever = DenseRetriever(args.encoder, dtype=args.dtype)
+        records = benchmark_key_encoding(
+            retriever, synthetic_docs(args.num_docs), batch_size=args.batch_size, max_tokens=args.max_tokens)
+    elif args.bench == "backends":
+        records = benchmark_encoder_backends(
+            args.encoder, 
+            synthetic_docs(args.num_queries, min_words=4, max_words=24, seed=1), 
+            synthetic_docs(args.num_docs), 
+            backends=args.backends, 
+            batch_size=args.batch_size)
+    elif args.bench == "memorize":
+        records = benchmark_memorize_reload(
+            Memory(args.model), " ".join(synthetic_docs(1, args.context_words, args.context_words)), repeats=args.repeats)
+    elif args.bench == "kv":
+        records = benchmark_kv_serialization(args.context_length, args.num_layers, args.num_kv_heads, args.head_dim)
+    elif args.bench == "pipeline":
+        records = benchmark_pipelines(
+            args.pipelines, args.context_tokens, model_dir=args.model_dir, isolate=not args.no_isolate, 
+            num_queries=args.num_queries, max_new_tokens=args.max_new_tokens, chunk_workers=args.chunk_workers)
+        if args.baseline:
+            with open(args.baseline) as f:
+                records["comparison"] = compare_pipeline_reports(json.load(f), records)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(records, f, indent=2)
+    print(json.dumps(records, indent=2))
+    if getattr(args, "min_cosine", None) is not None and any(r["min_cosine"] < args.min_cosine for r in records):
+        raise SystemExit(f"encoder parity below {args.min_cosine}")
+
+
+if __name__ == "__main__":
+    main()
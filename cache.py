@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Mapping, Optional, Tuple
+from transformers.utils import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.get_logger(__name__)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive advisory lock on `path` between processes; without `fcntl` (Windows) only one process
+    should write."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # closing the file releases the lock
+        yield
+
+
+class EmbeddingCache:
+    """On-disk cache from chunk content hash to embedding row.
+
+    Every encoder configuration (`namespace`) gets its own directory holding `embeddings.bin`, raw float32 rows
+    that are memory-mapped for reads, and `keys.txt`, the content hash of each row in order. Both files are
+    append-only, so re-encoding a lightly edited document only appends its new chunks. Processes sharing the
+    directory append under a file lock, and pick up each other's rows on their next lookup.
+    """
+    def __init__(self, cache_dir: str, namespace: Mapping, ndim: int) -> None:
+        self.namespace = dict(namespace)
+        self.ndim = ndim
+        self.dtype = np.dtype(np.float32)
+        self.row_bytes = ndim * self.dtype.itemsize
+
+        key = content_hash(json.dumps(self.namespace, sort_keys=True))
+        self.path = os.path.join(cache_dir, key)
+        os.makedirs(self.path, exist_ok=True)
+        self.keys_path = os.path.join(self.path, "keys.txt")
+        self.embeddings_path = os.path.join(self.path, "embeddings.bin")
+        self.lock_path = os.path.join(self.path, "lock")
+
+        namespace_path = os.path.join(self.path, "namespace.json")
+        if not os.path.exists(namespace_path):
+            with open(namespace_path, "w") as f:
+                json.dump(self.namespace, f, indent=2)
+
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._num_rows = 0
+        # bytes of `keys.txt` read so far
+        self._keys_offset = 0
+        self._mmap = None
+        self._load()
+
+    def _load(self):
+        with file_lock(self.lock_path):
+            keys = []
+            if os.path.exists(self.keys_path):
+                with open(self.keys_path) as f:
+                    keys = f.read().split()
+            num_rows = 0
+            if os.path.exists(self.embeddings_path):
+                num_rows = os.path.getsize(self.embeddings_path) // self.row_bytes
+
+            # an interrupted `put` may leave one file ahead of the other, keep the common prefix
+            num_rows = min(num_rows, len(keys))
+            if len(keys) != num_rows:
+                with open(self.keys_path, "w") as f:
+                    f.write("".join(f"{k}\n" for k in keys[:num_rows]))
+            with open(self.embeddings_path, "ab") as f:
+                f.truncate(num_rows * self.row_bytes)
+            self._refresh()
+        logger.info(f"loaded {self._num_rows} cached embeddings from {self.path}")
+
+    def _refresh(self):
+        """Index the rows other processes appended since the last look.
+
+        Rows are written before their keys, so every complete line of `keys.txt` has its row on disk.
+        """
+        size = os.path.getsize(self.keys_path) if os.path.exists(self.keys_path) else 0
+        if size < self._keys_offset:
+            # rewritten by a `_load` repairing an interrupted `put`, index it again
+            self._rows, self._num_rows, self._keys_offset, self._mmap = {}, 0, 0, None
+        if size == self._keys_offset:
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read(size - self._keys_offset)
+        end = data.rfind(b"\n") + 1
+        for key in data[:end].decode().split():
+            self._rows[key] = self._num_rows
+            self._num_rows += 1
+        self._keys_offset += end
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nbytes(self):
+        return self._num_rows * self.row_bytes
+
+    def _view(self) -> np.ndarray:
+        num_rows = self._num_rows
+        if self._mmap is None or len(self._mmap) < num_rows:
+            self._mmap = np.memmap(self.embeddings_path, dtype=self.dtype, mode="r", shape=(num_rows, self.ndim))
+        return self._mmap
+
+    def get(self, docs: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """Look up `docs` in the cache.
+
+        Returns:
+            embeddings: [len(docs), ndim], rows of missing docs are zero
+            missing: positions in `docs` that were not cached
+        """
+        embeddings = np.zeros((len(docs), self.ndim), dtype=self.dtype)
+        positions, rows, missing = [], [], []
+        with self._lock:
+            self._refresh()
+            for i, doc in enumerate(docs):
+                row = self._rows.get(content_hash(doc))
+                if row is None:
+                    missing.append(i)
+                else:
+                    positions.append(i)
+                    rows.append(row)
+            if rows:
+                embeddings[positions] = self._view()[rows]
+        return embeddings, missing
+
+    def put(self, docs: List[str], embeddings: np.ndarray):
+        """Append embeddings of `docs` that are not cached yet."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        with self._lock, file_lock(self.lock_path):
+            # rows other processes appended are neither appended again nor overwritten
+            self._refresh()
+            new_keys, new_rows, seen = [], [], set()
+            for doc, embedding in zip(docs, embeddings):
+                key = content_hash(doc)
+                if key in self._rows or key in seen:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(embedding)
+            if not new_keys:
+                return
+            # rows first: a crash in between leaves extra rows past the last key, cut off here or by `_load`
+            with open(self.embeddings_path, "ab") as f:
+                if os.path.getsize(self.embeddings_path) != self._num_rows * self.row_bytes:
+                    f.truncate(self._num_rows * self.row_bytes)
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.keys_path, "a") as f:
+                # and possibly a partial key line
+                if f.tell() != self._keys_offset:
+                    f.truncate(self._keys_offset)
+                f.write("".join(f"{k}\n" for k in new_keys))
+            self._refresh()
+
+
+def normalize_query(text: str) -> str:
+    """Case, Unicode width and whitespace variants of a query share one cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+class QueryEmbeddingCache:
+    """Thread-safe in-memory LRU of query embeddings, bounded by entry count and bytes, with optional TTL.
+
+    Entries are keyed by the normalized query text and the query instruction; embeddings are stored as 
+    read-only float32 rows.
+    """
+    def __init__(self, max_entries: int = 4096, max_bytes: Optional[int] = 64 * 1024 ** 2, ttl: Optional[float] = 3600.0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(query: str, instruct: Optional[str] = None) -> Tuple[Optional[str], str]:
+        return (instruct, normalize_query(query))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                self._pop(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, embedding: np.ndarray):
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        if self.max_bytes is not None and embedding.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (embedding, time.monotonic())
+            self._nbytes += embedding.nbytes
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._nbytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _pop(self, key):
+        embedding, _ = self._entries.pop(key)
+        self._nbytes -= embedding.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class ResponseCache:
+    """Thread-safe in-memory LRU of final answers, matched by query embedding similarity.
+
+    Entries are grouped by store (e.g. its fingerprint) and a hashable key of generation settings; a lookup 
+    returns the answer of the most similar cached query in its group if their cosine similarity reaches 
+    `threshold`. Bounded by entry count and by the bytes of embeddings and answers.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = 16 * 1024 ** 2, threshold: float = 0.95) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        # entry id -> ((store, group), normalized embedding, response, bytes)
+        self._entries = OrderedDict()
+        self._groups: Dict = {}
+        self._next_id = 0
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def get(self, store, group, embedding: np.ndarray) -> Optional[str]:
+        embedding = self._normalize(embedding)
+        with self._lock:
+            ids = self._groups.get((store, group))
+            if ids:
+                ids = list(ids)
+                similarity = np.stack([self._entries[i][1] for i in ids]) @ embedding
+                best = int(similarity.argmax())
+                if similarity[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self.hits += 1
+                    return self._entries[ids[best]][2]
+            self.misses += 1
+            return None
+
+    def put(self, store, group, embedding: np.ndarray, response: str):
+        embedding = self._normalize(embedding)
+        nbytes = embedding.nbytes + len(response.encode("utf-8"))
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = ((store, group), embedding, response, nbytes)
+            self._groups.setdefault((store, group), {})[entry_id] = None
+            self._nbytes += nbytes
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._nbytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _pop(self, entry_id):
+        group, _, _, nbytes = self._entries.pop(entry_id)
+        del self._groups[group][entry_id]
+        if not self._groups[group]:
+            del self._groups[group]
+        self._nbytes -= nbytes
+
+    def invalidate(self, store) -> None:
+        """Drop every entry about `store`."""
+        with self._lock:
+            for entry_id in [i for i, entry in self._entries.items() if entry[0][0] == store]:
+                self._pop(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,202 @@
+import numpy as np
+import multiprocessing
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
+from semantic_text_splitter import TextSplitter
+from transformers.utils import logging
+from .resources import _cpu_count
+
+logger = logging.get_logger(__name__)
+
+COARSE_BOUNDARIES = ("\n\n", "\n", ". ", " ")
+
+
+def coarse_segments(text: str, segment_chars: int) -> List[Tuple[int, int]]:
+    """Cut `text` into consecutive (start, end) spans of at most `segment_chars` characters, at the strongest
+    boundary (paragraph, line, sentence, word) in the second half of each span."""
+    spans, start = [], 0
+    while start < len(text):
+        end = min(start + segment_chars, len(text))
+        if end < len(text):
+            for boundary in COARSE_BOUNDARIES:
+                cut = text.rfind(boundary, start + segment_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(boundary)
+                    break
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+def _chunk_spans(splitter: TextSplitter, text: str, offset: int = 0) -> List[Tuple[int, int]]:
+    # chunks are trimmed, their character offsets point at the first kept character
+    return [(offset + start, offset + start + len(chunk)) for start, chunk in splitter.chunk_indices(text)]
+
+
+# the splitter of a `ParallelChunker` worker process
+_worker_splitter = None
+
+
+def _init_chunk_worker(model: str, capacity: int):
+    global _worker_splitter
+    _worker_splitter = TextSplitter.from_tiktoken_model(model, capacity)
+
+
+def _chunk_segment_worker(segment: Tuple[str, int]) -> List[Tuple[int, int]]:
+    return _chunk_spans(_worker_splitter, *segment)
+
+
+class TextChunks(Sequence):
+    """Read-only list of chunks stored as (start, end) character spans into their source texts.
+
+    Each source text is kept once; a chunk string is only materialized when it is indexed.
+    """
+    def __init__(self, text: Optional[str] = None, spans: Optional[List[Tuple[int, int]]] = None) -> None:
+        self.texts: List[str] = []
+        # source, start, end
+        self.spans = np.zeros((0, 3), dtype=np.int64)
+        if text is not None:
+            self.append(text, spans)
+
+    def append(self, text: str, spans: List[Tuple[int, int]]) -> None:
+        """Add the chunks of another source text."""
+        new_spans = np.zeros((len(spans), 3), dtype=np.int64)
+        new_spans[:, 0] = len(self.texts)
+        if len(spans):
+            new_spans[:, 1:] = spans
+        self.texts.append(text)
+        self.spans = np.concatenate([self.spans, new_spans])
+
+    def __add__(self, other):
+        """A new `TextChunks` with the chunks of both, sharing their source texts."""
+        if not isinstance(other, TextChunks):
+            return NotImplemented
+        chunks = TextChunks()
+        chunks.texts = self.texts + other.texts
+        other_spans = other.spans.copy()
+        other_spans[:, 0] += len(self.texts)
+        chunks.spans = np.concatenate([self.spans, other_spans])
+        return chunks
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        source, start, end = self.spans[i].tolist()
+        return self.texts[source][start:end]
+
+    def byte_spans(self) -> Tuple[List[bytes], np.ndarray]:
+        """The UTF-8 source texts and the chunk spans as byte offsets into their concatenation."""
+        blobs, byte_spans, base = [], np.zeros((len(self), 2), dtype=np.int64), 0
+        for source, text in enumerate(self.texts):
+            blob = text.encode("utf-8")
+            rows = np.flatnonzero(self.spans[:, 0] == source)
+            char_spans = self.spans[rows, 1:]
+            if len(blob) == len(text):
+                byte_spans[rows] = char_spans + base
+            else:
+                # byte position of every distinct chunk boundary, encoding the text between them once
+                positions = np.unique(char_spans)
+                byte_positions, byte_pos, char_pos = [], 0, 0
+                for position in positions.tolist():
+                    byte_pos += len(text[char_pos:position].encode("utf-8"))
+                    char_pos = position
+                    byte_positions.append(byte_pos)
+                byte_spans[rows] = np.asarray(byte_positions, dtype=np.int64)[np.searchsorted(positions, char_spans)] + base
+            blobs.append(blob)
+            base += len(blob)
+        return blobs, byte_spans
+
+
+class ChainedChunks(Sequence):
+    """Read-only concatenation of chunk sequences, e.g. a memory-mapped `ChunkStore` and the `TextChunks`
+    appended to it, that copies none of them."""
+    def __init__(self, parts: List[Sequence]) -> None:
+        self.parts = []
+        for part in parts:
+            for chunks in (part.parts if isinstance(part, ChainedChunks) else [part]):
+                if not len(chunks):
+                    continue
+                if self.parts and isinstance(self.parts[-1], TextChunks) and isinstance(chunks, TextChunks):
+                    self.parts[-1] = self.parts[-1] + chunks
+                else:
+                    self.parts.append(chunks)
+        # index of the first chunk of each part, and the total
+        self.offsets = np.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        part = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.parts[part][i - int(self.offsets[part])]
+
+
+def extend_corpus(corpus: Sequence, new_chunks: Sequence) -> Sequence:
+    """A new retrieval corpus with `new_chunks` appended, leaving `corpus` untouched for snapshots.
+
+    A loaded corpus stays memory-mapped, the result only refers to it.
+    """
+    if isinstance(corpus, TextChunks) and isinstance(new_chunks, TextChunks):
+        return corpus + new_chunks
+    return ChainedChunks([corpus, new_chunks])
+
+
+class ParallelChunker:
+    """Semantic chunking with character offsets, parallel over coarse segments of long texts.
+
+    Texts of at least `min_parallel_chars` characters are first cut at paragraph (or weaker) boundaries
+    into segments of about `segment_chars`, which worker processes split with the semantic splitter. A chunk
+    never crosses a segment boundary, so the chunks are not guaranteed to match splitting the whole text at
+    once; they still fit `capacity` and cover the text in order. Shorter texts, or `num_workers=1`, give
+    exactly the chunks of the semantic splitter.
+
+    Args:
+        capacity: max tokens per chunk
+        model: tiktoken model counting the tokens
+        num_workers: worker processes, defaults to the CPU count; 1 always splits in this process
+    """
+    def __init__(
+        self,
+        capacity: int,
+        model: str = "gpt-3.5-turbo",
+        num_workers: Optional[int] = None,
+        segment_chars: int = 200_000,
+        min_parallel_chars: int = 1_000_000) -> None:
+        self.capacity = capacity
+        self.model = model
+        self.num_workers = num_workers or _cpu_count()
+        self.segment_chars = segment_chars
+        self.min_parallel_chars = min_parallel_chars
+        self.splitter = TextSplitter.from_tiktoken_model(model, capacity)
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        """(start, end) character offsets of the chunks of `text`, in order."""
+        if self.num_workers <= 1 or len(text) < self.min_parallel_chars:
+            return _chunk_spans(self.splitter, text)
+
+        segments = coarse_segments(text, self.segment_chars)
+        num_workers = min(self.num_workers, len(segments))
+        logger.info(f"chunking {len(text)} characters as {len(segments)} segments in {num_workers} processes")
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_chunk_worker,
+            initargs=(self.model, self.capacity)) as pool:
+            results = pool.map(_chunk_segment_worker, [(text[start:end], start) for start, end in segments])
+            return [span for spans in results for span in spans]
+
+    def split(self, text: str) -> TextChunks:
+        return TextChunks(text, self.spans(text))
+
+    def chunks(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.spans(text)]
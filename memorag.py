@@ -1,17 +1,23 @@
 import torch
 from transformers.utils import logging
-from typing import Dict, Union, List, Optional
+from typing import AsyncIterator, Dict, Iterator, Union, List, Optional, Tuple
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 from transformers.tokenization_utils_base import BatchEncoding
-from itertools import chain
-from semantic_text_splitter import TextSplitter
-from .retrieval import DenseRetriever, FaissIndex
+from .retrieval import DenseRetriever, FaissIndex, CrossEncoderReranker, load_index, load_sparse_index
 from typing import Dict, List, Union
 from .prompt import en_prompts, zh_prompts
+from .chunking import ParallelChunker, extend_corpus
+from .store import save_chunks, load_chunks, save_kv_cache, load_kv_cache, is_kv_file
+from .cache import ResponseCache, content_hash
+from .registry import MODEL_REGISTRY
+from .resources import _available_ram_mb, _gpu_memory_mb
 import os 
-import json
+import time
+import asyncio
+import threading
 import tiktoken
-import copy
+from contextlib import contextmanager
 from minference import MInference
 
 logger = logging.get_logger(__name__)          
@@ -27,6 +33,157 @@ def merge_inputs(inputs1: BatchEncoding, inputs2: BatchEncoding) -> BatchEncodin
     })
     return merged_inputs
 
+@contextmanager
+def prefix_cache(cache: DynamicCache):
+    """Lend the memorized `cache` to one generation and truncate it back to the memorized prefix afterwards.
+
+    Generation grows the cache by concatenation, which frees the previous tensors, so the memory is 
+    never held twice as it is with a deep copy. Not thread-safe: generations sharing a cache must be serialized.
+    """
+    prefix_length = cache.get_seq_length()
+    try:
+        yield cache
+    finally:
+        cache.crop(prefix_length)
+
+
+def expand_cache(cache: DynamicCache, batch_size: int) -> DynamicCache:
+    """A batch of `batch_size` rows of a single-sequence cache.
+
+    The rows start as views, but the first decode step concatenates onto them, which materializes 
+    `batch_size` full copies of the cache; bound the batch with `decode_batch_size`.
+    """
+    return DynamicCache.from_legacy_cache(tuple(
+        (key.expand(batch_size, *key.shape[1:]), value.expand(batch_size, *value.shape[1:]))
+        for key, value in cache.to_legacy_cache()))
+
+
+def cache_nbytes(cache: DynamicCache) -> int:
+    return sum(t.numel() * t.element_size() for layer in cache.to_legacy_cache() for t in layer)
+
+
+# attention implementations whose masks are known to handle the pads left between the memorized prefix and
+# each prompt of a batch; flash attention 2 has not been verified with them, so it decodes one prompt at a time
+BATCHED_DECODE_ATTENTION = ("eager", "sdpa")
+
+
+def decode_batch_size(model, cache: DynamicCache, num_prompts: int, max_batch_size: int = 4, memory_fraction: float = 0.5) -> int:
+    """How many prompts to decode together against the memorized `cache`.
+
+    Every row of a batch holds its own copy of the cache once decoding starts (see `expand_cache`), so the 
+    batch is capped by the free memory of the model's device as well as by `max_batch_size`.
+    """
+    if num_prompts <= 1 or model.config._attn_implementation not in BATCHED_DECODE_ATTENTION:
+        return 1
+    if model.device.type == "cuda":
+        _, free_mb, _ = _gpu_memory_mb(model.device.index or 0)
+    else:
+        free_mb = _available_ram_mb()
+    batch_size = min(num_prompts, max_batch_size)
+    if free_mb is not None:
+        batch_size = min(batch_size, int(free_mb * 1024 ** 2 * memory_fraction // max(cache_nbytes(cache), 1)))
+    return max(1, batch_size)
+
+
+def _attribute_state(model) -> List:
+    """Shallow copies of the instance attributes of the model, its config and every submodule, which is where
+    MInference binds its forwards and flags. Classes and library modules are left alone."""
+    objects, seen = [], set()
+    for obj in [model, model.config, *model.modules()]:
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            objects.append(obj)
+
+    state = []
+    for obj in objects:
+        attrs = dict(vars(obj))
+        # submodule, parameter and buffer registries are mutated in place
+        registries = {key: dict(attrs[key]) for key in ("_modules", "_parameters", "_buffers") if isinstance(attrs.get(key), dict)}
+        state.append((obj, attrs, registries))
+    return state
+
+
+def _restore_attribute_state(state: List) -> None:
+    for obj, attrs, registries in state:
+        current = vars(obj)
+        for key in [key for key in current if key not in attrs]:
+            delattr(obj, key)
+        for key, value in attrs.items():
+            if current.get(key) is not value:
+                setattr(obj, key, value)
+        for key, saved in registries.items():
+            registry = current[key]
+            if len(registry) != len(saved) or any(registry.get(k) is not v for k, v in saved.items()):
+                registry.clear()
+                registry.update(saved)
+
+
+@contextmanager
+def reversible_patch(model):
+    """Undo, on exit, the instance attributes a monkey patch such as MInference's sets or replaces on `model`.
+
+    Weights are never copied, so patching for one pass and restoring costs no reload. Anyone else using
+    `model` inside the block runs the patched forwards, so only patch models nobody shares.
+    """
+    state = _attribute_state(model)
+    try:
+        yield
+    finally:
+        _restore_attribute_state(state)
+
+
+def generate_from_prefix(model, cache: DynamicCache, context_inputs, sample_inputs, **generation_kwargs) -> List[str]:
+    """Decode a left-padded batch of prompts that all continue the memorized context.
+
+    Each row is the context followed by its (padded) prompt, so the pads sit between the two; they are 
+    masked out and position ids skip them, which holds for `BATCHED_DECODE_ATTENTION`. The memorized `cache` 
+    is left as it was.
+    """
+    batch_size = sample_inputs["input_ids"].shape[0]
+    context_inputs = {k: v.expand(batch_size, -1) for k, v in context_inputs.items()}
+    sample_inputs = merge_inputs(context_inputs, sample_inputs)
+    if batch_size == 1:
+        with prefix_cache(cache) as past_key_values:
+            return model.ids2text(sample_inputs, past_key_values=past_key_values, **generation_kwargs)
+    return model.ids2text(sample_inputs, past_key_values=expand_cache(cache, batch_size), **generation_kwargs)
+
+
+class _StopOnEvent(StoppingCriteria):
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def stage_event(stage: str, tic: float) -> Dict:
+    return {"event": "stage", "stage": stage, "seconds": round(time.perf_counter() - tic, 4)}
+
+
+def print_index_stats(index: FaissIndex) -> None:
+    stats = index.stats()
+    print(f"Index: {stats['index_factory']} ({stats['quantize'] or 'float32'} keys), {stats['index_mb']:.1f} MB in memory, "
+          f"{stats['float32_mb']:.1f} MB as float32, "
+          f"recall@{stats['recall_at']} vs exact search: {stats['recall'] or 0:.3f}")
+    if stats["quantize"]:
+        print(f"Rescoring keys: {stats['rescore_mb']:.1f} MB float16, memory-mapped from disk once saved")
+
+
+async def aiterate(iterator: Iterator) -> AsyncIterator:
+    """Drive a blocking iterator from a worker thread, so the event loop keeps serving while it waits."""
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, next, iterator, sentinel)
+            if item is sentinel:
+                break
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            await loop.run_in_executor(None, iterator.close)
+
+
 class Model:
     def __init__(
         self, 
@@ -38,7 +195,8 @@ class Model:
         enable_flash_attn: bool=True
     ):  
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if enable_flash_attn:
+        # flash attention and bitsandbytes 4-bit need CUDA, load plainly on CPU
+        if enable_flash_attn and device.type == "cuda":
             if model_name_or_path.find("mistral") != -1:
                 attn_implementation = "sdpa"
             else:
@@ -46,7 +204,7 @@ class Model:
         else:
             attn_implementation = None
 
-        if model_name_or_path.find("memorag") == -1:
+        if model_name_or_path.find("memorag") == -1 and device.type == "cuda":
             load_in_4bit = True
 
         self.model_kwargs = {
@@ -68,27 +226,74 @@ class Model:
         if beacon_ratio and model_name_or_path.find("memorag") != -1:
             self.model_kwargs["beacon_ratio"] = [beacon_ratio]
 
-        tokenizer_kwargs = {
+        self.tokenizer_kwargs = {
             "cache_dir": cache_dir,
             "token": access_token,
             "padding_side": "left",
             "trust_remote_code": True,
         }
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name_or_path, 
-            **tokenizer_kwargs
+        # loaded on first use and shared with every `Model` of the same weights, see `ModelRegistry`
+        self._model = None
+        self._tokenizer = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def shared(self) -> bool:
+        """Whether other instances may use the same loaded weights."""
+        return True
+
+    @property
+    def registry_key(self) -> Tuple:
+        kwargs = self.model_kwargs
+        return (
+            "causal_lm", 
+            self.model_name_or_path, 
+            str(kwargs["torch_dtype"]), 
+            "4bit" if "quantization_config" in kwargs else None, 
+            str(kwargs["device_map"][""]), 
+            kwargs["attn_implementation"], 
+            str(kwargs.get("beacon_ratio")))
+
+    def _load(self):
+        tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name_or_path, 
+            **self.tokenizer_kwargs
         )
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name_or_path, 
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name_or_path, 
             **self.model_kwargs
         ).eval()
 
-        logger.info(f"Model loaded from {model_name_or_path}")
+        logger.info(f"Model loaded from {self.model_name_or_path}")
+
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return tokenizer, model
+
+    def _ensure_loaded(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    if self.shared:
+                        self._tokenizer, self._model = MODEL_REGISTRY.acquire(self.registry_key, self._load, owner=self)
+                    else:
+                        self._tokenizer, self._model = self._load()
+
+    @property
+    def model(self):
+        self._ensure_loaded()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
 
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
+    @property
+    def tokenizer(self):
+        self._ensure_loaded()
+        return self._tokenizer
 
     def ids2text(
         self, 
@@ -108,6 +313,44 @@ class Model:
 
         return decoded_output
 
+    def stream_ids(
+        self, 
+        inputs, 
+        **generation_kwargs
+    ) -> Iterator[str]:
+        """Like `ids2text` for a single sequence, but yields the decoded text piece by piece.
+
+        Generation runs in a background thread; closing the iterator early stops it.
+        """
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                self.model.generate(
+                    **inputs, 
+                    **generation_kwargs, 
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop)]),
+                    pad_token_id=self.tokenizer.eos_token_id
+                )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            stop.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def template2ids(
         self, 
         templates: List, 
@@ -136,18 +379,49 @@ class Model:
 
         return inputs
 
+    def continuation2ids(self, messages: List[Dict]) -> BatchEncoding:
+        """Token ids of `messages` as turns continuing a conversation, without the BOS, system prompt or other
+        start of a conversation that the chat template puts before the first turn."""
+        opening = [{"role": "user", "content": ""}, {"role": "assistant", "content": ""}]
+        prefix = self.tokenizer.apply_chat_template(opening, tokenize=False)
+        text = self.tokenizer.apply_chat_template(opening + messages, tokenize=False)
+        if not text.startswith(prefix):
+            raise ValueError("The chat template renders earlier turns differently once more follow, cannot continue a conversation.")
+        return self.tokenizer(
+            [text[len(prefix):]], 
+            add_special_tokens=False, 
+            return_tensors="pt"
+        ).to(self.model.device)
+
     def minference_patch(self, model_type:str="meta-llama/Meta-Llama-3.1-8B-Instruct"):
+        if self.shared:
+            raise ValueError("The model is shared through the registry, patching it would change it for every holder!")
         minference_patch = MInference("minference", model_type)
         self.model=minference_patch(self.model)
 
+    @contextmanager
+    def sparse_prefill(self, model_type:str="meta-llama/Meta-Llama-3.1-8B-Instruct"):
+        """Run the model with MInference sparse attention inside the block, and the dense attention it was 
+        loaded with afterwards, without reloading the weights. See `reversible_patch`."""
+        model = self.model
+        with reversible_patch(model):
+            try:
+                self.minference_patch(model_type)
+                yield
+            finally:
+                self.model = model
+
     def reload_model(self):
-        # TODO 
-        del self.model
+        """Load the weights again, the fallback for patches `sparse_prefill` cannot undo.
+
+        A shared model is dropped from the registry and loaded anew; instances still holding the old one 
+        keep it. Models that get patched (see `Memory.patches_model`) are never shared.
+        """
+        self._model = None
         torch.cuda.empty_cache()
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_name_or_path, 
-            **self.model_kwargs
-        ).eval()
+        if self.shared:
+            MODEL_REGISTRY.discard(self.registry_key)
+        self._ensure_loaded()
 
     def generate(
         self, 
@@ -182,10 +456,35 @@ class Model:
             all_outputs.extend(outputs)
         return all_outputs
 
+    def stream(
+        self, 
+        prompt: str, 
+        max_new_tokens: int = 256,
+        temperature: float = None,
+        top_p: float = None,
+        do_sample: bool = False,
+        repetition_penalty:float=1.0
+    ) -> Iterator[str]:
+        """Stream the response to a single prompt, see `stream_ids`."""
+        inputs = self.template2ids([[{"role": "user", "content": prompt}]])
+        yield from self.stream_ids(
+            inputs, 
+            max_new_tokens=max_new_tokens, 
+            do_sample=do_sample, 
+            temperature=temperature, 
+            top_p=top_p, 
+            repetition_penalty=repetition_penalty)
+
 
 class Memory(Model):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, max_decode_batch: int = 4, **kwargs):
+        """
+        Args:
+            max_decode_batch: `longllm` only, max instructions decoded together against the memory, see
+                `decode_batch_size`; 1 decodes them one at a time
+        """
         super().__init__(*args, **kwargs)
+        self.max_decode_batch = max_decode_batch
         self.memory = None
         if self.model_name_or_path.find("memorag") != -1:
             self.memo_type = "beacon"
@@ -197,13 +496,29 @@ class Memory(Model):
         else:
             self.prompts = en_prompts
 
+    @property
+    def shared(self) -> bool:
+        # beacon models keep the memory inside the model, and `longllm` models on CUDA are patched with
+        # MInference while memorizing, which must not affect other holders of the weights
+        return self.memo_type != "beacon" and not self.patches_model
+
+    @property
+    def patches_model(self) -> bool:
+        """Whether `memorize` patches the model with MInference sparse attention, which is CUDA only."""
+        return self.memo_type == "longllm" and torch.cuda.is_available()
+
     def memorize(
         self, 
         context, 
         max_length=None,
-        reload_model:bool=True
+        reload_model:bool=False
     ):
-        
+        """Prefill the memory with `context`.
+
+        Args:
+            reload_model: `longllm` only, reload the weights after the sparse prefill instead of undoing the 
+                MInference patch in place
+        """
         context_inputs = self.template2ids([[
             {"role": "user", "content": self.prompts["context"].format(context=context)},
             {"role": "assistant", "content": "I have read the article. Please provide your question."}
@@ -214,20 +529,52 @@ class Memory(Model):
                 self.model(**context_inputs)
             self.memory = self.model.memory.export()
         elif self.memo_type == "longllm":
-            self.minference_patch()
+            sparse_prefill = self.patches_model
             self.memory = DynamicCache()
             with torch.no_grad():
-                model_outputs = self.model(**context_inputs, past_key_values=self.memory)
+                if sparse_prefill and not reload_model:
+                    with self.sparse_prefill():
+                        model_outputs = self.model(**context_inputs, past_key_values=self.memory)
+                else:
+                    if sparse_prefill:
+                        self.minference_patch()
+                    model_outputs = self.model(**context_inputs, past_key_values=self.memory)
             self.memory = model_outputs.past_key_values
             self.context_inputs = context_inputs
-            if reload_model:
+            if reload_model and sparse_prefill:
                 self.reload_model()
 
+    def extend(self, context) -> None:
+        """Read `context` as a continuation of the memorized one, prefilling only the new tokens."""
+        if not self.memory:
+            raise ValueError("Memory is not initialized. Please memorize a context before extending it.")
+
+        # new turns of the memorized conversation, not the start of another one
+        extension_inputs = self.continuation2ids([
+            {"role": "user", "content": self.prompts["context_continue"].format(context=context)},
+            {"role": "assistant", "content": self.prompts["dull_reply"]}
+        ])
+        if self.memo_type == "beacon":
+            self.model.memory.reset(**self.memory)
+            with torch.no_grad():
+                self.model(**extension_inputs)
+            self.memory = self.model.memory.export()
+        elif self.memo_type == "longllm":
+            context_inputs = merge_inputs(self.context_inputs, extension_inputs)
+            with torch.no_grad():
+                model_outputs = self.model(
+                    input_ids=extension_inputs["input_ids"], 
+                    attention_mask=context_inputs["attention_mask"], 
+                    past_key_values=self.memory)
+            self.memory = model_outputs.past_key_values
+            self.context_inputs = context_inputs
+
     def reset(
         self
     ) -> None:
         self.memory = None
-        self.model.memory.reset()
+        if self.memo_type == "beacon":
+            self.model.memory.reset()
 
     def answer(
         self,
@@ -244,6 +591,14 @@ class Memory(Model):
         query, max_new_tokens=128) -> str:
         return self.generate(self.prompts["sur"], query, max_new_tokens=max_new_tokens)[0]
 
+    def recall_and_rewrite(
+        self,
+        query, max_new_tokens=128) -> Tuple[str, str]:
+        """`recall` and `rewrite` together, decoded as one batch with `longllm` memory."""
+        text_spans, surrogate_queries = self.generate(
+            [self.prompts["span"], self.prompts["sur"]], query, max_new_tokens=max_new_tokens)
+        return text_spans, surrogate_queries
+
     def summarize(
         self, max_new_tokens:int=512) -> str:
         return self.generate(self.prompts["sum"], max_new_tokens=max_new_tokens)[0]
@@ -256,8 +611,15 @@ class Memory(Model):
         temperature: float = None,
         top_p: float = None,
         do_sample: bool = False,
-        with_cache: bool = True
+        with_cache: bool = True,
+        batch_size: Optional[int] = None
     ) -> List[str]:
+        """Generate a response to every instruction from the memory.
+
+        Args:
+            batch_size: `longllm` only, instructions decoded together (against the memorized prefix 
+                `with_cache`), defaults to as many as `decode_batch_size` allows
+        """
         if not self.memory:
             raise ValueError("Memory is not initialized. Please ensure that memory has been formed before using generate.")
 
@@ -271,7 +633,29 @@ class Memory(Model):
             "top_p": top_p
         }
         if self.memo_type == "longllm" and with_cache:
-            generation_kwargs["past_key_values"] = copy.deepcopy(self.memory)
+            # all instructions share the memorized prefix, decode them together
+            batch_size = batch_size or decode_batch_size(self.model, self.memory, len(instruct), self.max_decode_batch)
+            outputs = []
+            for i in range(0, len(instruct), batch_size):
+                batch_prompts = []
+                for inst in instruct[i: i + batch_size]:
+                    content = inst.format(question=query) if query else inst
+                    batch_prompts.append([{"role": "user", "content": content}])
+                sample_inputs = self.template2ids(batch_prompts)
+                outputs.extend(generate_from_prefix(
+                    self, self.memory, self.context_inputs, sample_inputs, **generation_kwargs))
+                torch.cuda.empty_cache() 
+            return outputs
+        elif self.memo_type == "longllm":
+            # without the memory, instructions are plain prompts
+            prompts = [inst.format(question=query) if query else inst for inst in instruct]
+            return super().generate(
+                prompts, 
+                batch_size=batch_size or len(prompts), 
+                max_new_tokens=max_new_tokens, 
+                temperature=temperature, 
+                top_p=top_p, 
+                do_sample=do_sample)
 
         outputs = []
 
@@ -282,23 +666,55 @@ class Memory(Model):
                 sample_inputs = self.template2ids([[{"role": "user", "content": inst.format(question=query)}]])
             else:
                 sample_inputs = self.template2ids([[{"role": "user", "content": inst}]])
-            if self.memo_type == "longllm" and with_cache:
-                sample_inputs = merge_inputs(self.context_inputs, sample_inputs)
             response = self.ids2text(sample_inputs, **generation_kwargs)
             outputs.extend(response)
-            if self.memo_type == "longllm" and with_cache:
-                del generation_kwargs["past_key_values"]
-                torch.cuda.empty_cache() 
         return outputs
     
-    def save(self, path):
+    def stream(
+        self, 
+        instruct: str, 
+        query: str = "",  
+        max_new_tokens: int = 256,
+        temperature: float = None,
+        top_p: float = None,
+        do_sample: bool = False,
+        with_cache: bool = True
+    ) -> Iterator[str]:
+        """Stream the response to a single instruction from the memory, see `generate`."""
+        if not self.memory:
+            raise ValueError("Memory is not initialized. Please ensure that memory has been formed before using generate.")
+
+        generation_kwargs = {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "temperature": temperature,
+            "top_p": top_p
+        }
+        content = instruct.format(question=query) if query else instruct
+        sample_inputs = self.template2ids([[{"role": "user", "content": content}]])
+        if self.memo_type == "longllm" and with_cache:
+            sample_inputs = merge_inputs(self.context_inputs, sample_inputs)
+            with prefix_cache(self.memory) as past_key_values:
+                yield from self.stream_ids(sample_inputs, past_key_values=past_key_values, **generation_kwargs)
+        else:
+            if self.memo_type == "beacon":
+                self.model.memory.reset(**self.memory)
+            yield from self.stream_ids(sample_inputs, **generation_kwargs)
+
+    def save(self, path, quantize: Optional[str] = None):
+        """Save the memory.
+
+        Args:
+            quantize: `longllm` only, None, "int8" or "fp8" storage of the KV cache, see `save_kv_cache`
+        """
         if self.memo_type == "beacon":
             torch.save(self.memory, path)
         elif self.memo_type == "longllm":
-            torch.save(
-                {"memory": self.memory,
-                 "context_inputs": self.context_inputs}, 
-                 path)
+            save_kv_cache(
+                path, 
+                self.memory, 
+                tensors={f"context_inputs.{k}": v for k, v in self.context_inputs.items()}, 
+                quantize=quantize)
         else:
             raise NotImplementedError
         
@@ -306,9 +722,15 @@ class Memory(Model):
         if self.memo_type == "beacon":
             self.memory = torch.load(path)
         elif self.memo_type == "longllm":
-            _cache = torch.load(path)
-            self.memory = _cache["memory"]
-            self.context_inputs = _cache["context_inputs"]
+            if is_kv_file(path):
+                self.memory, tensors, _ = load_kv_cache(path, device=self.model.device)
+                self.context_inputs = BatchEncoding(
+                    {k[len("context_inputs."):]: v for k, v in tensors.items() if k.startswith("context_inputs.")})
+            else:
+                # pickled memory saved by earlier versions
+                _cache = torch.load(path)
+                self.memory = _cache["memory"]
+                self.context_inputs = _cache["context_inputs"]
         
 
 class MemoRAG:
@@ -324,7 +746,24 @@ class MemoRAG:
         access_token:Optional[str]=None,
         beacon_ratio:int=4,
         load_in_4bit:bool=False,
-        enable_flash_attn: bool=True):
+        enable_flash_attn: bool=True,
+        embedding_cache_dir:Optional[str]=None,
+        retrieval_fusion:str="rrf",
+        retrieval_mode:str="hybrid",
+        index_quantization:Optional[str]=None,
+        index_spill_dir:Optional[str]=None,
+        ret_encoder_backend:str="eager",
+        query_cache_size:int=4096,
+        index_shards:int=1,
+        query_dedup_threshold:Optional[float]=0.95,
+        max_knowledge_chunks:Optional[int]=None,
+        reranker_model_name_or_path:Optional[str]=None,
+        rerank_latency_budget:Optional[float]=None,
+        response_cache_size:int=0,
+        response_cache_bytes:Optional[int]=16 * 1024 ** 2,
+        response_cache_threshold:float=0.95,
+        chunk_workers:Optional[int]=None,
+        max_decode_batch:int=4):
 
         if mem_model_name_or_path.lower().find("chinese") != -1:
             self.prompts = zh_prompts
@@ -333,7 +772,8 @@ class MemoRAG:
             self.prompts = en_prompts
 
         self.mem_model = Memory(
-            mem_model_name_or_path, cache_dir=cache_dir, beacon_ratio=beacon_ratio, load_in_4bit=load_in_4bit, enable_flash_attn=enable_flash_attn)
+            mem_model_name_or_path, cache_dir=cache_dir, beacon_ratio=beacon_ratio, load_in_4bit=load_in_4bit, 
+            enable_flash_attn=enable_flash_attn, max_decode_batch=max_decode_batch)
 
         if gen_model_name_or_path:
             self.gen_model = Model(
@@ -344,28 +784,110 @@ class MemoRAG:
             self.gen_model = self.mem_model    
 
         self.retriever = DenseRetriever(
-            ret_model_name_or_path, hits=ret_hit, cache_dir=cache_dir, load_in_4bit=load_in_4bit)
-
-        self.text_splitter = TextSplitter.from_tiktoken_model(
-            "gpt-3.5-turbo", retrieval_chunk_size)
+            ret_model_name_or_path, hits=ret_hit, cache_dir=cache_dir, load_in_4bit=load_in_4bit, 
+            embedding_cache_dir=embedding_cache_dir, index_quantization=index_quantization, 
+            index_spill_dir=index_spill_dir, 
+            encoder_backend=ret_encoder_backend, query_cache_size=query_cache_size, 
+            num_shards=index_shards)
+
+        # splits long contexts in `chunk_workers` processes, keeping chunks as offsets into the context
+        self.chunker = ParallelChunker(retrieval_chunk_size, num_workers=chunk_workers)
+        self.text_splitter = self.chunker.splitter
+
+        # how the hits of all clue queries are merged, and how many chunks reach the generator
+        self.retrieval_fusion = retrieval_fusion
+        # "dense", "sparse" (BM25 only, no encoder pass per query) or "hybrid", can be changed between calls
+        self.retrieval_mode = retrieval_mode
+        self.query_dedup_threshold = query_dedup_threshold
+        self.max_knowledge_chunks = max_knowledge_chunks
+        # optional cross-encoder reordering the fused hits; max_knowledge_chunks then applies after it,
+        # and it gives up on the pairs left once rerank_latency_budget seconds are spent
+        self.reranker = None
+        if reranker_model_name_or_path:
+            self.reranker = CrossEncoderReranker(
+                reranker_model_name_or_path, cache_dir=cache_dir, latency_budget=rerank_latency_budget)
+        self.retrieval_corpus = None
+
+        # answers of "qa" and "memorag" calls, reused for later questions whose embedding has cosine 
+        # similarity >= response_cache_threshold with a cached one, about the same store and settings
+        self.response_cache = None
+        if response_cache_size:
+            self.response_cache = ResponseCache(response_cache_size, response_cache_bytes, response_cache_threshold)
+        # identifies the memorized store; changes on memorize, extend and load
+        self.store_fingerprint = None
+
+    def snapshot(self) -> Dict:
+        """References to everything `memorize`/`load` produced, to switch between contexts with `restore`."""
+        return {
+            "memory": self.mem_model.memory,
+            "context_inputs": getattr(self.mem_model, "context_inputs", None),
+            "index": self.retriever._index,
+            "sparse_index": self.retriever.sparse_index,
+            "retrieval_corpus": self.retrieval_corpus,
+            "store_fingerprint": self.store_fingerprint,
+        }
 
-    def memorize(self, context: str, save_dir: str = None, print_stats: bool = False):
+    def restore(self, state: Optional[Dict] = None) -> None:
+        """Make a `snapshot` the active context, or detach from all contexts if `state` is None.
+
+        Nothing is copied; after detaching, the next `memorize` builds a new index rather than resetting 
+        the one a snapshot refers to.
+        """
+        state = state or {}
+        self.mem_model.memory = state.get("memory")
+        self.mem_model.context_inputs = state.get("context_inputs")
+        self.retriever._index = state.get("index")
+        self.retriever.sparse_index = state.get("sparse_index")
+        self.retrieval_corpus = state.get("retrieval_corpus")
+        self.store_fingerprint = state.get("store_fingerprint")
+
+    def _set_fingerprint(self, fingerprint: str) -> None:
+        # answers about the store being replaced can never be served again
+        if self.response_cache is not None and self.store_fingerprint not in (None, fingerprint):
+            self.response_cache.invalidate(self.store_fingerprint)
+        self.store_fingerprint = fingerprint
+
+    def memorize(self, context: str, save_dir: str = None, print_stats: bool = False, kv_quantize: Optional[str] = None):
+        self._set_fingerprint(content_hash(context))
         self.retriever.remove_all()
 
         self.mem_model.memorize(context)
-        self.retrieval_corpus = self.text_splitter.chunks(context)
+        self.retrieval_corpus = self.chunker.split(context)
         self.retriever.add(self.retrieval_corpus)
 
         if save_dir:
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            self.mem_model.save(os.path.join(save_dir, "memory.bin"))
-            self.retriever._index.save(os.path.join(save_dir, "index.bin"))
-            with open(os.path.join(save_dir, "chunks.json"), "w") as f:
-                json.dump(self.retrieval_corpus, f, ensure_ascii=False, indent=2)
+            self._save(save_dir, kv_quantize)
+            if print_stats:
+                self._print_stats(save_dir, context)
+
+    def extend(self, context: str, save_dir: str = None, print_stats: bool = False, kv_quantize: Optional[str] = None):
+        """Append `context` to the memorized one without re-reading it.
+
+        The memory model prefills only the new text on top of its cache, and the new chunks are added to 
+        the existing index. Memorizes `context` if nothing is memorized yet.
+        """
+        if not self.mem_model.memory:
+            return self.memorize(context, save_dir, print_stats, kv_quantize)
+
+        self._set_fingerprint(content_hash(f"{self.store_fingerprint}:{content_hash(context)}"))
+        self.mem_model.extend(context)
+        new_chunks = self.chunker.split(context)
+        self.retriever.add(new_chunks)
+        self.retrieval_corpus = extend_corpus(self.retrieval_corpus, new_chunks)
+
+        if save_dir:
+            self._save(save_dir, kv_quantize)
             if print_stats:
                 self._print_stats(save_dir, context)
 
+    def _save(self, save_dir: str, kv_quantize: Optional[str] = None):
+        os.makedirs(save_dir, exist_ok=True)
+        self.mem_model.save(os.path.join(save_dir, "memory.bin"), quantize=kv_quantize)
+        self.retriever._index.save(os.path.join(save_dir, "index.bin"))
+        if self.retriever.sparse_index is not None:
+            self.retriever.sparse_index.save(os.path.join(save_dir, "bm25.bin"))
+        save_chunks(save_dir, self.retrieval_corpus)
+
     def _print_stats(self, save_dir: str, context: str=None):
         memory_path = os.path.join(save_dir, "memory.bin")
         memory_size_gb = os.path.getsize(memory_path) / (1024 ** 3)
@@ -376,14 +898,25 @@ class MemoRAG:
             encoded_context = encoding.encode(context)
             print(f"Encoded context length: {len(encoded_context)} tokens")
         print(f"Number of chunks in retrieval corpus: {len(self.retrieval_corpus)}")
+        print_index_stats(self.retriever._index)
+
 
+    def load(self, save_dir: str, print_stats: bool = False, mmap: bool = True):
+        """Load a store saved by `memorize`.
 
-    def load(self, save_dir: str, print_stats: bool = False):
-        self.mem_model.load(os.path.join(save_dir, "memory.bin"))
-        _index = FaissIndex(self.retriever.device)
-        _index.load(os.path.join(save_dir, "index.bin"))
-        self.retriever._index = _index
-        self.retrieval_corpus = json.load(open(os.path.join(save_dir, "chunks.json")))
+        Args:
+            mmap: memory-map the index and chunks instead of copying them into RAM
+        """
+        memory_path = os.path.join(save_dir, "memory.bin")
+        stat = os.stat(memory_path)
+        self._set_fingerprint(content_hash(f"{os.path.abspath(memory_path)}:{stat.st_size}:{stat.st_mtime_ns}"))
+        self.mem_model.load(memory_path)
+        self.retriever._index = load_index(
+            os.path.join(save_dir, "index.bin"), self.retriever.device, mmap=mmap, 
+            executor=self.retriever.shard_executor, spill_dir=self.retriever.index_spill_dir)
+        self.retrieval_corpus = load_chunks(save_dir, mmap=mmap)
+        if self.retriever.sparse:
+            self.retriever.sparse_index = load_sparse_index(os.path.join(save_dir, "bm25.bin"), self.retrieval_corpus)
         if print_stats:
             self._print_stats(save_dir)
             
@@ -395,37 +928,202 @@ class MemoRAG:
         prompt_template: str = None,
         max_new_tokens: int = 256,
         reset_each_call: bool = False,
-        use_memory_answer: bool = False
+        use_memory_answer: bool = False,
+        stream: bool = False
     ):
+        """Run a task against the memorized context.
+
+        Args:
+            stream: return the event iterator of `stream` instead of the final string
+        """
+        if stream:
+            return self.stream(
+                query, context, task_type, prompt_template, max_new_tokens, reset_each_call, use_memory_answer)
+
+        self._ensure_memory(context, reset_each_call)
+
+        if task_type == 'qa':
+            handle = lambda: self._handle_qa(query, max_new_tokens)
+        elif task_type == 'memorag':
+            handle = lambda: self._handle_rag(query, prompt_template, max_new_tokens, use_memory_answer)
+        elif task_type == 'summarize':
+            return self._handle_summarization(prompt_template, max_new_tokens)
+        else:
+            raise NotImplementedError(f"Task type '{task_type}' is not supported.")
+
+        if self.response_cache is None:
+            return handle()
+        group = self._response_group(task_type, prompt_template, max_new_tokens, use_memory_answer)
+        embedding = self.retriever.encode_queries(query)[0]
+        response = self.response_cache.get(self.store_fingerprint, group, embedding)
+        if response is None:
+            response = handle()
+            if isinstance(response, str):
+                self.response_cache.put(self.store_fingerprint, group, embedding, response)
+        return response
+
+    def _ensure_memory(self, context: Optional[str], reset_each_call: bool) -> Optional[float]:
+        """The start of `__call__` and `stream`: reset if asked, then memorize `context` unless memorized.
+
+        Returns:
+            the `time.perf_counter()` memorizing started at, None if the memory was kept
+        """
         assert self.gen_model is not None
-        
+
         if reset_each_call:
             self.mem_model.reset()
             self.retriever.remove_all()
 
-        if not self.mem_model.memory:
-            if not context:
-                raise ValueError("Please provide your input context...")
-            self.memorize(context)
+        if self.mem_model.memory:
+            return None
+        if not context:
+            raise ValueError("Please provide your input context...")
+        tic = time.perf_counter()
+        self.memorize(context)
+        return tic
+
+    def _response_group(self, task_type, prompt_template, max_new_tokens, use_memory_answer):
+        return (task_type, prompt_template, max_new_tokens, use_memory_answer, self.retrieval_mode)
+
+    def stream(
+        self, 
+        query: str = None, 
+        context: str = None, 
+        task_type: str = "memorag", 
+        prompt_template: str = None,
+        max_new_tokens: int = 256,
+        reset_each_call: bool = False,
+        use_memory_answer: bool = False
+    ) -> Iterator[Dict]:
+        """Like `__call__`, but yields events as the answer is produced.
+
+        Yields:
+            `{"event": "stage", "stage": name, "seconds": s}` as each stage before generation finishes,
+            `{"event": "token", "text": piece}` for every piece of the answer, 
+            and finally `{"event": "end", "text": answer}`
+        """
+        tic = self._ensure_memory(context, reset_each_call)
+        if tic is not None:
+            yield stage_event("memorize", tic)
 
         if task_type == 'qa':
-            return self._handle_qa(query, max_new_tokens)
+            tokens = self.mem_model.stream(self.prompts["qa"], query, max_new_tokens=max_new_tokens)
         elif task_type == 'memorag':
-            return self._handle_rag(query, prompt_template, max_new_tokens, use_memory_answer)
+            tic = time.perf_counter()
+            text_spans, surrogate_queries = self.mem_model.recall_and_rewrite(query)
+            yield stage_event("recall_rewrite", tic)
+
+            tic = time.perf_counter()
+            retrieval_query, potential_answer = self._prepare_retrieval_query(query, text_spans, surrogate_queries, use_memory_answer)
+            if use_memory_answer:
+                yield stage_event("memory_answer", tic)
+
+            tic = time.perf_counter()
+            retrieval_results = self._retrieve(retrieval_query, query)
+            yield stage_event("retrieve", tic)
+            if potential_answer:
+                retrieval_results.append(f"The answer might be {potential_answer}.")
+
+            knowledge = "\n\n".join(retrieval_results)
+            tokens = self._stream_response("qa_gen", query, knowledge, prompt_template, max_new_tokens)
         elif task_type == 'summarize':
-            return self._handle_summarization(prompt_template, max_new_tokens)
+            tic = time.perf_counter()
+            key_points = self.mem_model.summarize()
+            yield stage_event("summarize", tic)
+
+            tic = time.perf_counter()
+            retrieval_query = [query for query in key_points.split("\n") if len(query.split()) > 3]
+            retrieval_results = self._retrieve(retrieval_query)
+            yield stage_event("retrieve", tic)
+
+            knowledge = "\n\n".join(retrieval_results)
+            tokens = self._stream_response("sum_gen", None, knowledge, prompt_template, max_new_tokens)
         else:
             raise NotImplementedError(f"Task type '{task_type}' is not supported.")
 
+        pieces = []
+        for text in tokens:
+            pieces.append(text)
+            yield {"event": "token", "text": text}
+        yield {"event": "end", "text": "".join(pieces)}
+
+    async def astream(self, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Async generator version of `stream`."""
+        async for event in aiterate(self.stream(*args, **kwargs)):
+            yield event
+
+    def batch(
+        self, 
+        queries: List[str], 
+        task_type: str = "memorag", 
+        prompt_template: str = None,
+        max_new_tokens: int = 256,
+        use_memory_answer: bool = False
+    ) -> List[str]:
+        """Answer several queries about the memorized context, decoding each stage as one batch.
+
+        Clue spans, surrogate questions and memory answers of all queries are generated together, then
+        every query is retrieved for, and the final answers are generated together.
+        """
+        assert self.gen_model is not None
+        if not self.mem_model.memory:
+            raise ValueError("Memory is not initialized. Please memorize or load a context first.")
+
+        if task_type == 'summarize':
+            # the summary does not depend on the query
+            return [self._handle_summarization(prompt_template, max_new_tokens)] * len(queries)
+        elif task_type not in ('qa', 'memorag'):
+            raise NotImplementedError(f"Task type '{task_type}' is not supported.")
+        if self.response_cache is None:
+            return self._batch(queries, task_type, prompt_template, max_new_tokens, use_memory_answer)
+
+        group = self._response_group(task_type, prompt_template, max_new_tokens, use_memory_answer)
+        embeddings = self.retriever.encode_queries(queries)
+        responses = [self.response_cache.get(self.store_fingerprint, group, embedding) for embedding in embeddings]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            outputs = self._batch([queries[i] for i in missing], task_type, prompt_template, max_new_tokens, use_memory_answer)
+            for i, output in zip(missing, outputs):
+                responses[i] = output
+                if isinstance(output, str):
+                    self.response_cache.put(self.store_fingerprint, group, embeddings[i], output)
+        return responses
+
+    def _batch(self, queries, task_type, prompt_template, max_new_tokens, use_memory_answer):
+        prompts = self.mem_model.prompts
+        if task_type == 'qa':
+            return self.mem_model.generate(
+                [prompts["qa"].format(question=query) for query in queries], max_new_tokens=max_new_tokens)
+
+        stages = ["span", "sur", "qa"] if use_memory_answer else ["span", "sur"]
+        # the token budget of `recall_and_rewrite` and `answer` on the serial path
+        memory_outputs = self.mem_model.generate(
+            [prompts[stage].format(question=query) for query in queries for stage in stages], max_new_tokens=128)
+
+        gen_prompts = []
+        for i, query in enumerate(queries):
+            outputs = memory_outputs[i * len(stages): (i + 1) * len(stages)]
+            retrieval_query, _ = self._prepare_retrieval_query(query, outputs[0], outputs[1], False)
+            potential_answer = outputs[2] if use_memory_answer else None
+            if potential_answer:
+                retrieval_query.insert(-1, potential_answer)
+
+            retrieval_results = self._retrieve(retrieval_query, query)
+            if potential_answer:
+                retrieval_results.append(f"The answer might be {potential_answer}.")
+
+            knowledge = "\n\n".join(retrieval_results)
+            gen_prompts.append(self._format_prompt("qa_gen", query, knowledge, prompt_template))
+        return self._generate_prompts(gen_prompts, max_new_tokens)
+
     def _handle_qa(self, query: str, max_new_tokens:int=128):
         return self.mem_model.answer(query, max_new_tokens)
 
     def _handle_rag(self, query: str, prompt_template: str, max_new_tokens: int, use_memory_answer: bool):
-        text_spans = self.mem_model.recall(query)
-        surrogate_queries = self.mem_model.rewrite(query)
+        text_spans, surrogate_queries = self.mem_model.recall_and_rewrite(query)
         retrieval_query, potential_answer = self._prepare_retrieval_query(query, text_spans, surrogate_queries, use_memory_answer)
 
-        retrieval_results = self._retrieve(retrieval_query)
+        retrieval_results = self._retrieve(retrieval_query, query)
 
         if potential_answer:
             retrieval_results.append(f"The answer might be {potential_answer}.")
@@ -453,28 +1151,61 @@ class MemoRAG:
         retrieval_query.append(query)
         return retrieval_query, potential_answer
 
-    def _retrieve(self, retrieval_query):
-        topk_scores, topk_indices = self.retriever.search(queries=retrieval_query)
-        topk_indices = list(chain(*[topk_index.tolist() for topk_index in topk_indices]))
-        topk_indices = sorted(set([x for x in topk_indices if x > -1]))
-        return [self.retrieval_corpus[i].strip() for i in topk_indices]
-
-    def _generate_response(self, task_key: str, query: str, knowledge: str, prompt_template: str, max_new_tokens: int):
+    def _retrieve(self, retrieval_query, rerank_query: Optional[str] = None):
+        """Fetch the chunks for all `retrieval_query`s, reranked against `rerank_query` (or the retrieval 
+        queries themselves) when a reranker is set."""
+        topk_indices, _ = self.retriever.multi_search(
+            retrieval_query, 
+            fusion=self.retrieval_fusion, 
+            dedup_threshold=self.query_dedup_threshold, 
+            top_n=None if self.reranker else self.max_knowledge_chunks,
+            mode=self.retrieval_mode)
+        chunks = [self.retrieval_corpus[i].strip() for i in topk_indices]
+        if self.reranker is not None and chunks:
+            order, _ = self.reranker.rerank(rerank_query or retrieval_query, chunks, top_n=self.max_knowledge_chunks)
+            chunks = [chunks[j] for j in order]
+        return chunks
+
+    def _format_prompt(self, task_key: str, query: str, knowledge: str, prompt_template: str):
         if prompt_template:
-            prompt = prompt_template.format(input=query, context=knowledge) if query else prompt_template.format(context=knowledge)
+            return prompt_template.format(input=query, context=knowledge) if query else prompt_template.format(context=knowledge)
         else:
-            prompt = self.prompts[task_key].format(input=query, context=knowledge) if query else self.prompts[task_key].format(context=knowledge)
+            return self.prompts[task_key].format(input=query, context=knowledge) if query else self.prompts[task_key].format(context=knowledge)
 
+    def _generate_response(self, task_key: str, query: str, knowledge: str, prompt_template: str, max_new_tokens: int):
+        prompt = self._format_prompt(task_key, query, knowledge, prompt_template)
+        return self._generate_prompts([prompt], max_new_tokens)[0]
+
+    def _generate_prompts(self, prompts: List[str], max_new_tokens: int) -> List[str]:
         if self.gen_model.__class__.__name__ == "Memory" and self.mem_model.memo_type == "beacon":
             # `beacon` always has memory
             # self.gen_model._enable_beacon = False
-            output = self.gen_model.generate(prompt, max_new_tokens=max_new_tokens)[0]
+            outputs = self.gen_model.generate(prompts, max_new_tokens=max_new_tokens)
             # self.gen_model._enable_beacon = True
         elif self.gen_model.__class__.__name__ == "Memory" and self.mem_model.memo_type == "longllm": 
             # `longllm` stores/restores memory by past_key_values, user can control it by `with_cache`
-            output = self.gen_model.generate(prompt, max_new_tokens=max_new_tokens, with_cache=False)[0]
+            outputs = self.gen_model.generate(prompts, max_new_tokens=max_new_tokens, with_cache=False)
         elif self.gen_model.__class__.__name__ == "Model":
             # `Model.generate` does NOT have  parameter `with_cache`
-            output = self.gen_model.generate(prompt, max_new_tokens=max_new_tokens)[0]
+            outputs = self.gen_model.generate(prompts, batch_size=len(prompts), max_new_tokens=max_new_tokens)
+        elif hasattr(self.gen_model, "generate_many"):
+            # API-backed `customized_gen_model`s such as `Agent` send the prompts concurrently
+            outputs = self.gen_model.generate_many(prompts, max_new_tokens=max_new_tokens)
+        else:
+            # other `customized_gen_model`s take one prompt at a time
+            outputs = [self.gen_model.generate(prompt, max_new_tokens=max_new_tokens)[0] for prompt in prompts]
+        torch.cuda.empty_cache() 
+        return outputs
+
+    def _stream_response(self, task_key: str, query: str, knowledge: str, prompt_template: str, max_new_tokens: int):
+        prompt = self._format_prompt(task_key, query, knowledge, prompt_template)
+
+        if self.gen_model.__class__.__name__ == "Memory" and self.mem_model.memo_type == "longllm":
+            yield from self.gen_model.stream(prompt, max_new_tokens=max_new_tokens, with_cache=False)
+        elif hasattr(self.gen_model, "stream"):
+            # `Memory`, `Model`, and `customized_gen_model`s that stream
+            yield from self.gen_model.stream(prompt, max_new_tokens=max_new_tokens)
+        else:
+            # models without streaming support answer in one piece
+            yield self.gen_model.generate(prompt, max_new_tokens=max_new_tokens)[0]
         torch.cuda.empty_cache() 
-        return output
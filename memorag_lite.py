@@ -1,39 +1,30 @@
 import torch
 from transformers.utils import logging
-from typing import Dict, Union, List, Optional
+from typing import AsyncIterator, Callable, Dict, Iterator, Union, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
 from transformers.tokenization_utils_base import BatchEncoding
-from itertools import chain
-from semantic_text_splitter import TextSplitter
 from typing import Dict, List, Union
 import os 
 import time
 import json
 import tiktoken
-import copy
 from minference import MInference
 from langdetect import detect
-from .memorag import Model, merge_inputs
-from .retrieval import DenseRetriever, FaissIndex
+from .memorag import Model, merge_inputs, prefix_cache, generate_from_prefix, decode_batch_size, stage_event, aiterate, print_index_stats
+from .retrieval import DenseRetriever, CrossEncoderReranker, load_index, load_sparse_index
 from .prompt import en_prompts, zh_prompts
-import pynvml
+from .chunking import ParallelChunker, extend_corpus
+from .store import save_chunks, load_chunks, save_kv_cache, load_kv_cache, is_kv_file, GistJournal
+from .cache import content_hash
+from .resources import ResourceProbe, BatchCalibrator, DEFAULT_CALIBRATION_CACHE, max_batch_size
 
-def get_first_gpu_memory():
-    pynvml.nvmlInit()
+logger = logging.get_logger(__name__)
 
-    device_count = pynvml.nvmlDeviceGetCount()
+def _print_progress(event: Dict) -> None:
+    if event["done"] < event["total"]:
+        print(f"Progress: {round(event['done'] / event['total'] * 100, 2)}% of the context memorized...")
 
-    if device_count > 0:
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-
-        free_memory = mem_info.free / 1024 ** 2  
-
-        return free_memory
-    else:
-        return None
-
-    pynvml.nvmlShutdown()
 
 class MemoRAGLite:
     def __init__(
@@ -46,13 +37,43 @@ class MemoRAGLite:
         cache_dir: Optional[str] = None,
         access_token: Optional[str] = None,
         load_in_4bit: bool = False,
-        enable_flash_attn: bool = True):
-        
-        if gen_model_name_or_path.find("Qwen2.5-1.5B-Instruct") == -1:
-            self.adapt_bs = False
-        else:
-            self.adapt_bs = True
-
+        enable_flash_attn: bool = True,
+        embedding_cache_dir: Optional[str] = None,
+        retrieval_fusion: str = "rrf",
+        retrieval_mode: str = "hybrid",
+        index_quantization: Optional[str] = None,
+        index_spill_dir: Optional[str] = None,
+        ret_encoder_backend: str = "eager",
+        query_cache_size: int = 4096,
+        index_shards: int = 1,
+        query_dedup_threshold: Optional[float] = 0.95,
+        max_knowledge_chunks: Optional[int] = None,
+        reranker_model_name_or_path: Optional[str] = None,
+        rerank_latency_budget: Optional[float] = None,
+        resource_probe: Optional[ResourceProbe] = None,
+        calibration_cache: Optional[str] = DEFAULT_CALIBRATION_CACHE,
+        chunk_workers: Optional[int] = None,
+        max_decode_batch: int = 4):
+        """
+        Args:
+            retrieval_mode: "dense", "sparse" (BM25 only, no encoder pass per query) or "hybrid", 
+                see `DenseRetriever.multi_search`; can be changed between calls
+            index_quantization: None, "int8" or "binary" storage of the dense keys, rescored in float
+            index_spill_dir: where quantized keys spill their float16 rescoring copies while building, see
+                `DenseRetriever`; by default they stay in RAM until saved
+            ret_encoder_backend: "eager", "compile" or "onnx" retrieval encoder, see `build_encoder_backend`
+            query_cache_size: query embeddings kept in memory so repeated queries skip the encoder, 0 disables it
+            index_shards: faiss shards searched in parallel threads, see `ShardedFaissIndex`
+            reranker_model_name_or_path: cross-encoder reordering the retrieved chunks, see `CrossEncoderReranker`;
+                `max_knowledge_chunks` then applies after reranking
+            rerank_latency_budget: seconds the reranker may spend per retrieval
+            resource_probe: reports CPU, RAM and GPU resources for gist batch sizing, see `ResourceProbe`
+            calibration_cache: JSON file caching the gist batch size and thread count calibrated per host,
+                None to calibrate on every `memorize`
+            chunk_workers: processes splitting long contexts into chunks, see `ParallelChunker`; defaults to
+                the CPU count
+            max_decode_batch: max instructions decoded together against the memory, see `decode_batch_size`
+        """
         if gen_model_name_or_path:
             self.gen_model = Model(
                 gen_model_name_or_path, cache_dir=cache_dir, access_token=access_token, load_in_4bit=load_in_4bit, enable_flash_attn=enable_flash_attn)
@@ -61,11 +82,31 @@ class MemoRAGLite:
         else:
             raise NotImplementedError
 
+        # batch sizes and threads are only tuned for local models
+        self.adapt_bs = isinstance(self.gen_model, Model)
+        self.calibrator = BatchCalibrator(resource_probe, calibration_cache)
+
         self.ret_model_name_or_path = ret_model_name_or_path
         self.retrieval_chunk_size = retrieval_chunk_size
+        self.chunk_workers = chunk_workers
+        self.max_decode_batch = max_decode_batch
         self.ret_hit = ret_hit
         self.cache_dir = cache_dir
         self.load_in_4bit = load_in_4bit
+        self.embedding_cache_dir = embedding_cache_dir
+        self.retrieval_fusion = retrieval_fusion
+        self.retrieval_mode = retrieval_mode
+        self.index_quantization = index_quantization
+        self.index_spill_dir = index_spill_dir
+        self.ret_encoder_backend = ret_encoder_backend
+        self.query_cache_size = query_cache_size
+        self.index_shards = index_shards
+        self.query_dedup_threshold = query_dedup_threshold
+        self.max_knowledge_chunks = max_knowledge_chunks
+        self.reranker = None
+        if reranker_model_name_or_path:
+            self.reranker = CrossEncoderReranker(
+                reranker_model_name_or_path, cache_dir=cache_dir, latency_budget=rerank_latency_budget)
 
         self.prefix = "<|im_start|>user\n{input}"
         self.suffix = "<|im_end|>\n<|im_start|>assistant\n"
@@ -76,6 +117,7 @@ class MemoRAGLite:
         self.context_inputs = None
         self.retriever = None
         self.retrieval_corpus = None
+        self.language = None
 
     def __call__(
         self, 
@@ -85,33 +127,197 @@ class MemoRAGLite:
         prompt_template: str = None,
         max_new_tokens: int = 256,
         reset_each_call: bool = False,
-        use_memory_answer: bool = False
+        use_memory_answer: bool = False,
+        stream: bool = False
     ):
-        assert self.gen_model is not None
-        
-        if reset_each_call:
-            self.reset()
+        """Run a task against the memorized context.
 
-        if not self.memory:
-            if not context:
-                raise ValueError("Please provide your input context...")
+        Args:
+            stream: return the event iterator of `stream` instead of the final string
+        """
+        if stream:
+            return self.stream(
+                query, context, task_type, prompt_template, max_new_tokens, reset_each_call, use_memory_answer)
 
-            self.memorize(context)
+        self._ensure_memory(context, reset_each_call)
 
         if task_type == 'qa':
             return self.answer(query, max_new_tokens)
         elif task_type == 'memorag':
             return self._handle_rag(query, max_new_tokens, use_memory_answer)
+        elif task_type == 'summarize':
+            return self._handle_summarization(max_new_tokens)
+        else:
+            raise NotImplementedError(f"Task type '{task_type}' is not supported.")
+
+    def stream(
+        self, 
+        query: str = None, 
+        context: str = None, 
+        task_type: str = "memorag", 
+        prompt_template: str = None,
+        max_new_tokens: int = 256,
+        reset_each_call: bool = False,
+        use_memory_answer: bool = False
+    ) -> Iterator[Dict]:
+        """Like `__call__`, but yields events as the answer is produced, see `MemoRAG.stream`."""
+        tic = self._ensure_memory(context, reset_each_call)
+        if tic is not None:
+            yield stage_event("memorize", tic)
+
+        if task_type == 'qa':
+            tokens = self.stream_w_memory(self.prompts["qa"], query, max_new_tokens=max_new_tokens)
+        elif task_type == 'memorag':
+            tic = time.perf_counter()
+            text_spans, surrogate_queries = self.recall_and_rewrite(query)
+            yield stage_event("recall_rewrite", tic)
+
+            tic = time.perf_counter()
+            retrieval_query, potential_answer = self._prepare_retrieval_query(
+                query, text_spans, surrogate_queries, use_memory_answer)
+            if use_memory_answer:
+                yield stage_event("memory_answer", tic)
+
+            tic = time.perf_counter()
+            retrieval_results = self._retrieve(retrieval_query, query)
+            yield stage_event("retrieve", tic)
+            if potential_answer:
+                retrieval_results.append(f"The answer might be {potential_answer}.")
+
+            knowledge = "\n\n".join(retrieval_results)
+            _prompt = self.prompts["qa_gen"].format(context=knowledge, input=query)
+            tokens = self.gen_model.stream(_prompt, max_new_tokens=max_new_tokens, repetition_penalty=1.2)
+        elif task_type == 'summarize':
+            tic = time.perf_counter()
+            key_points = self.summarize()
+            yield stage_event("summarize", tic)
+
+            tic = time.perf_counter()
+            retrieval_results = self._retrieve(self._filter_queries(key_points.split("\n")))
+            yield stage_event("retrieve", tic)
+
+            knowledge = "\n\n".join(retrieval_results)
+            _prompt = self.prompts["sum_gen"].format(context=knowledge)
+            tokens = self.gen_model.stream(_prompt, max_new_tokens=max_new_tokens, repetition_penalty=1.2)
         else:
             raise NotImplementedError(f"Task type '{task_type}' is not supported.")
 
+        pieces = []
+        for text in tokens:
+            pieces.append(text)
+            yield {"event": "token", "text": text}
+        yield {"event": "end", "text": "".join(pieces)}
+
+    def _ensure_memory(self, context: Optional[str], reset_each_call: bool) -> Optional[float]:
+        """The start of `__call__` and `stream`, see `MemoRAG._ensure_memory`."""
+        assert self.gen_model is not None
+
+        if reset_each_call:
+            self.reset()
+
+        if self.memory:
+            return None
+        if not context:
+            raise ValueError("Please provide your input context...")
+        tic = time.perf_counter()
+        self.memorize(context)
+        return tic
+
+    async def astream(self, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Async generator version of `stream`."""
+        async for event in aiterate(self.stream(*args, **kwargs)):
+            yield event
+
+    def snapshot(self) -> Dict:
+        """References to everything `memorize`/`load` produced, to switch between contexts with `restore`."""
+        return {
+            "memory": self.memory,
+            "context_inputs": self.context_inputs,
+            "prompts": self.prompts,
+            "language": self.language,
+            "gists": self.gists,
+            "index": self.retriever._index if self.retriever else None,
+            "sparse_index": self.retriever.sparse_index if self.retriever else None,
+            "retrieval_corpus": self.retrieval_corpus,
+        }
+
+    def restore(self, state: Optional[Dict] = None) -> None:
+        """Make a `snapshot` the active context, or detach from all contexts if `state` is None.
+
+        Nothing is copied; after detaching, the next `memorize` builds a new index rather than resetting 
+        the one a snapshot refers to.
+        """
+        state = state or {}
+        self.memory = state.get("memory")
+        self.context_inputs = state.get("context_inputs")
+        self.prompts = state.get("prompts")
+        self.language = state.get("language")
+        self.gists = state.get("gists")
+        if self.retriever is None and state.get("index") is not None:
+            self.retriever = self._new_retriever()
+        if self.retriever is not None:
+            self.retriever._index = state.get("index")
+            self.retriever.sparse_index = state.get("sparse_index")
+        self.retrieval_corpus = state.get("retrieval_corpus")
+
+    def batch(
+        self, 
+        queries: List[str], 
+        task_type: str = "memorag", 
+        prompt_template: str = None,
+        max_new_tokens: int = 256,
+        use_memory_answer: bool = False
+    ) -> List[str]:
+        """Answer several queries about the memorized context, decoding each stage as one batch, 
+        see `MemoRAG.batch`."""
+        assert self.gen_model is not None
+        if not self.memory:
+            raise ValueError("Memory is not initialized. Please memorize or load a context first.")
+
+        if task_type == 'qa':
+            return self.generate_w_memory(
+                [self.prompts["qa"].format(question=query) for query in queries], max_new_tokens=max_new_tokens)
+        elif task_type == 'summarize':
+            # the summary does not depend on the query
+            return [self._handle_summarization(max_new_tokens)] * len(queries)
+        elif task_type != 'memorag':
+            raise NotImplementedError(f"Task type '{task_type}' is not supported.")
+
+        stages = ["span", "sur", "qa"] if use_memory_answer else ["span", "sur"]
+        memory_outputs = self.generate_w_memory(
+            [self.prompts[stage].format(question=query) for query in queries for stage in stages], max_new_tokens=128)
+
+        gen_prompts = []
+        for i, query in enumerate(queries):
+            outputs = memory_outputs[i * len(stages): (i + 1) * len(stages)]
+            retrieval_query, _ = self._prepare_retrieval_query(query, outputs[0], outputs[1], False)
+            potential_answer = outputs[2] if use_memory_answer else None
+            if potential_answer:
+                retrieval_query.insert(-1, potential_answer)
+
+            retrieval_results = self._retrieve(retrieval_query, query)
+            if potential_answer:
+                retrieval_results.append(f"The answer might be {potential_answer}.")
+
+            knowledge = "\n\n".join(retrieval_results)
+            gen_prompts.append(self.prompts["qa_gen"].format(context=knowledge, input=query))
+        return self.gen_model.generate(
+            gen_prompts, batch_size=len(gen_prompts), max_new_tokens=max_new_tokens, repetition_penalty=1.2)
+
+    def _handle_summarization(self, max_new_tokens: int):
+        key_points = self.summarize()
+        retrieval_results = self._retrieve(self._filter_queries(key_points.split("\n")))
+
+        knowledge = "\n\n".join(retrieval_results)
+        _prompt = self.prompts["sum_gen"].format(context=knowledge)
+        return self.gen_model.generate(_prompt, max_new_tokens=max_new_tokens, repetition_penalty=1.2)[0]
+
     def _handle_rag(self, query: str, max_new_tokens: int=128, use_memory_answer: bool=True):
-        text_spans = self.recall(query)
-        surrogate_queries = self.rewrite(query)
+        text_spans, surrogate_queries = self.recall_and_rewrite(query)
         retrieval_query, potential_answer = self._prepare_retrieval_query(
             query, text_spans, surrogate_queries, use_memory_answer)
 
-        retrieval_results = self._retrieve(retrieval_query)
+        retrieval_results = self._retrieve(retrieval_query, query)
         if potential_answer:
             retrieval_results.append(f"The answer might be {potential_answer}.")
 
@@ -121,11 +327,7 @@ class MemoRAGLite:
 
 
     def _prepare_retrieval_query(self, query, text_spans, surrogate_queries, use_memory_answer):
-        retrieval_query = text_spans.split("\n") + surrogate_queries.split("\n")
-        if self.language == "zh-cn":
-            retrieval_query = [q for q in retrieval_query if len(q) > 3] # TODO
-        else:
-            retrieval_query = [q for q in retrieval_query if len(q.split()) > 3]
+        retrieval_query = self._filter_queries(text_spans.split("\n") + surrogate_queries.split("\n"))
 
         potential_answer = None
         if use_memory_answer:
@@ -134,11 +336,26 @@ class MemoRAGLite:
         retrieval_query.append(query)
         return retrieval_query, potential_answer
 
-    def _retrieve(self, retrieval_query):
-        topk_scores, topk_indices = self.retriever.search(queries=retrieval_query)
-        topk_indices = list(chain(*[topk_index.tolist() for topk_index in topk_indices]))
-        topk_indices = sorted(set([x for x in topk_indices if x > -1]))
-        return [self.retrieval_corpus[i].strip() for i in topk_indices]
+    def _filter_queries(self, queries):
+        if self.language == "zh-cn":
+            return [q for q in queries if len(q) > 3] # TODO
+        else:
+            return [q for q in queries if len(q.split()) > 3]
+
+    def _retrieve(self, retrieval_query, rerank_query: Optional[str] = None):
+        """Fetch the chunks for all `retrieval_query`s, reranked against `rerank_query` (or the retrieval 
+        queries themselves) when a reranker is set."""
+        topk_indices, _ = self.retriever.multi_search(
+            retrieval_query, 
+            fusion=self.retrieval_fusion, 
+            dedup_threshold=self.query_dedup_threshold, 
+            top_n=None if self.reranker else self.max_knowledge_chunks,
+            mode=self.retrieval_mode)
+        chunks = [self.retrieval_corpus[i].strip() for i in topk_indices]
+        if self.reranker is not None and chunks:
+            order, _ = self.reranker.rerank(rerank_query or retrieval_query, chunks, top_n=self.max_knowledge_chunks)
+            chunks = [chunks[j] for j in order]
+        return chunks
 
     def reset(self):
         torch.cuda.empty_cache()
@@ -150,33 +367,67 @@ class MemoRAGLite:
         self.context_inputs = None
         self.language = None
 
-    def adapt_batch_size(self):
-        free_memory = get_first_gpu_memory()
-
-        if free_memory < 23000:
-            print(f"The minimum recommended GPU memory for MemoRAG is 24GiB, but only {round(free_memory / 1024, 1)} GiB is available.")
-
-        if self.adapt_bs:
-            memory_thresholds = {
-                "en": [(70000, 16), (60000, 10), (38000, 8), (20000, 4), (14000, 2)], 
-                "zh-cn": [(70000, 16), (60000, 10), (38000, 8), (20000, 4), (14000, 2)]  
-            }
-            thresholds = memory_thresholds.get(self.language, memory_thresholds["en"])
-
-            for threshold, bs in thresholds:
-                if free_memory > threshold:
-                    batch_size = bs
-                    break
-        return batch_size
+    def adapt_batch_size(
+        self,
+        gist_chunks: List[str],
+        max_new_tokens: int = 512,
+        gist_chunk_size: int = 4096,
+        probe_tokens: int = 512) -> int:
+        """Pick the gist batch size, and on CPU the torch thread count, by a short calibration run.
+
+        The calibration generates for the first gist prompts truncated to `probe_tokens`. The batch size is
+        capped by the KV cache memory the full-length batch needs; the result is cached per host.
+        """
+        if not self.adapt_bs:
+            return 1
+
+        resources = self.calibrator.probe.probe()
+        on_gpu = self.gen_model.model.device.type == "cuda"
+        if on_gpu and resources["gpu_free_mb"] < 23000:
+            print(f"The minimum recommended GPU memory for MemoRAG is 24GiB, but only {round(resources['gpu_free_mb'] / 1024, 1)} GiB is available.")
+
+        seq_len = len(self.gen_model.tokenizer.encode(gist_chunks[0])) + max_new_tokens
+        max_batch = max_batch_size(self.gen_model.model, resources, seq_len)
+
+        def run(prompts, new_tokens):
+            self.gen_model.generate(prompts, batch_size=len(prompts), max_new_tokens=new_tokens, repetition_penalty=1.2)
+
+        # short probes keep calibration cheap, the memory cap above still accounts for the full prompts
+        tokenizer = self.gen_model.tokenizer
+        probes = [
+            tokenizer.decode(tokenizer.encode(chunk, add_special_tokens=False)[:probe_tokens])
+            for chunk in gist_chunks[:self.calibrator.num_probes]]
+        best = self.calibrator.calibrate(
+            run,
+            probes,
+            key=f"{self.gen_model.model_name_or_path}|{self.gen_model.model.dtype}|{self.language}|{gist_chunk_size}",
+            max_batch=max_batch,
+            on_gpu=on_gpu)
+        if not on_gpu:
+            torch.set_num_threads(best["num_threads"])
+        logger.info(f"Gist generation: batch size {best['batch_size']}, {best['num_threads']} threads, ~{best['tokens_per_s']} tokens/s")
+        return best["batch_size"]
 
     def memorize(
         self, 
         context: str, 
         save_dir: str = None, 
         print_stats: bool = True, 
-        batch_size: int = 1,
-        gist_chunk_size: int = 4096):
-    
+        batch_size: Optional[int] = None,
+        gist_chunk_size: int = 4096,
+        kv_quantize: Optional[str] = None,
+        num_workers: int = 1,
+        journal_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[Dict], None]] = None):
+        """Memorize `context`: form gists of it, encode them as the memory, and build the retrieval index.
+
+        Args:
+            batch_size: gists generated per batch, None to calibrate, see `adapt_batch_size`
+            num_workers: batches generated concurrently; more than one mainly helps API-based models
+            journal_path: gist journal to resume from, defaults to `gists.jsonl` in `save_dir`
+            progress_callback: called with a progress event dict after each gist batch,
+                defaults to printing the progress when `print_stats`
+        """
         self.reset()
 
         # Detect language
@@ -185,40 +436,28 @@ class MemoRAGLite:
         if print_stats:
             print(f"Detected language: {self.language}")
 
-        batch_size = self.adapt_batch_size()
-
         # Encode context
-        encoding = tiktoken.get_encoding("cl100k_base")
-        encoded_context = encoding.encode(context)
         if print_stats:
+            encoded_context = tiktoken.get_encoding("cl100k_base").encode(context)
             print(f"Context length: {len(encoded_context)} tokens")
 
         # Set appropriate prompts based on detected language
         self.prompts = zh_prompts if self.language == "zh-cn" else en_prompts
 
         # Split context into gists
-        text_splitter = TextSplitter.from_tiktoken_model("gpt-3.5-turbo", gist_chunk_size)
-        gist_chunks = text_splitter.chunks(context)
+        gist_chunks = ParallelChunker(gist_chunk_size, num_workers=self.chunk_workers).chunks(context)
         gist_chunks = [self.prompts["gist"].format(context=chunk) for chunk in gist_chunks]
 
         # Generate gists
         if print_stats:
             print(f"Forming memory of the context...")
+        if journal_path is None and save_dir:
+            journal_path = os.path.join(save_dir, "gists.jsonl")
+        if progress_callback is None and print_stats:
+            progress_callback = _print_progress
 
-        self.gists = []
-        for i in range(0, len(gist_chunks), batch_size):
-            if print_stats and i > 1:
-                progress = round(i / len(gist_chunks) * 100, 2)
-                print(f"Progress: {progress}% of the context memorized...")
-
-            gists_batch = self.gen_model.generate(
-                gist_chunks[i:i+batch_size], 
-                batch_size=batch_size, 
-                max_new_tokens=512, 
-                repetition_penalty=1.2)
-            torch.cuda.empty_cache()
-            
-            self.gists.extend(gists_batch)
+        self.gists = self._form_gists(
+            gist_chunks, batch_size, gist_chunk_size, num_workers, journal_path, progress_callback)
 
         # Join generated gists and clear cache
         gists_concatenated = "\n".join(self.gists)
@@ -248,16 +487,14 @@ class MemoRAGLite:
             print("Context memorization completed successfully.")
 
         # Set up dense retrieval index
-        self.text_splitter = TextSplitter.from_tiktoken_model("gpt-3.5-turbo", self.retrieval_chunk_size)
-        self.retriever = DenseRetriever(
-            self.ret_model_name_or_path,
-            hits=self.ret_hit,
-            cache_dir=self.cache_dir,
-            load_in_4bit=self.load_in_4bit
-        )
+        self.chunker = ParallelChunker(self.retrieval_chunk_size, num_workers=self.chunk_workers)
+        self.text_splitter = self.chunker.splitter
+        # `reset` emptied the index of an existing retriever, whose encoder and query cache are kept
+        if self.retriever is None:
+            self.retriever = self._new_retriever()
 
         # Add retrieval corpus and build the index
-        self.retrieval_corpus = self.text_splitter.chunks(context)
+        self.retrieval_corpus = self.chunker.split(context)
         with torch.no_grad():
             self.retriever.add(self.retrieval_corpus)
         torch.cuda.empty_cache()
@@ -267,28 +504,173 @@ class MemoRAGLite:
 
         # Save memory and index if save_dir is specified
         if save_dir:
-            os.makedirs(save_dir, exist_ok=True)
-            torch.save(
-                {
-                    "memory": self.memory,
-                    "context_inputs": self.context_inputs,
-                    "prompts": self.prompts,
-                    "language": self.language
-                }, 
-                os.path.join(save_dir, "memory.bin")
-            )
-            self.retriever._index.save(os.path.join(save_dir, "index.bin"))
-            with open(os.path.join(save_dir, "chunks.json"), "w") as f:
-                json.dump(self.retrieval_corpus, f, ensure_ascii=False, indent=2)
+            self._save(save_dir, kv_quantize)
+            if print_stats:
+                self._print_stats(save_dir, context)
+
+    def extend(
+        self, 
+        context: str, 
+        save_dir: str = None, 
+        print_stats: bool = True, 
+        batch_size: Optional[int] = None,
+        gist_chunk_size: int = 4096,
+        kv_quantize: Optional[str] = None,
+        num_workers: int = 1,
+        journal_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[Dict], None]] = None):
+        """Append `context` to the memorized one without re-reading it.
+
+        Only the gists of the new text are generated and prefilled on top of the memory, and only its chunks 
+        are added to the index. Memorizes `context` if nothing is memorized yet; arguments as in `memorize`.
+        """
+        if not self.memory:
+            return self.memorize(
+                context, save_dir, print_stats, batch_size, gist_chunk_size, kv_quantize, 
+                num_workers, journal_path, progress_callback)
+
+        gist_chunker = ParallelChunker(gist_chunk_size, num_workers=self.chunk_workers)
+        gist_chunks = [self.prompts["gist"].format(context=chunk) for chunk in gist_chunker.chunks(context)]
+        if journal_path is None and save_dir:
+            journal_path = os.path.join(save_dir, "gists.jsonl")
+        if progress_callback is None and print_stats:
+            progress_callback = _print_progress
+        new_gists = self._form_gists(
+            gist_chunks, batch_size, gist_chunk_size, num_workers, journal_path, progress_callback)
+        if self.gists is not None:
+            self.gists.extend(new_gists)
+
+        # stores saved before `extend` existed lack the prompt
+        default_prompts = zh_prompts if self.language == "zh-cn" else en_prompts
+        continue_prompt = self.prompts.get("context_continue", default_prompts["context_continue"])
+        # the memorized user turn is left open for the instruction, continue it with the new gists
+        extension_inputs = self.gen_model.tokenizer(
+            ["\n\n" + continue_prompt.format(context="\n".join(new_gists))], 
+            add_special_tokens=False, 
+            return_tensors="pt"
+        ).to(self.gen_model.model.device)
+        context_inputs = merge_inputs(self.context_inputs, extension_inputs)
+        with torch.no_grad():
+            model_outputs = self.gen_model.model(
+                input_ids=extension_inputs["input_ids"], 
+                attention_mask=context_inputs["attention_mask"], 
+                past_key_values=self.memory)
+        self.memory = model_outputs.past_key_values
+        self.context_inputs = context_inputs
+        torch.cuda.empty_cache()
 
+        chunker = ParallelChunker(self.retrieval_chunk_size, num_workers=self.chunk_workers)
+        new_chunks = chunker.split(context)
+        with torch.no_grad():
+            self.retriever.add(new_chunks)
+        self.retrieval_corpus = extend_corpus(self.retrieval_corpus, new_chunks)
+        torch.cuda.empty_cache()
+
+        if save_dir:
+            self._save(save_dir, kv_quantize)
             if print_stats:
                 self._print_stats(save_dir, context)
 
+    def _new_retriever(self) -> DenseRetriever:
+        return DenseRetriever(
+            self.ret_model_name_or_path,
+            hits=self.ret_hit,
+            cache_dir=self.cache_dir,
+            load_in_4bit=self.load_in_4bit,
+            embedding_cache_dir=self.embedding_cache_dir,
+            index_quantization=self.index_quantization,
+            index_spill_dir=self.index_spill_dir,
+            encoder_backend=self.ret_encoder_backend,
+            query_cache_size=self.query_cache_size,
+            num_shards=self.index_shards
+        )
+
+    def _save(self, save_dir: str, kv_quantize: Optional[str] = None):
+        os.makedirs(save_dir, exist_ok=True)
+        save_kv_cache(
+            os.path.join(save_dir, "memory.bin"),
+            self.memory,
+            tensors={f"context_inputs.{k}": v for k, v in self.context_inputs.items()},
+            meta={"prompts": self.prompts, "language": self.language},
+            quantize=kv_quantize
+        )
+        self.retriever._index.save(os.path.join(save_dir, "index.bin"))
+        if self.retriever.sparse_index is not None:
+            self.retriever.sparse_index.save(os.path.join(save_dir, "bm25.bin"))
+        save_chunks(save_dir, self.retrieval_corpus)
+
+    def _form_gists(
+        self,
+        gist_chunks: List[str],
+        batch_size: Optional[int] = None,
+        gist_chunk_size: int = 4096,
+        num_workers: int = 1,
+        journal_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[Dict], None]] = None,
+        max_new_tokens: int = 512) -> List[str]:
+        """Generate the gist of every chunk prompt with a pool of `num_workers` threads.
+
+        Finished batches are appended to the journal at `journal_path`; gists already in it are skipped.
+        """
+        model_name = getattr(self.gen_model, "model_name_or_path", type(self.gen_model).__name__)
+        keys = [content_hash(json.dumps([model_name, max_new_tokens, chunk])) for chunk in gist_chunks]
+        journal = GistJournal(journal_path) if journal_path else None
+
+        gists = [None] * len(gist_chunks)
+        todo = []
+        for i, key in enumerate(keys):
+            if journal is not None and key in journal:
+                gists[i] = journal[key]
+            else:
+                todo.append(i)
+        total, skipped, done = len(gist_chunks), len(gist_chunks) - len(todo), len(gist_chunks) - len(todo)
+        tic = time.perf_counter()
+
+        def report():
+            if progress_callback is not None:
+                progress_callback({
+                    "event": "progress", "stage": "gist", "done": done, "total": total, "skipped": skipped,
+                    "seconds": round(time.perf_counter() - tic, 4)})
+
+        def run(batch):
+            return self.gen_model.generate(
+                [gist_chunks[i] for i in batch], 
+                batch_size=len(batch), 
+                max_new_tokens=max_new_tokens, 
+                repetition_penalty=1.2)
+
+        # adapt_batch_size may tune torch threads for gist generation, restored afterwards
+        num_threads = torch.get_num_threads()
+        pool = ThreadPoolExecutor(max(1, num_workers))
+        try:
+            report()
+            if todo and batch_size is None:
+                batch_size = self.adapt_batch_size([gist_chunks[i] for i in todo], max_new_tokens, gist_chunk_size)
+            futures = {
+                pool.submit(run, todo[i: i + batch_size]): todo[i: i + batch_size] 
+                for i in range(0, len(todo), batch_size or 1)}
+            for future in as_completed(futures):
+                batch = futures[future]
+                for i, gist in zip(batch, future.result()):
+                    gists[i] = gist
+                    if journal is not None:
+                        journal.append(keys[i], gist)
+                torch.cuda.empty_cache()
+                done += len(batch)
+                report()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            torch.set_num_threads(num_threads)
+            if journal is not None:
+                journal.close()
+        return gists
+
     def _print_stats(self, save_dir: str, context: str = None):
         memory_path = os.path.join(save_dir, "memory.bin")
         memory_size_gb = os.path.getsize(memory_path) / (1024 ** 3)
         print(f"Memory file size: {memory_size_gb:.2f} GB")
         print(f"Number of chunks in retrieval corpus: {len(self.retrieval_corpus)}")
+        print_index_stats(self.retriever._index)
 
     def generate_w_memory(
         self, 
@@ -299,7 +681,8 @@ class MemoRAGLite:
         top_p: float = None,
         do_sample: bool = False,
         with_cache: bool = True,
-        repetition_penalty: float=1.2):
+        repetition_penalty: float=1.2,
+        batch_size: Optional[int] = None):
         
         if not self.memory:
             raise ValueError("Memory is not initialized. Please ensure that memory has been formed before using generate.")
@@ -312,47 +695,86 @@ class MemoRAGLite:
             "do_sample": do_sample,
             "temperature": temperature,
             "top_p": top_p,
-            "past_key_values": copy.deepcopy(self.memory),
             "repetition_penalty": repetition_penalty
         }
 
+        # all instructions share the memorized prefix, decode them together
+        batch_size = batch_size or decode_batch_size(self.gen_model.model, self.memory, len(instruct), self.max_decode_batch)
         outputs = []
-        for i, inst in enumerate(instruct):
-            
-            if query:
-                inst = inst.format(question=query)
-            sample_to_encode = f"{inst}{self.suffix}"
+        for i in range(0, len(instruct), batch_size):
+            samples_to_encode = []
+            for inst in instruct[i: i + batch_size]:
+                if query:
+                    inst = inst.format(question=query)
+                samples_to_encode.append(f"{inst}{self.suffix}")
             sample_inputs = self.gen_model.tokenizer(
-                                [sample_to_encode], 
+                                samples_to_encode, 
                                 add_special_tokens=False, 
                                 return_tensors="pt", 
                                 padding=True
                             ).to(self.gen_model.model.device)
 
-            sample_inputs = merge_inputs(self.context_inputs, sample_inputs)
-            response = self.gen_model.ids2text(sample_inputs, **generation_kwargs)
-            outputs.extend(response)
+            outputs.extend(generate_from_prefix(
+                self.gen_model, self.memory, self.context_inputs, sample_inputs, **generation_kwargs))
 
         return outputs
 
-    def load(self, path):
-        _cache = torch.load(os.path.join(path, "memory.bin"))
-        self.memory = _cache["memory"]
-        self.context_inputs = _cache["context_inputs"]
-        self.prompts = _cache["prompts"]
-        self.language = _cache["language"]
+    def stream_w_memory(
+        self, 
+        instruct: str, 
+        query: str = "",  
+        max_new_tokens: int = 256,
+        temperature: float = None,
+        top_p: float = None,
+        do_sample: bool = False,
+        repetition_penalty: float=1.2) -> Iterator[str]:
+        """Stream the response to a single instruction from the memory, see `generate_w_memory`."""
+        if not self.memory:
+            raise ValueError("Memory is not initialized. Please ensure that memory has been formed before using generate.")
+
+        if query:
+            instruct = instruct.format(question=query)
+        sample_inputs = self.gen_model.tokenizer(
+                            [f"{instruct}{self.suffix}"], 
+                            add_special_tokens=False, 
+                            return_tensors="pt", 
+                            padding=True
+                        ).to(self.gen_model.model.device)
+        sample_inputs = merge_inputs(self.context_inputs, sample_inputs)
+        with prefix_cache(self.memory) as past_key_values:
+            yield from self.gen_model.stream_ids(
+                sample_inputs,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty)
+
+    def load(self, path, mmap: bool = True):
+        memory_path = os.path.join(path, "memory.bin")
+        if is_kv_file(memory_path):
+            self.memory, tensors, meta = load_kv_cache(memory_path, device=self.gen_model.model.device)
+            self.context_inputs = BatchEncoding(
+                {k[len("context_inputs."):]: v for k, v in tensors.items() if k.startswith("context_inputs.")})
+            self.prompts = meta["prompts"]
+            self.language = meta["language"]
+        else:
+            # pickled memory saved by earlier versions
+            _cache = torch.load(memory_path)
+            self.memory = _cache["memory"]
+            self.context_inputs = _cache["context_inputs"]
+            self.prompts = _cache["prompts"]
+            self.language = _cache["language"]
         
         if not self.retriever:
-            self.retriever = DenseRetriever(
-                self.ret_model_name_or_path,
-                hits=self.ret_hit,
-                cache_dir=self.cache_dir,
-                load_in_4bit=self.load_in_4bit
-            )
-        _index = FaissIndex(self.retriever.device)
-        _index.load(os.path.join(path, "index.bin"))
-        self.retriever._index = _index
-        self.retrieval_corpus = json.load(open(os.path.join(path, "chunks.json")))
+            self.retriever = self._new_retriever()
+        self.retriever._index = load_index(
+            os.path.join(path, "index.bin"), self.retriever.device, mmap=mmap, 
+            executor=self.retriever.shard_executor, spill_dir=self.retriever.index_spill_dir)
+        self.retrieval_corpus = load_chunks(path, mmap=mmap)
+        if self.retriever.sparse:
+            self.retriever.sparse_index = load_sparse_index(os.path.join(path, "bm25.bin"), self.retrieval_corpus)
 
 
     def answer(
@@ -370,6 +792,13 @@ class MemoRAGLite:
         query, max_new_tokens=128) -> str:
         return self.generate_w_memory(self.prompts["sur"], query, max_new_tokens=max_new_tokens)[0]
 
+    def recall_and_rewrite(
+        self,
+        query, max_new_tokens=128) -> Tuple[str, str]:
+        text_spans, surrogate_queries = self.generate_w_memory(
+            [self.prompts["span"], self.prompts["sur"]], query, max_new_tokens=max_new_tokens)
+        return text_spans, surrogate_queries
+
     def summarize(
         self, max_new_tokens:int=512) -> str:
         return self.generate_w_memory(self.prompts["sum"], max_new_tokens=max_new_tokens)[0]
@@ -45,7 +45,11 @@ Your task is to create a concise summary of the long article by listing its key
     "qa_gen": "Read the text below and answer a question.\n\n{context}\n\nQuestion: {input}\n\nBe concise.",
     "sum_gen": "Summarize the following text.\n\n{context}",
     "gist": "Please summarize the core content of the following text, remove redundant information, and compress it into concise and accurate text. Retain all key facts and points. The language should be straightforward and concise, and do not use any formatting.\n\nText: {context}\n\nPlease output the core content directly.",
-    "dull_reply": "I have read the article. Please provide your question."
+    "dull_reply": "I have read the article. Please provide your question.",
+    "context_continue": """The article continues:
+- **Article Content:** {context}
+
+The continuation ends here."""
 }
 
 zh_prompts = {
@@ -99,6 +103,10 @@ zh_prompts = {
 
     "sum_gen": "请总结以下文本，请输出中文。\n\n{context}", 
     "gist": "请总结以下文本的核心内容，删除冗余信息，压缩为简洁、准确的文本，保留所有关键事实和要点，语言直观、简明，不要使用任何格式。\n\n文本：{context}\n\n请直接输出核心内容。",
-    "dull_reply": "我已经读完文本，请提出你的问题。"
+    "dull_reply": "我已经读完文本，请提出你的问题。",
+    "context_continue": """文章继续：
+- **文章内容：** {context}
+
+续篇到此结束。"""
 }
 
@@ -0,0 +1,165 @@
+import gc
+import time
+import weakref
+import threading
+import torch
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+def loaded_nbytes(value) -> int:
+    """Bytes of the parameters and buffers of every torch module in `value` (a module or a tuple)."""
+    values = value if isinstance(value, (tuple, list)) else (value,)
+    nbytes = 0
+    for item in values:
+        if isinstance(item, torch.nn.Module):
+            nbytes += sum(t.numel() * t.element_size() for t in item.parameters())
+            nbytes += sum(t.numel() * t.element_size() for t in item.buffers())
+    return nbytes
+
+
+class _Entry:
+    def __init__(self, value, nbytes):
+        self.value = value
+        self.nbytes = nbytes
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    """Process-wide, ref-counted cache of loaded models and tokenizers.
+
+    `acquire` loads a key on first use and hands the same objects to every later caller, so pipelines and
+    retrievers with the same model share its weights. A reference is dropped with `release`, or when the
+    `owner` passed to `acquire` is garbage collected. Unreferenced models stay loaded for reuse until the
+    loaded total exceeds `memory_budget_mb`, then the least recently used ones are evicted.
+
+    Args:
+        memory_budget_mb: megabytes of weights worth keeping loaded, None never evicts idle models
+    """
+    def __init__(self, memory_budget_mb: Optional[float] = None) -> None:
+        self.memory_budget_mb = memory_budget_mb
+        self._entries: Dict[Hashable, _Entry] = OrderedDict()
+        # keys being loaded, set once their load finished or failed
+        self._loading: Dict[Hashable, threading.Event] = {}
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def acquire(self, key: Hashable, loader: Callable[[], Any], owner: Any = None) -> Any:
+        """The object loaded for `key`, calling `loader()` if nobody has loaded it yet.
+
+        The load runs outside the registry lock, so other keys can be acquired and released meanwhile;
+        concurrent callers for the same key wait for the first one's load.
+
+        Args:
+            owner: release the reference when this object is garbage collected
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    self._take(key, entry)
+                    break
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    load = True
+                else:
+                    load = False
+            if not load:
+                # loaded by another caller, or its load failed and this one retries
+                loading.wait()
+                continue
+            try:
+                tic = time.perf_counter()
+                value = loader()
+            except BaseException:
+                with self._lock:
+                    del self._loading[key]
+                loading.set()
+                raise
+            with self._lock:
+                entry = self._entries[key] = _Entry(value, loaded_nbytes(value))
+                del self._loading[key]
+                self.loads += 1
+                self._take(key, entry)
+            loading.set()
+            logger.info(f"loaded {key[:2]} ({entry.nbytes / 1024 ** 2:.0f} MB) in {time.perf_counter() - tic:.1f}s")
+            break
+        if owner is not None:
+            weakref.finalize(owner, self._release, key, entry)
+        return entry.value
+
+    def _take(self, key, entry):
+        # under the lock, before anything can evict the entry
+        entry.refs += 1
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def release(self, key: Hashable) -> None:
+        """Drop a reference taken by `acquire` without an `owner`."""
+        self._release(key, self._entries.get(key))
+
+    def _release(self, key, entry):
+        with self._lock:
+            # a discarded entry is no longer counted
+            if entry is None or self._entries.get(key) is not entry or entry.refs == 0:
+                return
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            self._evict()
+
+    def discard(self, key: Hashable) -> None:
+        """Forget `key`, e.g. after its model was modified; current holders keep their objects."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def _evict(self, budget_bytes: Optional[float] = None):
+        if budget_bytes is None:
+            if self.memory_budget_mb is None:
+                return
+            budget_bytes = self.memory_budget_mb * 1024 ** 2
+        evicted = False
+        # least recently used first
+        for key in [key for key, entry in self._entries.items() if entry.refs == 0]:
+            if self.nbytes <= budget_bytes:
+                break
+            logger.info(f"evicting idle model {key[:2]}")
+            del self._entries[key]
+            self.evictions += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def evict_idle(self) -> None:
+        """Unload every model nobody references."""
+        with self._lock:
+            self._evict(budget_bytes=0)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "models": len(self._entries),
+                "in_use": sum(entry.refs > 0 for entry in self._entries.values()),
+                "loaded_mb": self.nbytes / 1024 ** 2,
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+            }
+
+
+# shared by all pipelines in the process; set `MODEL_REGISTRY.memory_budget_mb` to evict idle models
+MODEL_REGISTRY = ModelRegistry()
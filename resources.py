@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import socket
+import platform
+import torch
+from typing import Callable, Dict, List, Optional, Tuple
+from transformers.utils import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+logger = logging.get_logger(__name__)
+
+DEFAULT_CALIBRATION_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "memorag", "calibration.json")
+
+
+def _cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _physical_cores() -> int:
+    if psutil is not None:
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return min(cores, _cpu_count())
+    # without psutil, assume two hardware threads per core
+    return max(1, _cpu_count() // 2)
+
+
+def _available_ram_mb() -> Optional[float]:
+    if psutil is not None:
+        return psutil.virtual_memory().available / 1024 ** 2
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _gpu_memory_mb(device: int = 0) -> Tuple[Optional[str], Optional[float], Optional[float]]:
+    """Name, free and total memory of a GPU, from torch when CUDA is initialized and NVML otherwise."""
+    if torch.cuda.is_available():
+        free, total = torch.cuda.mem_get_info(device)
+        return torch.cuda.get_device_name(device), free / 1024 ** 2, total / 1024 ** 2
+    if pynvml is not None:
+        try:
+            pynvml.nvmlInit()
+            try:
+                if pynvml.nvmlDeviceGetCount() > device:
+                    handle = pynvml.nvmlDeviceGetHandleByIndex(device)
+                    info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    name = pynvml.nvmlDeviceGetName(handle)
+                    name = name.decode() if isinstance(name, bytes) else name
+                    return name, info.free / 1024 ** 2, info.total / 1024 ** 2
+            finally:
+                pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            pass
+    return None, None, None
+
+
+class ResourceProbe:
+    """Reports the compute resources available on this host.
+
+    Subclass and override `probe` (e.g. to read cgroup limits on a container host) and pass the instance
+    to `MemoRAGLite(resource_probe=...)`.
+    """
+    def probe(self) -> Dict:
+        """Returns:
+            dict with `cpu_count`, `physical_cores`, `torch_threads`, `ram_available_mb` and, when a GPU is
+            present, `gpu_name`, `gpu_free_mb`, `gpu_total_mb`
+        """
+        gpu_name, gpu_free, gpu_total = _gpu_memory_mb()
+        return {
+            "cpu_count": _cpu_count(),
+            "physical_cores": _physical_cores(),
+            "torch_threads": torch.get_num_threads(),
+            "ram_available_mb": _available_ram_mb(),
+            "gpu_name": gpu_name,
+            "gpu_free_mb": gpu_free,
+            "gpu_total_mb": gpu_total,
+        }
+
+    def fingerprint(self, resources: Dict) -> str:
+        """Identifies the host hardware, free memory excluded, as the key of cached calibrations."""
+        return "|".join(str(x) for x in (
+            socket.gethostname(),
+            platform.machine(),
+            resources["cpu_count"],
+            resources["gpu_name"],
+            round(resources["gpu_total_mb"] or 0),
+            torch.__version__,
+        ))
+
+
+def kv_bytes_per_token(model) -> int:
+    """Size of the KV cache of one token for a transformers causal LM."""
+    config = model.config
+    num_heads = config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * model.dtype.itemsize
+
+
+def max_batch_size(
+    model,
+    resources: Dict,
+    seq_len: int,
+    candidates: List[int] = (1, 2, 4, 8, 16, 32),
+    memory_fraction: float = 0.6) -> int:
+    """Largest candidate batch whose KV cache, plus about as much again for activations, fits in memory.
+
+    Uses free GPU memory when the model is on a GPU and available RAM otherwise.
+    """
+    if model.device.type == "cuda":
+        free_mb = resources["gpu_free_mb"]
+    else:
+        free_mb = resources["ram_available_mb"]
+    if free_mb is None:
+        return candidates[0]
+    per_sequence_mb = 2 * kv_bytes_per_token(model) * seq_len / 1024 ** 2
+    fitting = [bs for bs in candidates if bs * per_sequence_mb <= free_mb * memory_fraction]
+    return fitting[-1] if fitting else candidates[0]
+
+
+def thread_candidates(resources: Dict) -> List[int]:
+    """Torch intra-op thread counts worth trying on CPU: physical cores, all logical cores, and half the cores."""
+    cores = resources["physical_cores"]
+    return sorted({cores, resources["cpu_count"], max(1, cores // 2)}, reverse=True)
+
+
+def _is_oom(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+class BatchCalibrator:
+    """Picks the batch size and torch thread count that maximize generated tokens/sec.
+
+    A few short probe inputs are tiled into batches of 1, 2, 4, ... and each batch runs a short generation,
+    stopping at the first batch that is slower than the previous one or runs out of memory. On CPU the thread
+    count is picked first, at batch size 1. The fastest configuration is cached in a JSON file keyed by host
+    fingerprint and `key`, so later runs on the same host skip calibration.
+
+    Args:
+        probe: the `ResourceProbe` describing this host
+        cache_path: JSON file of cached calibrations, None disables caching
+        calibration_tokens: new tokens generated per calibration run
+        num_probes: distinct inputs the calibration batches are tiled from
+    """
+    def __init__(
+        self,
+        probe: Optional[ResourceProbe] = None,
+        cache_path: Optional[str] = DEFAULT_CALIBRATION_CACHE,
+        calibration_tokens: int = 32,
+        num_probes: int = 2) -> None:
+        self.probe = probe or ResourceProbe()
+        self.cache_path = cache_path
+        self.calibration_tokens = calibration_tokens
+        self.num_probes = num_probes
+
+    def _read_cache(self) -> Dict:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring unreadable calibration cache {self.cache_path}")
+            return {}
+
+    def _write_cache(self, entry_key: str, entry: Dict) -> None:
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        cache = self._read_cache()
+        cache[entry_key] = entry
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def _time(self, run: Callable[[List, int], None], probes: List, batch_size: int, num_threads: int) -> Optional[float]:
+        """Tokens/sec of one run of `batch_size` inputs, None when it runs out of memory."""
+        batch = [probes[i % len(probes)] for i in range(batch_size)]
+        tic = time.perf_counter()
+        try:
+            run(batch, self.calibration_tokens)
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logger.info(f"calibration: batch {batch_size} ran out of memory")
+            return None
+        tokens_per_s = batch_size * self.calibration_tokens / (time.perf_counter() - tic)
+        logger.info(f"calibration: batch {batch_size}, {num_threads} threads, {tokens_per_s:.1f} tokens/s")
+        return tokens_per_s
+
+    def calibrate(
+        self,
+        run: Callable[[List, int], None],
+        inputs: List,
+        key: str,
+        max_batch: int,
+        on_gpu: bool) -> Dict:
+        """Time `run(batch, max_new_tokens)` for each candidate configuration.
+
+        Args:
+            run: generates for a batch of inputs
+            inputs: calibration inputs, the first `num_probes` are used; pass them truncated to keep it cheap
+            key: identifies the model and workload, e.g. model name and chunk size
+            max_batch: largest batch size allowed by memory
+            on_gpu: thread count is only tuned on CPU
+
+        Returns:
+            dict with `batch_size`, `num_threads` and `tokens_per_s`
+        """
+        resources = self.probe.probe()
+        entry_key = f"{self.probe.fingerprint(resources)}|{key}"
+        cached = self._read_cache().get(entry_key)
+        if cached and cached["batch_size"] <= max_batch:
+            logger.info(f"Using cached calibration {cached}")
+            return cached
+
+        probes = list(inputs[:self.num_probes])
+        thread_counts = [resources["torch_threads"]] if on_gpu else thread_candidates(resources)
+        original_threads = torch.get_num_threads()
+
+        try:
+            best = None
+            for num_threads in thread_counts:
+                torch.set_num_threads(num_threads)
+                tokens_per_s = self._time(run, probes, 1, num_threads)
+                if tokens_per_s is None:
+                    raise RuntimeError("Calibration ran out of memory at batch size 1.")
+                if best is None or tokens_per_s > best["tokens_per_s"]:
+                    best = {"batch_size": 1, "num_threads": num_threads, "tokens_per_s": tokens_per_s}
+
+            torch.set_num_threads(best["num_threads"])
+            batch_size = 2
+            while batch_size <= max_batch:
+                tokens_per_s = self._time(run, probes, batch_size, best["num_threads"])
+                # larger batches only get slower once throughput stops growing
+                if tokens_per_s is None or tokens_per_s < best["tokens_per_s"]:
+                    break
+                best.update(batch_size=batch_size, tokens_per_s=tokens_per_s)
+                batch_size *= 2
+        finally:
+            torch.set_num_threads(original_threads)
+
+        best["tokens_per_s"] = round(best["tokens_per_s"], 2)
+        self._write_cache(entry_key, best)
+        return best
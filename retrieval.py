@@ -1,66 +1,867 @@
+import os
+import re
+import json
+import time
 import torch
+import weakref
+import tempfile
 import faiss
+import threading
+import multiprocessing
 import numpy as np
-from typing import List, Mapping, Optional, Union
-from collections import defaultdict
-from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Mapping, Optional, Sequence, Union
+from collections import Counter, OrderedDict, defaultdict
+from transformers import AutoConfig, AutoTokenizer, AutoModel, AutoModelForSequenceClassification
 from transformers.utils import logging
 from semantic_text_splitter import TextSplitter
+from .cache import EmbeddingCache, QueryEmbeddingCache, content_hash
+from .backends import build_encoder_backend
+from .resources import _cpu_count
+from .registry import MODEL_REGISTRY
 
 logger = logging.get_logger(__name__)
 
+FLAT_MAX_NTOTAL = 50_000
+HNSW_MAX_NTOTAL = 1_000_000
+
+
+def _ivf_pq_factory(ntotal: int, ndim: int) -> str:
+    """IVF-PQ factory string sized for `ntotal` vectors of dimension `ndim`."""
+    # ~4*sqrt(N) lists rounded to a power of two, with at least 39 training points per list
+    nlist = 1 << int(round(np.log2(max(4 * np.sqrt(ntotal), 1))))
+    nlist = max(1, min(nlist, ntotal // 39))
+    # largest sub-quantizer count dividing ndim with at least 8 dims per sub-vector
+    m = next((m for m in (64, 48, 32, 24, 16, 8, 4, 2) if ndim % m == 0 and ndim // m >= 8), 1)
+    return f"IVF{nlist},PQ{m}"
+
+
+def select_index_factory(ntotal: int, ndim: int) -> str:
+    """Pick a faiss index factory string for a corpus of `ntotal` vectors.
+
+    Small corpora are searched exactly, medium ones with HNSW, and large ones with IVF-PQ.
+    """
+    if ntotal < FLAT_MAX_NTOTAL:
+        return "Flat"
+    elif ntotal < HNSW_MAX_NTOTAL:
+        return "HNSW32"
+    else:
+        return _ivf_pq_factory(ntotal, ndim)
+
+
+def quantized_factory(index_factory: str, quantize: Optional[str]) -> str:
+    """The factory string storing keys as `quantize` codes.
+
+    "int8" turns flat and HNSW storage into 8-bit scalar codes (IVF-PQ is already smaller), "binary" keeps
+    one sign bit per dimension in an exhaustive Hamming index.
+    """
+    if quantize is None:
+        return index_factory
+    elif quantize == "int8":
+        if index_factory == "Flat":
+            return "SQ8"
+        elif index_factory.startswith("HNSW") and "," not in index_factory:
+            return f"{index_factory},SQ8"
+        return index_factory
+    elif quantize == "binary":
+        return "BFlat"
+    else:
+        raise NotImplementedError(f"Quantization {quantize} not implemented!")
+
+
+def _is_gpu_index(index) -> bool:
+    return hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex)
+
+
+def _remove_spill(file, path):
+    file.close()
+    try:
+        # memory maps of the file stay valid after it is unlinked
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _SpillFile:
+    """Append-only float16 rows in a temporary file, read back through a memory map."""
+    def __init__(self, spill_dir: str, ndim: int) -> None:
+        os.makedirs(spill_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix="rescore-", suffix=".f16", dir=spill_dir)
+        self.file = os.fdopen(fd, "w+b")
+        self.ndim = ndim
+        self.close = weakref.finalize(self, _remove_spill, self.file, self.path)
+
+    def append(self, vectors, batch_rows: int = 65536) -> np.ndarray:
+        """Append `vectors` and return a read-only map of all rows so far."""
+        # in slices, so a memory-mapped source is never read into RAM whole
+        for start in range(0, len(vectors), batch_rows):
+            self.file.write(np.ascontiguousarray(vectors[start:start + batch_rows], dtype=np.float16).tobytes())
+        self.file.flush()
+        rows = self.file.tell() // (2 * self.ndim)
+        if not rows:
+            return np.zeros((0, self.ndim), dtype=np.float16)
+        return np.memmap(self.path, dtype=np.float16, mode="r", shape=(rows, self.ndim))
+
+
 class FaissIndex:
-    def __init__(self, device) -> None:
+    def __init__(
+        self, 
+        device, 
+        nprobe:int=32, 
+        ef_search:int=128, 
+        retrain_growth:float=2.0, 
+        background_retrain:bool=True, 
+        max_train_points:int=256,
+        quantize:Optional[str]=None,
+        rescore_factor:Optional[int]=None,
+        spill_dir:Optional[str]=None) -> None:
+        """
+        Args:
+            nprobe: inverted lists visited per query by IVF indexes
+            ef_search: HNSW search queue size
+            retrain_growth: with `index_factory="auto"`, retrain once the corpus grew by this factor 
+                and its size calls for a different index
+            background_retrain: retrain in a daemon thread; searches and appends keep using the old index meanwhile
+            max_train_points: training vectors sampled per IVF list
+            quantize: None, "int8" or "binary" key storage, see `quantized_factory`. Quantized indexes stay on 
+                CPU and rescore a shortlist with float16 copies of the keys, memory-mapped from disk once saved.
+                Until then the copies are in RAM unless `spill_dir` is set: int8 keys take about 3 bytes per 
+                dimension while building (1 for the code, 2 for the copy), binary keys about 2.1
+            rescore_factor: shortlist `rescore_factor * hits` keys per query for rescoring, by default 4 for
+                int8 and 10 for the coarser binary codes
+            spill_dir: write the float16 copies of the keys to a temporary file here while building, and read
+                them through a memory map, so only the codes stay resident
+        """
         if isinstance(device, torch.device):
             if device.index is None:
                 device = "cpu"
             else:
                 device = device.index
         self.device = device
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.retrain_growth = retrain_growth
+        self.background_retrain = background_retrain
+        self.max_train_points = max_train_points
+        self.quantize = quantize
+        self.rescore_factor = rescore_factor or (10 if quantize == "binary" else 4)
+        self.spill_dir = spill_dir
+
+        self.index = None
+        self.vectors = None
+        self._spill = None
+        self.index_factory = None
+        self.metric = None
+        self.auto = False
+        self._trained_ntotal = 0
+        self._lock = threading.RLock()
+        self._retrain_thread = None
+        self._pending = None
+        self.mmap_path = None
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal if self.index is not None else 0
+
+    def _new_index(self, ndim, index_factory, metric):
+        if index_factory.startswith("B"):
+            return faiss.index_binary_factory(ndim, index_factory)
+        index = faiss.index_factory(ndim, index_factory, metric)
+        # HNSW has no GPU implementation, keep it on CPU
+        if self.device != "cpu" and "HNSW" not in index_factory and self.quantize is None:
+            co = faiss.GpuClonerOptions()
+            co.useFloat16 = True
+            # logger.info("using fp16 on GPU...")
+            index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), self.device, index, co)
+        return index
+
+    def _tune(self, index, index_factory):
+        if "HNSW" in index_factory:
+            index.hnsw.efSearch = self.ef_search
+        elif "IVF" in index_factory:
+            ivf = None if _is_gpu_index(index) else faiss.try_extract_index_ivf(index)
+            if ivf is not None:
+                ivf.nprobe = self.nprobe
+            else:
+                index.nprobe = self.nprobe
+
+    def _train(self, index, index_factory, doc_embeddings):
+        if "IVF" in index_factory:
+            nlist = int(index_factory.split(",")[0][3:])
+            max_points = nlist * self.max_train_points
+            if len(doc_embeddings) > max_points:
+                rng = np.random.default_rng(0)
+                sample = rng.choice(len(doc_embeddings), max_points, replace=False)
+                doc_embeddings = doc_embeddings[np.sort(sample)]
+        index.train(doc_embeddings)
+
+    def _codes(self, embeddings):
+        if self.quantize == "binary":
+            return np.packbits(embeddings > 0, axis=1)
+        return embeddings
+
+    def _create(self, doc_embeddings, index_factory, metric):
+        index = self._new_index(doc_embeddings.shape[1], index_factory, metric)
+        if not index.is_trained:
+            self._train(index, index_factory, doc_embeddings)
+        index.add(self._codes(doc_embeddings))
+        self._tune(index, index_factory)
+        return index
 
     def build(self, doc_embeddings, index_factory, metric):
+        """Build the index from scratch.
+
+        Args:
+            index_factory: a faiss factory string, or "auto" to pick one from the corpus size 
+                (see `select_index_factory`) and retrain as the corpus grows
+        """
         if metric == "l2":
             metric = faiss.METRIC_L2
         elif metric in ["ip", "cos"]:
             metric = faiss.METRIC_INNER_PRODUCT
         else:
             raise NotImplementedError(f"Metric {metric} not implemented!")
-        
-        index = faiss.index_factory(doc_embeddings.shape[1], index_factory, metric)
-        
-        if self.device != "cpu":
-            co = faiss.GpuClonerOptions()
-            co.useFloat16 = True
-            # logger.info("using fp16 on GPU...")
-            index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), self.device, index, co)
 
-        index.train(doc_embeddings)
-        index.add(doc_embeddings)
-        self.index = index
+        self.wait()
+        # an exhaustive binary index never needs a different type
+        self.auto = index_factory == "auto" and self.quantize != "binary"
+        if index_factory == "auto":
+            index_factory = quantized_factory(select_index_factory(*doc_embeddings.shape), self.quantize)
+            logger.info(f"auto-selected index {index_factory} for {len(doc_embeddings)} keys")
+
+        index = self._create(doc_embeddings, index_factory, metric)
+        with self._lock:
+            self.index = index
+            if self.quantize:
+                self._drop_spill()
+                self.vectors = None
+                self._append_vectors(doc_embeddings)
+            self.index_factory = index_factory
+            self.metric = metric
+            self._trained_ntotal = index.ntotal
         return index
-    
+
     def add(self, doc_embeddings):
-        self.index.add(doc_embeddings)
+        """Append keys to the trained index without rebuilding it."""
+        with self._lock:
+            self._make_writable()
+            self.index.add(self._codes(doc_embeddings))
+            if self.quantize:
+                self._append_vectors(doc_embeddings)
+            if self._pending is not None:
+                # a retrain is running on a snapshot, replay these keys on the new index
+                self._pending.append(doc_embeddings)
+                return
+            if not self._needs_retrain():
+                return
+            # keys appended from here on are replayed on the retrained index
+            self._pending = []
+            ntotal = self.ntotal
+            if self.background_retrain:
+                self._retrain_thread = threading.Thread(target=self._retrain, args=(ntotal,), daemon=True)
+                self._retrain_thread.start()
+                return
+        self._retrain(ntotal)
+
+    def _append_vectors(self, doc_embeddings):
+        if self.spill_dir is None:
+            vectors = doc_embeddings.astype(np.float16)
+            # a memory-mapped copy is read into RAM until the next save
+            self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+            return
+        if self._spill is None:
+            self._spill = _SpillFile(self.spill_dir, doc_embeddings.shape[1])
+            if self.vectors is not None:
+                # keys loaded or saved before, copied from their memory map
+                self._spill.append(self.vectors)
+        self.vectors = self._spill.append(doc_embeddings)
+
+    def _drop_spill(self):
+        # searches still holding a map of the file keep reading it after removal
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def _needs_retrain(self):
+        if not self.auto or self.ntotal < self._trained_ntotal * self.retrain_growth:
+            return False
+        return quantized_factory(select_index_factory(self.ntotal, self.index.d), self.quantize) != self.index_factory
+
+    def _reconstruct_all(self):
+        if self.vectors is not None:
+            return np.asarray(self.vectors, dtype=np.float32)
+        index = faiss.index_gpu_to_cpu(self.index) if _is_gpu_index(self.index) else self.index
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # IVF-PQ keys decode to their approximations, which is good enough to retrain on
+            ivf.make_direct_map()
+        return index.reconstruct_n(0, index.ntotal)
+
+    def _snapshot(self, ntotal, block_rows:int=65536):
+        """The first `ntotal` keys, read without holding the lock for longer than one block of keys."""
+        with self._lock:
+            vectors, index = self.vectors, self.index
+            if vectors is None and _is_gpu_index(index):
+                # a CPU copy nothing else modifies
+                vectors = faiss.index_gpu_to_cpu(index).reconstruct_n(0, ntotal)
+            elif vectors is None and faiss.try_extract_index_ivf(index) is not None:
+                # IVF-PQ keys decode to their approximations, which is good enough to retrain on
+                faiss.try_extract_index_ivf(index).make_direct_map()
+        if vectors is not None:
+            # appends replace the array or map instead of growing it in place
+            return np.asarray(vectors[:ntotal], dtype=np.float32)
+        blocks = []
+        for start in range(0, ntotal, block_rows):
+            with self._lock:
+                blocks.append(index.reconstruct_n(start, min(block_rows, ntotal - start)))
+        return np.concatenate(blocks)
+
+    def _retrain(self, ntotal):
+        try:
+            doc_embeddings = self._snapshot(ntotal)
+            index_factory = quantized_factory(select_index_factory(*doc_embeddings.shape), self.quantize)
+            logger.info(f"retraining index as {index_factory} for {len(doc_embeddings)} keys")
+            index = self._create(doc_embeddings, index_factory, self.metric)
+        except Exception as e:
+            logger.error(f"retraining index failed: {e}")
+            with self._lock:
+                self._pending = None
+            return
+        with self._lock:
+            for pending in self._pending:
+                index.add(pending)
+            self.index = index
+            self.index_factory = index_factory
+            self._trained_ntotal = index.ntotal
+            self._pending = None
+
+    def wait(self):
+        """Block until a background retrain, if any, has been swapped in."""
+        thread = self._retrain_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._retrain_thread = None
 
-    def load(self, index_path):
+    def reset(self):
+        """Remove all keys; with `index_factory="auto"` the next append re-selects the index type."""
+        self.wait()
+        with self._lock:
+            self._make_writable()
+            self.index.reset()
+            if self.vectors is not None:
+                self._drop_spill()
+                self.vectors = np.zeros((0, self.vectors.shape[1]), dtype=np.float16)
+            self._trained_ntotal = 0
+
+    def _make_writable(self):
+        # memory-mapped indexes are read-only views, faiss aborts on resizing them
+        if self.mmap_path is not None:
+            logger.info(f"reading {self.mmap_path} into memory to modify it...")
+            self.index = faiss.read_index(self.mmap_path)
+            self._tune(self.index, self.index_factory or "")
+            self.mmap_path = None
+
+    def load(self, index_path, mmap:bool=False):
+        """Load a saved index.
+
+        Args:
+            mmap: map the index file read-only instead of copying it into RAM (CPU only), so that processes
+                loading the same store share its pages. The index is read into RAM on the first modification.
+        """
         # logger.info(f"loading index from {index_path}...")
-        index = faiss.read_index(index_path)
-        if self.device != "cpu":
+        self.wait()
+        index_factory, metric = None, None
+        if os.path.exists(f"{index_path}.json"):
+            with open(f"{index_path}.json") as f:
+                meta = json.load(f)
+            index_factory, metric = meta["index_factory"], meta["metric"]
+            self.quantize, self.rescore_factor = meta["quantize"], meta["rescore_factor"]
+            # indexes saved before these were recorded keep their type
+            auto, trained_ntotal = meta.get("auto", False), meta.get("trained_ntotal")
+            self.retrain_growth = meta.get("retrain_growth", self.retrain_growth)
+        else:
+            auto, trained_ntotal = False, None
+
+        mmap = mmap and self.device == "cpu"
+        if self.quantize == "binary":
+            index = faiss.read_index_binary(index_path)
+            mmap = False
+        elif mmap:
+            io_flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+            index = faiss.read_index(index_path, io_flags)
+        else:
+            index = faiss.read_index(index_path)
+        if self.device != "cpu" and self.quantize is None:
             co = faiss.GpuClonerOptions()
             co.useFloat16 = True
             index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), self.device, index, co)
-        self.index = index
+        with self._lock:
+            self.index = index
+            self.index_factory = index_factory
+            self.metric = metric if metric is not None else getattr(index, "metric_type", None)
+            self.auto = auto
+            self._trained_ntotal = index.ntotal if trained_ntotal is None else trained_ntotal
+            self.mmap_path = index_path if mmap else None
+            self._drop_spill()
+            self.vectors = np.load(f"{index_path}.vectors.npy", mmap_mode="r") if self.quantize else None
 
     def save(self, index_path):
         logger.info(f"saving index at {index_path}...")
-        if isinstance(self.index, faiss.GpuIndex):
-            index = faiss.index_gpu_to_cpu(self.index)
-        else:
-            index = self.index
-        faiss.write_index(index, index_path)
+        self.wait()
+        with self._lock:
+            if _is_gpu_index(self.index):
+                index = faiss.index_gpu_to_cpu(self.index)
+            else:
+                index = self.index
+            if self.quantize == "binary":
+                faiss.write_index_binary(index, index_path)
+            else:
+                faiss.write_index(index, index_path)
+            if self.quantize:
+                # saved atomically, a memory map of the previous file may still be in use
+                tmp_path = f"{index_path}.vectors.tmp.npy"
+                np.save(tmp_path, np.ascontiguousarray(self.vectors))
+                os.replace(tmp_path, f"{index_path}.vectors.npy")
+                self.vectors = np.load(f"{index_path}.vectors.npy", mmap_mode="r")
+                self._drop_spill()
+            if os.path.exists(f"{index_path}.shards.json"):
+                # a sharded index saved here before would shadow this one on load
+                os.remove(f"{index_path}.shards.json")
+            with open(f"{index_path}.json", "w") as f:
+                json.dump({
+                    "index_factory": self.index_factory, 
+                    "metric": self.metric,
+                    "quantize": self.quantize, 
+                    "rescore_factor": self.rescore_factor,
+                    "auto": self.auto,
+                    "trained_ntotal": self._trained_ntotal,
+                    "retrain_growth": self.retrain_growth}, f)
 
     def search(self, query, hits):
-        return self.index.search(query, k=hits)
+        with self._lock:
+            if not self.quantize:
+                return self.index.search(query, k=hits)
+            _, shortlist = self.index.search(self._codes(query), k=hits * self.rescore_factor)
+            vectors = self.vectors
+        return self._rescore(query, shortlist, hits, vectors)
+
+    def _rescore(self, query, shortlist, hits, vectors):
+        l2 = self.metric == faiss.METRIC_L2
+        scores = np.full((len(query), hits), np.inf if l2 else -np.inf, dtype=np.float32)
+        indices = np.full((len(query), hits), -1, dtype=np.int64)
+        for i, candidates in enumerate(shortlist):
+            candidates = np.sort(candidates[candidates >= 0])
+            # sorted ids read the memory-mapped keys in file order
+            keys = np.asarray(vectors[candidates], dtype=np.float32)
+            if l2:
+                candidate_scores = ((keys - query[i]) ** 2).sum(axis=1)
+                order = np.argsort(candidate_scores, kind="stable")[:hits]
+            else:
+                candidate_scores = keys @ query[i]
+                order = np.argsort(-candidate_scores, kind="stable")[:hits]
+            scores[i, :len(order)] = candidate_scores[order]
+            indices[i, :len(order)] = candidates[order]
+        return scores, indices
+
+    def _index_bytes(self):
+        with self._lock:
+            index = faiss.index_gpu_to_cpu(self.index) if _is_gpu_index(self.index) else self.index
+            if self.quantize == "binary":
+                return faiss.serialize_index_binary(index).nbytes
+            return faiss.serialize_index(index).nbytes
+
+    def stats(self, num_queries:int=100, hits:int=10) -> Dict:
+        """Key storage size and recall@`hits` against exact float search, with `num_queries` sampled keys
+        as queries."""
+        index_bytes = self._index_bytes()
+        keys = self._reconstruct_all() if self.ntotal else np.zeros((0, 0), dtype=np.float32)
+        hits = max(1, min(hits, self.ntotal))
+        return {
+            "index_factory": self.index_factory,
+            "quantize": self.quantize,
+            "ntotal": self.ntotal,
+            "index_mb": index_bytes / 1024 ** 2,
+            "float32_mb": keys.size * 4 / 1024 ** 2,
+            "rescore_mb": self.vectors.nbytes / 1024 ** 2 if self.vectors is not None else 0.0,
+            "recall_at": hits,
+            "recall": _recall(self.search, keys, self.metric, num_queries, hits),
+        }
+
+
+def _recall(search, keys: np.ndarray, metric, num_queries: int, hits: int) -> Optional[float]:
+    """Recall@`hits` of `search` against exact float search over `keys`, with sampled keys as queries."""
+    if not len(keys):
+        return None
+    rng = np.random.default_rng(0)
+    queries = keys[rng.choice(len(keys), min(num_queries, len(keys)), replace=False)]
+    exact = faiss.IndexFlatL2(keys.shape[1]) if metric == faiss.METRIC_L2 else faiss.IndexFlatIP(keys.shape[1])
+    exact.add(keys)
+    _, truth = exact.search(queries, hits)
+    _, found = search(queries, hits)
+    return float(np.mean([len(set(f) & set(t)) / hits for f, t in zip(found.tolist(), truth.tolist())]))
+
+
+# the shard served by a `ShardedFaissIndex` worker process
+_worker_shard = None
+
+
+def _init_shard_worker(index_path: str, num_threads: int, kwargs: Dict):
+    global _worker_shard
+    faiss.omp_set_num_threads(num_threads)
+    _worker_shard = FaissIndex("cpu", **kwargs)
+    _worker_shard.load(index_path, mmap=True)
+
+
+def _search_shard_worker(query: np.ndarray, hits: int):
+    return _worker_shard.search(query, hits)
+
+
+class ShardedFaissIndex:
+    """Splits the keys over `num_shards` `FaissIndex` shards, searched in parallel and merged into one top-k.
+
+    Key `i` lives in shard `i % num_shards`, so appends stay balanced and global ids need no lookup table.
+    Each shard picks its own index type for its size with `index_factory="auto"`, and shards are built in 
+    parallel threads (faiss releases the GIL while training and adding).
+
+    Args:
+        num_shards: shard count, e.g. the number of physical cores
+        executor: "thread" searches the shards from a thread pool, which parallelizes single queries that 
+            faiss runs on one core. "process" gives every shard its own worker process (CPU only), which
+            also parallelizes the Python rescoring of quantized keys. Worker processes serve the index as 
+            last saved or loaded, memory-mapping the shard files; searches after an in-memory modification 
+            run in threads until the next save.
+        kwargs: passed to every shard, see `FaissIndex`
+    """
+    def __init__(self, device, num_shards:int, executor:str="thread", **kwargs) -> None:
+        if executor not in ("thread", "process"):
+            raise NotImplementedError(f"Shard executor {executor} not implemented!")
+        self.device = device
+        self.num_shards = num_shards
+        self.executor = executor
+        self._shard_kwargs = kwargs
+        self.shards = [FaissIndex(device, **kwargs) for _ in range(num_shards)]
+        self._lock = threading.RLock()
+        self._threads = ThreadPoolExecutor(num_shards, thread_name_prefix="faiss-shard")
+        self._processes = None
+        # shard files the worker processes may serve
+        self._served_path = None
+
+    @property
+    def ntotal(self):
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def metric(self):
+        return self.shards[0].metric
+
+    @property
+    def quantize(self):
+        return self.shards[0].quantize
+
+    def _map(self, fn, *iterables):
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(self.num_shards, thread_name_prefix="faiss-shard")
+            threads = self._threads
+        return list(threads.map(fn, *iterables))
+
+    def _split(self, doc_embeddings, offset):
+        # global id offset + k goes to shard (offset + k) % num_shards
+        return [
+            np.ascontiguousarray(doc_embeddings[(shard - offset) % self.num_shards::self.num_shards])
+            for shard in range(self.num_shards)]
+
+    def _modified(self):
+        self._served_path = None
+        self._stop_processes()
+
+    def build(self, doc_embeddings, index_factory, metric):
+        """Build all shards from scratch, in parallel. See `FaissIndex.build`."""
+        with self._lock:
+            self._modified()
+            self._map(lambda shard, keys: shard.build(keys, index_factory, metric), self.shards, self._split(doc_embeddings, 0))
+
+    def add(self, doc_embeddings):
+        with self._lock:
+            self._modified()
+            parts = self._split(doc_embeddings, self.ntotal)
+            for shard, keys in zip(self.shards, parts):
+                if len(keys):
+                    shard.add(keys)
+
+    def wait(self):
+        for shard in self.shards:
+            shard.wait()
+
+    def reset(self):
+        with self._lock:
+            self._modified()
+            for shard in self.shards:
+                shard.reset()
+
+    def _shard_path(self, index_path, shard):
+        return f"{index_path}.shard{shard}"
+
+    def save(self, index_path):
+        with self._lock:
+            self._map(lambda i: self.shards[i].save(self._shard_path(index_path, i)), range(self.num_shards))
+            with open(f"{index_path}.shards.json", "w") as f:
+                json.dump({"num_shards": self.num_shards}, f)
+            self._stop_processes()
+            self._served_path = index_path
+
+    def load(self, index_path, mmap:bool=False):
+        """Load shards saved by `save`; the shard count is read from the saved index."""
+        with open(f"{index_path}.shards.json") as f:
+            num_shards = json.load(f)["num_shards"]
+        with self._lock:
+            self._stop_processes()
+            if num_shards != self.num_shards:
+                self.shards = [FaissIndex(self.device, **self._shard_kwargs) for _ in range(num_shards)]
+                self.num_shards = num_shards
+                self._close_threads()
+            self._map(lambda i: self.shards[i].load(self._shard_path(index_path, i), mmap=mmap), range(num_shards))
+            self._served_path = index_path
+
+    def _start_processes(self):
+        context = multiprocessing.get_context("spawn")
+        num_threads = max(1, _cpu_count() // self.num_shards)
+        self._processes = [
+            ProcessPoolExecutor(
+                1, mp_context=context, initializer=_init_shard_worker, 
+                initargs=(self._shard_path(self._served_path, i), num_threads, self._shard_kwargs))
+            for i in range(self.num_shards)]
+
+    def _stop_processes(self):
+        if self._processes is not None:
+            for pool in self._processes:
+                pool.shutdown(wait=False, cancel_futures=True)
+            self._processes = None
+
+    def search(self, query, hits):
+        futures = None
+        with self._lock:
+            if self.executor == "process" and self._served_path is not None:
+                if self._processes is None:
+                    self._start_processes()
+                futures = [pool.submit(_search_shard_worker, query, hits) for pool in self._processes]
+        # concurrent searches overlap, only dispatch holds the lock
+        if futures is not None:
+            results = [future.result() for future in futures]
+        else:
+            results = self._map(lambda shard: shard.search(query, hits), self.shards)
+        return self._merge(results, hits)
+
+    def _merge(self, results, hits):
+        scores = np.concatenate([shard_scores for shard_scores, _ in results], axis=1)
+        indices = np.concatenate([
+            np.where(shard_indices >= 0, shard_indices * self.num_shards + shard, -1)
+            for shard, (_, shard_indices) in enumerate(results)], axis=1)
+        # best first, empty slots last
+        keys = np.where(indices >= 0, scores if self.metric == faiss.METRIC_L2 else -scores, np.inf)
+        order = np.argsort(keys, axis=1, kind="stable")[:, :hits]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def _reconstruct_all(self):
+        shard_keys = [shard._reconstruct_all() for shard in self.shards]
+        keys = np.zeros((self.ntotal, shard_keys[0].shape[1]), dtype=np.float32)
+        for shard, part in enumerate(shard_keys):
+            keys[shard::self.num_shards] = part
+        return keys
+
+    def stats(self, num_queries:int=100, hits:int=10) -> Dict:
+        """`FaissIndex.stats` summed over shards, with recall of the merged search."""
+        keys = self._reconstruct_all() if self.ntotal else np.zeros((0, 0), dtype=np.float32)
+        hits = max(1, min(hits, self.ntotal))
+        factories = sorted({str(shard.index_factory) for shard in self.shards})
+        return {
+            "index_factory": f"{self.num_shards} shards of {'/'.join(factories)}",
+            "quantize": self.quantize,
+            "ntotal": self.ntotal,
+            "index_mb": sum(shard._index_bytes() for shard in self.shards) / 1024 ** 2,
+            "float32_mb": keys.size * 4 / 1024 ** 2,
+            "rescore_mb": sum(shard.vectors.nbytes for shard in self.shards if shard.vectors is not None) / 1024 ** 2,
+            "recall_at": hits,
+            "recall": _recall(self.search, keys, self.metric, num_queries, hits),
+        }
+
+    def _close_threads(self):
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def close(self):
+        """Stop the worker threads and processes."""
+        self._stop_processes()
+        self._close_threads()
+
+
+def load_index(index_path: str, device, mmap:bool=False, executor:str="thread", **kwargs):
+    """Load a `FaissIndex` or, when `index_path` was saved sharded, a `ShardedFaissIndex`.
+
+    Args:
+        kwargs: passed to every `FaissIndex`, e.g. `spill_dir`
+    """
+    if os.path.exists(f"{index_path}.shards.json"):
+        index = ShardedFaissIndex(device, 1, executor=executor, **kwargs)
+    else:
+        index = FaissIndex(device, **kwargs)
+    index.load(index_path, mmap=mmap)
+    return index
+
+
+def fuse_rankings(scores: np.ndarray, indices: np.ndarray, fusion:str="rrf", rrf_k:int=60):
+    """Merge the top-k lists of several queries into one ranking.
+
+    Args:
+        scores, indices: [num_queries, hits] faiss search results, -1 marks empty slots
+        fusion: "rrf" sums reciprocal ranks 1 / (rrf_k + rank), "max" keeps the best score of each key
+
+    Returns:
+        key indices and their fused scores, best first
+    """
+    fused = defaultdict(float) if fusion == "rrf" else {}
+    for row_scores, row_indices in zip(scores.tolist(), indices.tolist()):
+        for rank, (score, index) in enumerate(zip(row_scores, row_indices)):
+            if index < 0:
+                continue
+            if fusion == "rrf":
+                fused[index] += 1.0 / (rrf_k + rank + 1)
+            elif fusion == "max":
+                fused[index] = max(fused.get(index, -np.inf), score)
+            else:
+                raise NotImplementedError(f"Fusion {fusion} not implemented!")
+    ranked = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return [index for index, _ in ranked], [score for _, score in ranked]
+
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TERM_PATTERN = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+_CJK_PATTERN = re.compile(f"[{_CJK}]")
+
+
+def bm25_terms(text: str) -> List[str]:
+    """Lowercased word terms; runs of CJK characters, which have no spaces, become character bigrams."""
+    terms = []
+    for run in _TERM_PATTERN.findall(text.lower()):
+        if _CJK_PATTERN.match(run) and len(run) > 1:
+            terms.extend(run[i: i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+class BM25Index:
+    """Inverted index scoring chunks by BM25, for exact terms (names, tickers, dates) dense keys blur.
+
+    Every `add` appends an immutable segment of postings in CSR layout (term id -> doc ids, term frequencies),
+    so appends never rewrite existing postings; `save` merges the segments.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.reset()
+
+    @property
+    def ntotal(self):
+        return len(self.doc_lens)
+
+    def reset(self):
+        self.vocab: Dict[str, int] = {}
+        self.doc_lens = np.zeros(0, dtype=np.int32)
+        self._segments = []
+
+    def _segment(self, term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray):
+        order = np.lexsort((doc_ids, term_ids))
+        offsets = np.searchsorted(term_ids[order], np.arange(len(self.vocab) + 1)).astype(np.int64)
+        return offsets, doc_ids[order].astype(np.int32), tfs[order].astype(np.int32)
+
+    def add(self, docs: List[str]):
+        term_ids, doc_ids, tfs, doc_lens = [], [], [], []
+        for doc_id, doc in enumerate(docs, start=self.ntotal):
+            terms = bm25_terms(doc)
+            doc_lens.append(len(terms))
+            for term, tf in Counter(terms).items():
+                term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        self._segments.append(self._segment(np.array(term_ids, dtype=np.int64), np.array(doc_ids), np.array(tfs)))
+        self.doc_lens = np.concatenate([self.doc_lens, np.array(doc_lens, dtype=np.int32)])
+
+    def _postings(self, term_id: int):
+        doc_ids, tfs = [], []
+        for offsets, segment_doc_ids, segment_tfs in self._segments:
+            # segments only know the terms seen up to their creation
+            if term_id + 1 < len(offsets):
+                start, end = offsets[term_id], offsets[term_id + 1]
+                doc_ids.append(segment_doc_ids[start:end])
+                tfs.append(segment_tfs[start:end])
+        if not doc_ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        return np.concatenate(doc_ids), np.concatenate(tfs)
+
+    def search(self, queries: Union[str, List[str]], hits: int):
+        """Same layout as faiss results.
+
+        Returns:
+            scores, indices: [num_queries, hits], -1 marks empty slots
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        scores = np.zeros((len(queries), hits), dtype=np.float32)
+        indices = np.full((len(queries), hits), -1, dtype=np.int64)
+        if self.ntotal == 0:
+            return scores, indices
+
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lens / max(self.doc_lens.mean(), 1e-6))
+        for i, query in enumerate(queries):
+            doc_scores = np.zeros(self.ntotal, dtype=np.float32)
+            for term in set(bm25_terms(query)):
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    continue
+                doc_ids, tfs = self._postings(term_id)
+                idf = np.log(1 + (self.ntotal - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+                doc_scores[doc_ids] += idf * tfs * (self.k1 + 1) / (tfs + norm[doc_ids])
+            matched = np.flatnonzero(doc_scores)
+            top = matched[np.argsort(-doc_scores[matched], kind="stable")[:hits]]
+            scores[i, :len(top)] = doc_scores[top]
+            indices[i, :len(top)] = top
+        return scores, indices
+
+    def save(self, index_path: str):
+        if len(self._segments) > 1:
+            term_ids, doc_ids, tfs = [], [], []
+            for offsets, segment_doc_ids, segment_tfs in self._segments:
+                term_ids.append(np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)))
+                doc_ids.append(segment_doc_ids)
+                tfs.append(segment_tfs)
+            self._segments = [self._segment(np.concatenate(term_ids), np.concatenate(doc_ids), np.concatenate(tfs))]
+        offsets, doc_ids, tfs = self._segments[0] if self._segments else self._segment(*[np.zeros(0, dtype=np.int64)] * 3)
+        # terms never contain newlines
+        vocab = np.frombuffer("\n".join(self.vocab).encode("utf-8"), dtype=np.uint8)
+        with open(index_path, "wb") as f:
+            np.savez(f, vocab=vocab, doc_lens=self.doc_lens, offsets=offsets, doc_ids=doc_ids, tfs=tfs, 
+                     params=np.array([self.k1, self.b]))
+
+    def load(self, index_path: str):
+        with np.load(index_path) as data:
+            vocab = data["vocab"].tobytes().decode("utf-8")
+            self.vocab = {term: i for i, term in enumerate(vocab.split("\n"))} if vocab else {}
+            self.doc_lens = data["doc_lens"]
+            self._segments = [(data["offsets"], data["doc_ids"], data["tfs"])]
+            self.k1, self.b = data["params"].tolist()
+
+
+def load_sparse_index(index_path: str, docs: Sequence[str]) -> BM25Index:
+    """Load a saved `BM25Index`, or build it from `docs` for stores saved without one."""
+    index = BM25Index()
+    if os.path.exists(index_path):
+        index.load(index_path)
+    else:
+        logger.info(f"{index_path} not found, building the sparse index from {len(docs)} chunks...")
+        index.add(list(docs))
+    return index
 
 
 class DenseRetriever:
@@ -76,7 +877,34 @@ class DenseRetriever:
         cache_dir:Optional[str]=None, 
         query_instruct:str=None, 
         doc_instruct:str=None,
-        load_in_4bit:bool=False) -> None:
+        load_in_4bit:bool=False,
+        embedding_cache_dir:Optional[str]=None,
+        sparse:bool=True,
+        index_quantization:Optional[str]=None,
+        index_spill_dir:Optional[str]=None,
+        encoder_backend:str="eager",
+        backend_dir:Optional[str]=None,
+        query_cache_size:int=4096,
+        query_cache_bytes:Optional[int]=64 * 1024 ** 2,
+        query_cache_ttl:Optional[float]=3600.0,
+        num_shards:int=1,
+        shard_executor:str="thread") -> None:
+        """
+        Args:
+            embedding_cache_dir: persist key embeddings here by chunk content hash, so that re-adding 
+                unchanged chunks skips the encoder
+            sparse: also keep a BM25 index of the keys, for hybrid and sparse-only search
+            index_quantization: None, "int8" or "binary" storage of the keys in faiss, see `FaissIndex`
+            index_spill_dir: keep the float16 rescoring copies of quantized keys in a temporary file here
+                instead of RAM until the index is saved, see `FaissIndex(spill_dir=...)`
+            encoder_backend: "eager", "compile" or "onnx", see `build_encoder_backend`; the latter two run 
+                in float32 on CPU, where half precision is slow
+            backend_dir: where the onnx backend caches its export
+            query_cache_size, query_cache_bytes, query_cache_ttl: bounds of the in-memory LRU of query 
+                embeddings (entries, bytes, seconds), see `QueryEmbeddingCache`; 0 entries disables it
+            num_shards, shard_executor: split the keys over this many faiss indexes searched in parallel 
+                threads or processes, see `ShardedFaissIndex`
+        """
         self.name = encoder
         self.query_instruct = query_instruct
         self.doc_instruct = doc_instruct
@@ -86,8 +914,20 @@ class DenseRetriever:
         self.query_max_length = query_max_length
         self.key_max_length = key_max_length
         self.hits = hits
-        logger.info(f"Loading tokenizer and model from {encoder}...")
-
+        cache_namespace = {
+            "encoder": encoder,
+            "pooling_method": pooling_method,
+            "dense_metric": dense_metric,
+            "key_max_length": key_max_length,
+            "dtype": dtype,
+            "doc_instruct": doc_instruct,
+        }
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if encoder_backend != "eager":
+            # key embeddings differ slightly between backends
+            cache_namespace["encoder_backend"] = encoder_backend
+            if device == "cpu":
+                dtype = cache_namespace["dtype"] = "fp32"
         if dtype == "bf16":
             dtype = torch.bfloat16
         elif dtype == "fp16":
@@ -95,21 +935,65 @@ class DenseRetriever:
         else:
             dtype = torch.float32
 
-        self.tokenizer = AutoTokenizer.from_pretrained(encoder, cache_dir=cache_dir)
-        self.encoder = AutoModel.from_pretrained(encoder, cache_dir=cache_dir, torch_dtype=dtype, device_map={'': "cuda"}, load_in_4bit=load_in_4bit).eval()
+        def load_encoder():
+            logger.info(f"Loading tokenizer and model from {encoder}...")
+            tokenizer = AutoTokenizer.from_pretrained(encoder, cache_dir=cache_dir)
+            model = AutoModel.from_pretrained(encoder, cache_dir=cache_dir, torch_dtype=dtype, device_map={'': device}, load_in_4bit=load_in_4bit).eval()
+            forward = build_encoder_backend(model, encoder_backend, encoder, tokenizer.model_input_names, backend_dir)
+            return tokenizer, model, forward
+
+        # loaded on first use and shared with every retriever of the same encoder, see `ModelRegistry`
+        self.encoder_backend = encoder_backend
+        self._encoder_key = ("encoder", encoder, str(dtype), "4bit" if load_in_4bit else None, device, encoder_backend, backend_dir)
+        self._load_encoder = load_encoder
+        self._loaded_encoder = None
+        self._load_lock = threading.Lock()
+        self._device = torch.device("cuda:0" if device == "cuda" else device)
 
-        self.ndim = self.encoder.config.hidden_size
+        self.ndim = AutoConfig.from_pretrained(encoder, cache_dir=cache_dir).hidden_size
         self._index = None
-        self.docs = []
+        self.sparse = sparse
+        self.index_quantization = index_quantization
+        self.index_spill_dir = index_spill_dir
+        self.num_shards = num_shards
+        self.shard_executor = shard_executor
+        self.sparse_index = None
+
+        self.query_cache = None
+        if query_cache_size:
+            self.query_cache = QueryEmbeddingCache(query_cache_size, query_cache_bytes, query_cache_ttl)
+
+        self.embedding_cache = None
+        if embedding_cache_dir:
+            self.embedding_cache = EmbeddingCache(embedding_cache_dir, cache_namespace, self.ndim)
+
+    def _encoder_parts(self):
+        if self._loaded_encoder is None:
+            with self._load_lock:
+                if self._loaded_encoder is None:
+                    self._loaded_encoder = MODEL_REGISTRY.acquire(self._encoder_key, self._load_encoder, owner=self)
+        return self._loaded_encoder
+
+    @property
+    def tokenizer(self):
+        return self._encoder_parts()[0]
+
+    @property
+    def encoder(self):
+        return self._encoder_parts()[1]
+
+    @property
+    def _forward(self):
+        return self._encoder_parts()[2]
 
     @property
     def device(self):
-        return self.encoder.device
+        return self._device
 
     @property
     def num_keys(self):
         if self._index is not None:
-            return self._index.index.ntotal
+            return self._index.ntotal
         else:
             return 0
 
@@ -163,46 +1047,133 @@ class DenseRetriever:
             Tensor: [batch_size, d_embed]
         """
         inputs = self._prepare(inputs, field=field)
-        encoder = self.encoder
 
-        embeddings = encoder(**inputs).last_hidden_state    # B, L, D
+        embeddings = self._forward(**inputs).to(self.device)    # B, L, D
         embedding = self._pool(embeddings, inputs["attention_mask"])
         if self.dense_metric == "cos":
             embedding = torch.nn.functional.normalize(embedding, p=2, dim=1)
         return embedding
 
+    @torch.no_grad()
+    def encode_queries(self, queries: Union[str, List[str]]) -> np.ndarray:
+        """Query embeddings as contiguous float32 rows; cached queries skip the encoder.
+
+        Returns:
+            [len(queries), d_embed]
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        if self.query_cache is None:
+            return self.encode(queries, field="query").float().cpu().numpy().astype(np.float32, order="C")
+
+        keys = [self.query_cache.key(query, self.query_instruct) for query in queries]
+        embeddings = [self.query_cache.get(key) for key in keys]
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                # queries normalizing to the same key are encoded once
+                missing.setdefault(keys[i], i)
+        if missing:
+            encoded = self.encode([queries[i] for i in missing.values()], field="query").float().cpu().numpy()
+            encoded = dict(zip(missing, encoded))
+            for key, embedding in encoded.items():
+                self.query_cache.put(key, embedding)
+            embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        return np.stack(embeddings).astype(np.float32, order="C")
+
     def remove_all(self):
         """Remove all keys from the index."""
         if self._index is not None:
-            self._index.index.reset()
-        self.docs = []
+            self._index.reset()
+        if self.sparse_index is not None:
+            self.sparse_index.reset()
+
+    def _length_buckets(self, docs: List[str], batch_size:int, max_tokens:Optional[int]=None):
+        """Group `docs` into batches of similar token length.
+
+        Docs are sorted by length, longest first, and packed until either `batch_size` docs or `max_tokens` 
+        padded tokens are reached, so little compute goes into padding.
+
+        Yields:
+            positions of the batch members in `docs`, padded tokenizer outputs
+        """
+        if max_tokens is None:
+            max_tokens = batch_size * self.key_max_length
+        tokenized = self.tokenizer(docs, padding=False, truncation=True, max_length=self.key_max_length)
+        lengths = [len(input_ids) for input_ids in tokenized["input_ids"]]
+        order = sorted(range(len(docs)), key=lambda i: lengths[i], reverse=True)
+
+        def pad(positions):
+            features = [{k: tokenized[k][i] for k in tokenized.keys()} for i in positions]
+            return self.tokenizer.pad(features, return_tensors="pt")
+
+        batch = []
+        for i in order:
+            # the first member is the longest, so it fixes the padded length of the batch
+            if batch and (len(batch) >= batch_size or (len(batch) + 1) * lengths[batch[0]] > max_tokens):
+                yield batch, pad(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch, pad(batch)
 
     @torch.no_grad()
-    def add(self, docs: List[str], index_factory:str="Flat", batch_size=500):
-        """Build faiss index.
+    def encode_keys(self, docs: List[str], batch_size:int=500, max_tokens:Optional[int]=None, use_cache:bool=True) -> np.ndarray:
+        """Encode `docs` into a float32 matrix in input order.
+
+        Args:
+            batch_size: max docs per forward pass
+            max_tokens: max padded tokens per forward pass, defaults to `batch_size * key_max_length`
+            use_cache: reuse and fill `embedding_cache` when it is enabled
+        """
+        embedding_cache = self.embedding_cache if use_cache else None
+        if embedding_cache is not None:
+            doc_embeddings, missing = embedding_cache.get(docs)
+            if len(missing) < len(docs):
+                logger.info(f"reusing {len(docs) - len(missing)} cached key embeddings")
+        else:
+            doc_embeddings = np.zeros((len(docs), self.ndim), dtype=np.float32)
+            missing = list(range(len(docs)))
+        if not missing:
+            return doc_embeddings
+
+        missing_docs = [docs[i] for i in missing]
+        for positions, inputs in self._length_buckets(missing_docs, batch_size, max_tokens):
+            embeddings = self.encode(inputs).float().cpu().numpy()    # batch_size, ndim
+            doc_embeddings[[missing[i] for i in positions]] = embeddings
+            if embedding_cache is not None:
+                embedding_cache.put([missing_docs[i] for i in positions], embeddings)
+        return doc_embeddings
+
+    @torch.no_grad()
+    def add(self, docs: List[str], index_factory:str="auto", batch_size=500, max_tokens:Optional[int]=None):
+        """Build faiss index, or append to it if one exists.
         
         Args:
-            shard_across_devices: split the corpus onto all devices and encode them
+            index_factory: faiss factory string, "auto" picks Flat/HNSW/IVF-PQ by corpus size
+            max_tokens: padded token budget per encoder batch, see `encode_keys`
         """
         if len(docs) == 0:
             return
 
         metric = self.dense_metric
-        doc_embeddings = np.zeros((len(docs), self.ndim), dtype=np.float32)
-
-        for i in range(0, len(docs), batch_size):
-            batch_docs = docs[i: i + batch_size]
-            embeddings = self.encode(batch_docs)    # batch_size, ndim
-            doc_embeddings[i: i + batch_size] = embeddings.cpu().numpy()
+        doc_embeddings = self.encode_keys(docs, batch_size=batch_size, max_tokens=max_tokens)
 
         if self._index is None:
-            index = FaissIndex(self.device)
+            if self.num_shards > 1:
+                index = ShardedFaissIndex(
+                    self.device, self.num_shards, executor=self.shard_executor, 
+                    quantize=self.index_quantization, spill_dir=self.index_spill_dir)
+            else:
+                index = FaissIndex(self.device, quantize=self.index_quantization, spill_dir=self.index_spill_dir)
             index.build(doc_embeddings, index_factory, metric)
             self._index = index
         else:
             self._index.add(doc_embeddings)
-
-        self.docs.extend(docs)
+        if self.sparse:
+            if self.sparse_index is None:
+                self.sparse_index = BM25Index()
+            self.sparse_index.add(docs)
 
     @torch.no_grad()
     def search(self, queries: Union[str, List[str]], hits:Optional[int]=None):
@@ -211,7 +1182,200 @@ class DenseRetriever:
     
         assert self._index is not None, "Make sure there is an indexed corpus!"
 
-        embeddings = self.encode(queries, field="query").cpu().numpy().astype(np.float32, order="C")
+        embeddings = self.encode_queries(queries)
         scores, indices = self._index.search(embeddings, hits)
         return scores, indices
 
+    @torch.no_grad()
+    def multi_search(
+        self, 
+        queries: List[str], 
+        hits:Optional[int]=None, 
+        fusion:str="rrf", 
+        dedup_threshold:Optional[float]=0.95, 
+        top_n:Optional[int]=None,
+        mode:str="dense"):
+        """Search many overlapping queries at once and fuse their hits.
+
+        Exact duplicates (up to case and whitespace) are dropped before searching. In dense search, queries 
+        whose embedding has cosine similarity >= `dedup_threshold` with an earlier query are dropped too, 
+        and the rest go through faiss as one batch.
+
+        Args:
+            fusion: see `fuse_rankings`
+            top_n: keep at most this many keys after fusion
+            mode: "dense", "sparse" (BM25 only, no encoder pass) or "hybrid" (both, merged by reciprocal rank)
+
+        Returns:
+            key indices and their fused scores, best first
+        """
+        if hits is None:
+            hits = self.hits
+
+        unique_queries, seen = [], set()
+        for query in queries:
+            normalized = " ".join(query.lower().split())
+            if normalized and normalized not in seen:
+                seen.add(normalized)
+                unique_queries.append(query)
+        if not unique_queries:
+            return [], []
+
+        if mode == "dense":
+            indices, scores = self._dense_search(unique_queries, hits, fusion, dedup_threshold)
+        elif mode == "sparse":
+            indices, scores = self._sparse_search(unique_queries, hits, fusion)
+        elif mode == "hybrid":
+            dense_indices, _ = self._dense_search(unique_queries, hits, fusion, dedup_threshold)
+            sparse_indices, _ = self._sparse_search(unique_queries, hits, fusion)
+            # dense and BM25 scores are not comparable, merge the two rankings by rank
+            rankings = np.full((2, max(len(dense_indices), len(sparse_indices))), -1, dtype=np.int64)
+            rankings[0, :len(dense_indices)] = dense_indices
+            rankings[1, :len(sparse_indices)] = sparse_indices
+            indices, scores = fuse_rankings(np.zeros(rankings.shape, dtype=np.float32), rankings, fusion="rrf")
+        else:
+            raise NotImplementedError(f"Search mode {mode} not implemented!")
+
+        if top_n is not None:
+            indices, scores = indices[:top_n], scores[:top_n]
+        return indices, scores
+
+    def _dense_search(self, queries: List[str], hits: int, fusion: str, dedup_threshold: Optional[float]):
+        assert self._index is not None, "Make sure there is an indexed corpus!"
+
+        embeddings = self.encode_queries(queries)
+
+        if dedup_threshold is not None and len(embeddings) > 1:
+            normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+            similarity = normalized @ normalized.T
+            keep = []
+            for i in range(len(normalized)):
+                if not keep or similarity[i, keep].max() < dedup_threshold:
+                    keep.append(i)
+            embeddings = embeddings[keep]
+
+        scores, indices = self._index.search(embeddings, hits)
+        return fuse_rankings(scores, indices, fusion=fusion)
+
+    def _sparse_search(self, queries: List[str], hits: int, fusion: str):
+        assert self.sparse_index is not None, "Make sure there is a sparse index!"
+        scores, indices = self.sparse_index.search(queries, hits)
+        return fuse_rankings(scores, indices, fusion=fusion)
+
+
+class CrossEncoderReranker:
+    def __init__(
+        self, 
+        model_name_or_path:str="BAAI/bge-reranker-v2-m3", 
+        max_length:int=512, 
+        batch_size:int=32, 
+        dtype:str="fp16", 
+        cache_dir:Optional[str]=None, 
+        latency_budget:Optional[float]=None, 
+        cache_size:int=100_000) -> None:
+        """Rescore retrieved chunks with a cross-encoder.
+
+        Args:
+            batch_size: (query, chunk) pairs scored per forward pass
+            latency_budget: seconds per `rerank` call; once spent (the first batch is always scored), the pairs
+                not yet scored keep their first-stage order after the scored ones
+            cache_size: (query, chunk) scores kept in an LRU cache, keyed by the hashes of both texts
+        """
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        if dtype == "bf16":
+            dtype = torch.bfloat16
+        elif dtype == "fp16" and torch.cuda.is_available():
+            dtype = torch.float16
+        else:
+            dtype = torch.float32
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        def load_model():
+            tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, cache_dir=cache_dir)
+            model = AutoModelForSequenceClassification.from_pretrained(
+                model_name_or_path, cache_dir=cache_dir, torch_dtype=dtype, device_map={'': device}).eval()
+            return tokenizer, model
+
+        # loaded on the first rerank, see `ModelRegistry`
+        self._model_key = ("reranker", model_name_or_path, str(dtype), None, device)
+        self._load_model = load_model
+        self._loaded_model = None
+
+    def _model_parts(self):
+        if self._loaded_model is None:
+            with self._lock:
+                if self._loaded_model is None:
+                    self._loaded_model = MODEL_REGISTRY.acquire(self._model_key, self._load_model, owner=self)
+        return self._loaded_model
+
+    @property
+    def tokenizer(self):
+        return self._model_parts()[0]
+
+    @property
+    def model(self):
+        return self._model_parts()[1]
+
+    @torch.no_grad()
+    def score(self, queries: List[str], docs: List[str]) -> np.ndarray:
+        """Relevance of each (query, doc) pair, higher is better."""
+        inputs = self.tokenizer(
+            queries, docs, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt"
+        ).to(self.model.device)
+        logits = self.model(**inputs).logits.float()
+        scores = logits[:, 0] if logits.shape[1] == 1 else logits.log_softmax(-1)[:, -1]
+        return scores.cpu().numpy()
+
+    def rerank(self, queries: Union[str, List[str]], docs: List[str], top_n:Optional[int]=None):
+        """Order `docs`, given in first-stage order, by their best cross-encoder score over `queries`.
+
+        Returns:
+            positions into `docs` and their scores (NaN where the latency budget ran out), best first
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        tic = time.perf_counter()
+        query_keys = [content_hash(query) for query in queries]
+        doc_keys = [content_hash(doc) for doc in docs]
+
+        scores = np.full((len(queries), len(docs)), np.nan, dtype=np.float32)
+        missing = []
+        with self._lock:
+            # one query at a time, so an exhausted budget leaves whole high-ranked docs scored
+            for j in range(len(docs)):
+                for i in range(len(queries)):
+                    score = self._cache.get((query_keys[i], doc_keys[j]))
+                    if score is None:
+                        missing.append((i, j))
+                    else:
+                        self._cache.move_to_end((query_keys[i], doc_keys[j]))
+                        scores[i, j] = score
+
+        for start in range(0, len(missing), self.batch_size):
+            # the first batch, holding the best first-stage hits, is always scored
+            if start and self.latency_budget is not None and time.perf_counter() - tic > self.latency_budget:
+                logger.info(f"rerank budget of {self.latency_budget}s spent, {len(missing) - start} pairs left unscored")
+                break
+            batch = missing[start: start + self.batch_size]
+            batch_scores = self.score([queries[i] for i, _ in batch], [docs[j] for _, j in batch])
+            with self._lock:
+                for (i, j), score in zip(batch, batch_scores.tolist()):
+                    scores[i, j] = score
+                    self._cache[(query_keys[i], doc_keys[j])] = score
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        best = np.full(len(docs), -np.inf, dtype=np.float32)
+        scored = ~np.isnan(scores).all(axis=0)
+        best[scored] = np.nanmax(scores[:, scored], axis=0)
+        # scored docs by score, then unscored ones in first-stage order
+        order = np.argsort(-best, kind="stable").tolist()
+        if top_n is not None:
+            order = order[:top_n]
+        return order, [float(best[j]) if scored[j] else float("nan") for j in order]
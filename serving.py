@@ -0,0 +1,211 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class ServerOverloaded(RuntimeError):
+    """Raised by `MemoRAGServer.submit` when the request queue is full."""
+
+
+class _Request:
+    def __init__(self, store_id, query, task_type, prompt_template, max_new_tokens, use_memory_answer, deadline):
+        self.store_id = store_id
+        self.query = query
+        self.task_type = task_type
+        self.prompt_template = prompt_template
+        self.max_new_tokens = max_new_tokens
+        self.use_memory_answer = use_memory_answer
+        self.deadline = deadline
+        self.future = Future()
+
+    @property
+    def key(self):
+        """Requests with the same key can share batched passes."""
+        return (self.store_id, self.task_type, self.prompt_template, self.max_new_tokens, self.use_memory_answer)
+
+
+class MemoRAGServer:
+    """Serve questions about several memorized contexts from one `MemoRAG` or `MemoRAGLite` pipeline.
+
+    Every context (store) is memorized or loaded once and kept as a `snapshot`; switching stores only swaps
+    references, so all stores share the pipeline's models. A single worker thread drains the request queue,
+    groups requests that target the same store with the same settings, and answers each group with one
+    `batch` call. The queue is bounded (`submit` raises `ServerOverloaded` when it is full) and requests
+    whose deadline has passed before their group runs fail with `TimeoutError`.
+
+    Args:
+        pipeline: a `MemoRAG` or `MemoRAGLite`
+        max_queue_size: pending requests accepted before `submit` pushes back
+        max_batch_size: max requests answered by one `batch` call
+        batch_wait: seconds to wait for more requests to coalesce after the first one arrives
+        default_timeout: deadline in seconds for requests submitted without one
+    """
+    def __init__(
+        self,
+        pipeline,
+        max_queue_size: int = 64,
+        max_batch_size: int = 8,
+        batch_wait: float = 0.005,
+        default_timeout: Optional[float] = None) -> None:
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.default_timeout = default_timeout
+
+        self.stores: Dict[str, Dict] = {}
+        self._active = None
+        # serializes all use of the pipeline, which holds a single active context
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(max_queue_size)
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def add_store(self, store_id: str, context: Optional[str] = None, save_dir: Optional[str] = None, **memorize_kwargs) -> None:
+        """Memorize `context` (saving it to `save_dir` if given), or load the store saved in `save_dir`."""
+        with self._lock:
+            self.pipeline.restore(None)
+            try:
+                if context is None:
+                    if save_dir is None or not os.path.exists(os.path.join(save_dir, "memory.bin")):
+                        raise ValueError("Please provide a context or the save_dir of a memorized store...")
+                    self.pipeline.load(save_dir)
+                else:
+                    self.pipeline.memorize(context, save_dir=save_dir, **memorize_kwargs)
+                self.stores[store_id] = self.pipeline.snapshot()
+                self._active = store_id
+            except Exception:
+                self._active = None
+                raise
+
+    def remove_store(self, store_id: str) -> None:
+        with self._lock:
+            del self.stores[store_id]
+            if self._active == store_id:
+                self.pipeline.restore(None)
+                self._active = None
+
+    def submit(
+        self,
+        store_id: str,
+        query: str = None,
+        task_type: str = "memorag",
+        prompt_template: str = None,
+        max_new_tokens: int = 256,
+        use_memory_answer: bool = False,
+        timeout: Optional[float] = None,
+        block: bool = False) -> Future:
+        """Queue a question about a store.
+
+        Args:
+            timeout: seconds from now until the request expires, defaults to `default_timeout`
+            block: wait for room in the queue (at most `timeout`) instead of raising `ServerOverloaded`
+
+        Returns:
+            a future resolving to the answer
+        """
+        if self._closed.is_set():
+            raise RuntimeError("The server is closed.")
+        if store_id not in self.stores:
+            raise KeyError(f"Unknown store {store_id}!")
+        timeout = timeout if timeout is not None else self.default_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        request = _Request(store_id, query, task_type, prompt_template, max_new_tokens, use_memory_answer, deadline)
+        try:
+            self._queue.put(request, block=block, timeout=timeout if block else None)
+        except queue.Full:
+            raise ServerOverloaded(f"{self._queue.maxsize} requests are already pending, try again later.") from None
+        return request.future
+
+    async def asubmit(self, *args, **kwargs) -> str:
+        """`submit` and await the answer."""
+        return await asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _collect(self) -> List[_Request]:
+        requests = [self._queue.get(timeout=0.1)]
+        coalesce_until = time.monotonic() + self.batch_wait
+        while True:
+            remaining = coalesce_until - time.monotonic()
+            try:
+                requests.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                return requests
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                requests = self._collect()
+            except queue.Empty:
+                continue
+
+            groups = OrderedDict()
+            for request in requests:
+                groups.setdefault(request.key, []).append(request)
+            # serve the active store first to save a context switch
+            keys = sorted(groups, key=lambda key: key[0] != self._active)
+
+            for key in keys:
+                now = time.monotonic()
+                live = []
+                for request in groups[key]:
+                    if request.deadline is not None and now > request.deadline:
+                        request.future.set_exception(TimeoutError("The request expired before it was served."))
+                    elif request.future.set_running_or_notify_cancel():
+                        live.append(request)
+                for i in range(0, len(live), self.max_batch_size):
+                    self._serve(live[i: i + self.max_batch_size])
+
+    def _serve(self, requests: List[_Request]):
+        store_id, task_type, prompt_template, max_new_tokens, use_memory_answer = requests[0].key
+        try:
+            with self._lock:
+                if store_id not in self.stores:
+                    raise KeyError(f"Unknown store {store_id}!")
+                if self._active != store_id:
+                    self.pipeline.restore(self.stores[store_id])
+                    self._active = store_id
+                outputs = self.pipeline.batch(
+                    [request.query for request in requests],
+                    task_type=task_type,
+                    prompt_template=prompt_template,
+                    max_new_tokens=max_new_tokens,
+                    use_memory_answer=use_memory_answer)
+        except Exception as e:
+            logger.error(f"serving {len(requests)} requests on store {store_id} failed: {e}")
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        for request, output in zip(requests, outputs):
+            request.future.set_result(output)
+
+    def close(self, wait: bool = True) -> None:
+        """Stop the worker; requests still queued fail with `RuntimeError`."""
+        self._closed.set()
+        if wait:
+            self._worker.join()
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("The server is closed."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,284 @@
+import os
+import json
+import mmap
+import struct
+import torch
+import numpy as np
+from collections.abc import Sequence
+from typing import Dict, Mapping, Optional, Tuple, Union
+from transformers import DynamicCache
+from transformers.utils import logging
+from .chunking import TextChunks
+
+logger = logging.get_logger(__name__)
+
+
+class ChunkStore(Sequence):
+    """Read-only, memory-mapped list of chunk strings.
+
+    File layout: 8-byte magic, uint64 chunk count `n`, then either (`MRCHUNK1`) `n + 1` uint64 byte offsets
+    into a UTF-8 blob of all chunks, or (`MRCHUNK2`, see `write_spans`) `n` uint64 (start, end) byte spans
+    into the UTF-8 source texts, which are stored once instead of as chunk copies. Only the pages of the
+    chunks actually read are touched, and processes opening the same file share them through the page cache.
+    """
+    MAGIC = b"MRCHUNK1"
+    SPANS_MAGIC = b"MRCHUNK2"
+    _HEADER = struct.Struct("<8sQ")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_chunks = self._HEADER.unpack_from(self._mmap, 0)
+        if magic == self.MAGIC:
+            offsets = np.frombuffer(self._mmap, dtype="<u8", count=num_chunks + 1, offset=self._HEADER.size)
+            self._starts, self._ends = offsets[:-1], offsets[1:]
+            self._blob_start = self._HEADER.size + offsets.nbytes
+        elif magic == self.SPANS_MAGIC:
+            spans = np.frombuffer(self._mmap, dtype="<u8", count=2 * num_chunks, offset=self._HEADER.size)
+            self._starts, self._ends = spans[0::2], spans[1::2]
+            self._blob_start = self._HEADER.size + spans.nbytes
+        else:
+            raise ValueError(f"{path} is not a chunk store!")
+
+    @classmethod
+    def write(cls, path: str, chunks: Sequence) -> None:
+        """Write chunk strings one at a time, so a memory-mapped source is never read into RAM whole."""
+        offsets = np.zeros(len(chunks) + 1, dtype="<u8")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls._HEADER.pack(cls.MAGIC, len(chunks)))
+            # the offsets are only known once the chunks are written after them
+            f.seek(offsets.nbytes, os.SEEK_CUR)
+            for i, chunk in enumerate(chunks):
+                b = chunk.encode("utf-8")
+                f.write(b)
+                offsets[i + 1] = offsets[i] + len(b)
+            f.seek(cls._HEADER.size)
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def write_spans(cls, path: str, chunks: TextChunks) -> None:
+        """Write chunks that are spans of their source texts, storing each source text once."""
+        blobs, spans = chunks.byte_spans()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls._HEADER.pack(cls.SPANS_MAGIC, len(spans)))
+            f.write(spans.astype("<u8").tobytes())
+            for b in blobs:
+                f.write(b)
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        start = self._blob_start + int(self._starts[i])
+        end = self._blob_start + int(self._ends[i])
+        return self._mmap[start:end].decode("utf-8")
+
+    def close(self) -> None:
+        self._starts = self._ends = None
+        self._mmap.close()
+
+
+def save_chunks(save_dir: str, chunks: Sequence) -> None:
+    """Save the retrieval corpus as `chunks.bin` for mmap loading, and `chunks.json` for readability.
+
+    `TextChunks` are saved as spans of their source texts.
+    """
+    if isinstance(chunks, TextChunks):
+        ChunkStore.write_spans(os.path.join(save_dir, "chunks.bin"), chunks)
+    else:
+        ChunkStore.write(os.path.join(save_dir, "chunks.bin"), chunks)
+    with open(os.path.join(save_dir, "chunks.json"), "w") as f:
+        json.dump(list(chunks), f, ensure_ascii=False, indent=2)
+
+
+def load_chunks(save_dir: str, mmap: bool = True) -> Sequence:
+    """Load the retrieval corpus of a store, memory-mapped when the store has a `chunks.bin`."""
+    bin_path = os.path.join(save_dir, "chunks.bin")
+    if mmap and os.path.exists(bin_path):
+        return ChunkStore(bin_path)
+    with open(os.path.join(save_dir, "chunks.json")) as f:
+        return json.load(f)
+
+
+class GistJournal:
+    """Append-only JSONL journal of generated gists, keyed by a hash of the gist prompt and its generation
+    settings, so an interrupted `memorize` resumes from the gists already written.
+
+    Each record is flushed and fsynced as it is written; a record torn by a crash is ignored on reopen.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.gists: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping a torn record in gist journal {path}")
+                        continue
+                    self.gists[record["key"]] = record["gist"]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() > 0:
+            # terminate a record torn by a crash, so the next one starts on its own line
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.gists
+
+    def __getitem__(self, key: str) -> str:
+        return self.gists[key]
+
+    def __len__(self) -> int:
+        return len(self.gists)
+
+    def append(self, key: str, gist: str) -> None:
+        self._file.write(json.dumps({"key": key, "gist": gist}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.gists[key] = gist
+
+    def close(self) -> None:
+        self._file.close()
+
+
+KV_MAGIC = b"MRKVC001"
+_KV_HEADER = struct.Struct("<8sQ")
+_ALIGN = 64
+# largest finite magnitude of each quantized dtype
+_QMAX = {"int8": 127.0, "fp8": 448.0}
+
+
+def _dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def _quantize(x: torch.Tensor, mode: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric quantization with one scale per (batch, head, position), i.e. over the head dim."""
+    scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / _QMAX[mode]
+    x = x.float() / scale
+    if mode == "int8":
+        x = x.round().clamp(-127, 127).to(torch.int8)
+    else:
+        x = x.to(torch.float8_e4m3fn)
+    return x, scale.to(torch.float16)
+
+
+def _dequantize(x: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    return (x.float() * scale.float()).to(dtype)
+
+
+def is_kv_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(KV_MAGIC)) == KV_MAGIC
+
+
+def save_kv_cache(
+    path: str,
+    cache: DynamicCache,
+    tensors: Optional[Mapping[str, torch.Tensor]] = None,
+    meta: Optional[Dict] = None,
+    quantize: Optional[str] = None) -> None:
+    """Write a KV cache as contiguous per-layer blobs behind a small JSON header.
+
+    Args:
+        tensors: extra tensors stored alongside, e.g. the context input ids
+        meta: JSON-serializable metadata
+        quantize: None keeps the cache dtype, "int8" or "fp8" store keys and values with a per-position scale
+    """
+    if quantize not in (None, "int8", "fp8"):
+        raise NotImplementedError(f"KV quantization {quantize} not implemented!")
+
+    layers = cache.to_legacy_cache()
+    blobs = {}
+    for i, (key, value) in enumerate(layers):
+        for name, x in (("key", key), ("value", value)):
+            if quantize:
+                blobs[f"layers.{i}.{name}"], blobs[f"layers.{i}.{name}.scale"] = _quantize(x, quantize)
+            else:
+                blobs[f"layers.{i}.{name}"] = x
+    for name, x in (tensors or {}).items():
+        blobs[name] = x
+
+    header = {
+        "version": 1,
+        "num_layers": len(layers),
+        "quantize": quantize,
+        "kv_dtype": _dtype_name(layers[0][0].dtype) if layers else None,
+        "meta": meta or {},
+        "tensors": {},
+    }
+    offset = 0
+    for name, x in blobs.items():
+        x = x.detach().contiguous().cpu()
+        blobs[name] = x
+        header["tensors"][name] = {
+            "dtype": _dtype_name(x.dtype), "shape": list(x.shape), "offset": offset, "nbytes": x.numel() * x.element_size()}
+        offset += -(-header["tensors"][name]["nbytes"] // _ALIGN) * _ALIGN
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(_KV_HEADER.size + len(header_bytes)) // _ALIGN) * _ALIGN
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_KV_HEADER.pack(KV_MAGIC, len(header_bytes)))
+        f.write(header_bytes)
+        for name, x in blobs.items():
+            f.seek(data_start + header["tensors"][name]["offset"])
+            # bytes of any dtype, including bfloat16 and float8 which numpy lacks
+            f.write(x.view(-1).view(torch.uint8).numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_kv_cache(path: str, device: Union[str, torch.device] = "cpu") -> Tuple[DynamicCache, Dict[str, torch.Tensor], Dict]:
+    """Load a file written by `save_kv_cache`.
+
+    The file is mapped with `torch.from_file`, so unquantized layers left on CPU are views into the page
+    cache and are only read from disk when used. Quantized layers are dequantized to the original dtype.
+
+    Returns:
+        cache, extra tensors, meta
+    """
+    with open(path, "rb") as f:
+        magic, header_size = _KV_HEADER.unpack(f.read(_KV_HEADER.size))
+        if magic != KV_MAGIC:
+            raise ValueError(f"{path} is not a KV cache file!")
+        header = json.loads(f.read(header_size))
+    data_start = -(-(_KV_HEADER.size + header_size) // _ALIGN) * _ALIGN
+    buffer = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+
+    def tensor(name):
+        info = header["tensors"][name]
+        start = data_start + info["offset"]
+        x = buffer[start: start + info["nbytes"]].view(getattr(torch, info["dtype"]))
+        return x.view(info["shape"]).to(device)
+
+    quantize, kv_dtype = header["quantize"], header["kv_dtype"]
+    layers = []
+    for i in range(header["num_layers"]):
+        layer = []
+        for name in ("key", "value"):
+            x = tensor(f"layers.{i}.{name}")
+            if quantize:
+                x = _dequantize(x, tensor(f"layers.{i}.{name}.scale"), getattr(torch, kv_dtype))
+            layer.append(x)
+        layers.append(tuple(layer))
+    cache = DynamicCache.from_legacy_cache(tuple(layers))
+
+    tensors = {name: tensor(name) for name in header["tensors"] if not name.startswith("layers.")}
+    return cache, tensors, header["meta"]
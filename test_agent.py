@@ -0,0 +1,128 @@
+import json
+import time
+import threading
+import openai
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import agent as agent_module
+from .agent import Agent, TokenBucket
+
+
+class StubChatServer(ThreadingHTTPServer):
+    """Answers chat completions with the prompt after `delay` seconds, failing the first `failures[prompt]`
+    requests of a prompt with 503."""
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.05):
+        super().__init__(("127.0.0.1", 0), StubChatHandler)
+        self.delay = delay
+        self.failures = {}
+        self.requests = []
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubChatHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        prompt = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["messages"][0]["content"]
+        with server.lock:
+            server.requests.append((time.monotonic(), prompt))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            fail = server.failures.get(prompt, 0) > 0
+            if fail:
+                server.failures[prompt] -= 1
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        if fail:
+            return self._reply(503, {"error": {"message": "overloaded", "type": "server_error"}})
+        self._reply(200, {
+            "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+            "choices": [{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": f"re: {prompt}"}}]})
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # fresh shared rate limiters, and no backoff wait before a retry
+    monkeypatch.setattr(agent_module, "_rate_limiters", {})
+    monkeypatch.setattr(agent_module, "backoff_delay", lambda *args: 0.0)
+    server = StubChatServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _agent(server, **kwargs):
+    return Agent("stub", "openai", {"api_key": "test", "base_url": server.base_url}, **kwargs)
+
+
+def test_generate_many_keeps_order_and_bounds_concurrency(server):
+    prompts = [f"prompt {i}" for i in range(12)]
+    responses = _agent(server, max_concurrency=3).generate_many(prompts)
+    assert responses == [f"re: {prompt}" for prompt in prompts]
+    assert server.max_in_flight == 3
+
+
+def test_generate_many_retries_503(server):
+    server.failures = {"prompt 1": 2}
+    prompts = [f"prompt {i}" for i in range(3)]
+    assert _agent(server).generate_many(prompts) == [f"re: {prompt}" for prompt in prompts]
+    assert [prompt for _, prompt in server.requests].count("prompt 1") == 3
+
+
+def test_generate_retries_503(server):
+    server.failures = {"prompt": 1}
+    assert _agent(server).generate("prompt") == ["re: prompt"]
+    assert len(server.requests) == 2
+
+
+def test_generate_gives_up_after_retries(server):
+    server.failures = {"prompt": 100}
+    with pytest.raises(openai.InternalServerError):
+        _agent(server).generate("prompt")
+    # one attempt and 3 retries of `except_retry_dec`, the client does not retry on its own
+    assert len(server.requests) == 4
+
+    server.requests, server.failures = [], {"prompt": 100}
+    with pytest.raises(openai.InternalServerError):
+        _agent(server).generate_many(["prompt"])
+    assert len(server.requests) == 4
+
+
+def test_generate_many_is_rate_limited(server):
+    server.delay = 0.0
+    # 10 requests per second with bursts of 10, so 20 requests take at least a second
+    prompts = [f"prompt {i}" for i in range(20)]
+    tic = time.monotonic()
+    assert _agent(server, requests_per_minute=600).generate_many(prompts) == [f"re: {p}" for p in prompts]
+    assert time.monotonic() - tic >= 0.9
+    times = sorted(t for t, _ in server.requests)
+    assert times[-1] - times[0] >= 0.9
+
+
+def test_token_bucket_reservations_queue():
+    bucket = TokenBucket(rate=10, capacity=2)
+    waits = [bucket.reserve() for _ in range(5)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2:] == pytest.approx([0.1, 0.2, 0.3], abs=0.01)
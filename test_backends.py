@@ -0,0 +1,29 @@
+import pytest
+import numpy as np
+from .benchmark import build_stub_models, encoder_parity, synthetic_docs
+from .retrieval import DenseRetriever
+
+MIN_COSINE = 0.99
+
+
+@pytest.fixture(scope="module")
+def encoder(tmp_path_factory):
+    return build_stub_models(str(tmp_path_factory.mktemp("stub-models")))["encoder"]
+
+
+def _encode(retriever, queries, docs):
+    return np.concatenate([
+        retriever.encode(queries, field="query").float().cpu().numpy(),
+        retriever.encode_keys(docs, batch_size=8, use_cache=False)])
+
+
+@pytest.mark.parametrize("backend", ["compile", "onnx"])
+def test_backend_matches_eager(encoder, backend, tmp_path):
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+    queries, docs = synthetic_docs(4, max_words=16, seed=1), synthetic_docs(16, max_words=120)
+    reference = _encode(DenseRetriever(encoder, dtype="fp32", sparse=False), queries, docs)
+    retriever = DenseRetriever(
+        encoder, dtype="fp32", encoder_backend=backend, backend_dir=str(tmp_path), sparse=False)
+    parity = encoder_parity(_encode(retriever, queries, docs), reference)
+    assert parity["min_cosine"] >= MIN_COSINE, parity
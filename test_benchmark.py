@@ -0,0 +1,25 @@
+import pytest
+from . import benchmark
+from .benchmark import benchmark_kv_serialization
+
+
+@pytest.mark.parametrize("dtype", ["bfloat16", "float32"])
+def test_kv_round_trips_within_tolerance(dtype, tmp_path):
+    records = benchmark_kv_serialization(context_length=64, num_layers=2, dtype=dtype, save_dir=str(tmp_path))
+    errors = {record["format"]: record["max_abs_error"] for record in records}
+    assert errors["pickle"] == errors["kv"] == 0.0
+    assert 0.0 < errors["kv-int8"] < errors["kv-fp8"]
+
+
+def test_kv_round_trip_check_covers_values(monkeypatch, tmp_path):
+    load_kv_cache = benchmark.load_kv_cache
+
+    def corrupted(path):
+        # keys intact, values of the first layer zeroed
+        cache, *rest = load_kv_cache(path)
+        cache.value_cache[0] = cache.value_cache[0] * 0
+        return (cache, *rest)
+
+    monkeypatch.setattr(benchmark, "load_kv_cache", corrupted)
+    with pytest.raises(AssertionError):
+        benchmark_kv_serialization(context_length=64, num_layers=2, save_dir=str(tmp_path))
@@ -0,0 +1,82 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from . import cache as cache_module
+from .cache import EmbeddingCache, QueryEmbeddingCache
+
+NAMESPACE = {"encoder": "test"}
+NDIM = 8
+
+
+def _embedding(doc: str) -> np.ndarray:
+    return np.full(NDIM, float(doc.split()[-1]), dtype=np.float32)
+
+
+def _put_docs(cache_dir: str, docs):
+    cache = EmbeddingCache(cache_dir, NAMESPACE, NDIM)
+    for start in range(0, len(docs), 7):
+        batch = docs[start:start + 7]
+        cache.put(batch, np.stack([_embedding(doc) for doc in batch]))
+
+
+def test_concurrent_processes_keep_rows_aligned(tmp_path):
+    cache_dir = str(tmp_path)
+    # overlapping docs, so processes race on the same keys too
+    docs = [[f"doc {i}" for i in range(start, start + 200)] for start in range(0, 400, 100)]
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("spawn")) as pool:
+        list(pool.map(_put_docs, [cache_dir] * len(docs), docs))
+
+    cache = EmbeddingCache(cache_dir, NAMESPACE, NDIM)
+    all_docs = [f"doc {i}" for i in range(500)]
+    embeddings, missing = cache.get(all_docs)
+    assert missing == []
+    assert len(cache) == 500
+    np.testing.assert_array_equal(embeddings, np.stack([_embedding(doc) for doc in all_docs]))
+
+
+def test_sees_rows_appended_by_another_instance(tmp_path):
+    reader = EmbeddingCache(str(tmp_path), NAMESPACE, NDIM)
+    writer = EmbeddingCache(str(tmp_path), NAMESPACE, NDIM)
+    writer.put(["doc 1", "doc 2"], np.stack([_embedding("doc 1"), _embedding("doc 2")]))
+    embeddings, missing = reader.get(["doc 2", "doc 3"])
+    assert missing == [1]
+    np.testing.assert_array_equal(embeddings[0], _embedding("doc 2"))
+    # appends after the other instance's rows
+    reader.put(["doc 3"], _embedding("doc 3")[None])
+    embeddings, missing = writer.get(["doc 1", "doc 2", "doc 3"])
+    assert missing == []
+    np.testing.assert_array_equal(embeddings[:, 0], [1.0, 2.0, 3.0])
+
+
+def test_query_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    cache = QueryEmbeddingCache(ttl=10.0)
+    cache.put(cache.key("q"), np.ones(NDIM))
+    now[0] += 10.0
+    assert cache.get(cache.key("q")) is not None
+    now[0] += 0.5
+    assert cache.get(cache.key("q")) is None
+    assert len(cache) == 0 and cache.nbytes == 0 and cache.expirations == 1
+
+
+def test_query_cache_is_bounded_by_bytes():
+    row_bytes = NDIM * 4
+    cache = QueryEmbeddingCache(max_bytes=3 * row_bytes)
+    for i in range(5):
+        cache.put(cache.key(f"q{i}"), np.full(NDIM, i))
+    assert len(cache) == 3 and cache.nbytes == 3 * row_bytes and cache.evictions == 2
+    assert cache.get(cache.key("q1")) is None and cache.get(cache.key("q4"))[0] == 4
+    # rows larger than the whole budget are not cached
+    cache.put(cache.key("big"), np.zeros(4 * NDIM))
+    assert cache.get(cache.key("big")) is None and len(cache) == 3
+
+
+def test_query_cache_normalizes_variants():
+    cache = QueryEmbeddingCache()
+    cache.put(cache.key("What is  NVDA's\tguidance?", "Represent: "), np.ones(NDIM))
+    for variant in ["what is nvda's guidance?", " WHAT IS NVDA's\nguidance? ", "Ｗｈａｔ ｉｓ ＮＶＤＡ's guidance?"]:
+        assert cache.get(cache.key(variant, "Represent: ")) is not None
+    # the instruction is part of the key
+    assert cache.get(cache.key("what is nvda's guidance?")) is None
+    assert len(cache) == 1
@@ -0,0 +1,57 @@
+import numpy as np
+from .chunking import ChainedChunks, ParallelChunker, TextChunks, coarse_segments, extend_corpus
+from .store import ChunkStore, load_chunks, save_chunks
+
+
+def _text(num_paragraphs: int = 60, seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    words = ["memory", "retrieval", "clue", "gist", "naïve", "café", "数据", "index", "query", "answer"]
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        sentences = [" ".join(rng.choice(words, rng.integers(4, 15))).capitalize() + "." for _ in range(rng.integers(2, 8))]
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def test_sequential_chunks_are_the_splitters():
+    text = _text()
+    chunker = ParallelChunker(32, num_workers=1, min_parallel_chars=0)
+    assert chunker.chunks(text) == list(chunker.splitter.chunks(text))
+
+
+def test_parallel_chunks_fit_and_cover_the_text():
+    text = _text()
+    chunker = ParallelChunker(32, num_workers=2, segment_chars=1000, min_parallel_chars=0)
+    spans = chunker.spans(text)
+    segment_ends = {end for _, end in coarse_segments(text, chunker.segment_chars)}
+
+    position = 0
+    for start, end in spans:
+        # in order, and only whitespace left out between chunks
+        assert position <= start < end
+        assert not text[position:start].strip()
+        # never across a segment boundary, and within capacity
+        assert not any(start < cut < end for cut in segment_ends)
+        assert list(chunker.splitter.chunks(text[start:end])) == [text[start:end]]
+        position = end
+    assert not text[position:].strip()
+
+
+def test_extending_a_loaded_corpus_keeps_it_mapped(tmp_path):
+    chunker = ParallelChunker(32, num_workers=1)
+    first, second, third = (chunker.split(_text(10, seed)) for seed in range(3))
+    save_chunks(str(tmp_path), first)
+    loaded = load_chunks(str(tmp_path))
+    assert isinstance(loaded, ChunkStore)
+
+    corpus = extend_corpus(extend_corpus(loaded, second), third)
+    assert isinstance(corpus, ChainedChunks)
+    assert corpus.parts[0] is loaded and isinstance(corpus.parts[1], TextChunks)
+    expected = list(first) + list(second) + list(third)
+    assert list(corpus) == expected
+    assert corpus[-1] == expected[-1] and corpus[3:7] == expected[3:7]
+
+    saved = tmp_path / "saved"
+    saved.mkdir()
+    save_chunks(str(saved), corpus)
+    assert list(load_chunks(str(saved))) == expected
@@ -0,0 +1,24 @@
+import pytest
+from .benchmark import build_stub_models, synthetic_context, synthetic_queries
+from .memorag import MemoRAG
+
+
+@pytest.fixture(scope="module")
+def pipe(tmp_path_factory):
+    models = build_stub_models(str(tmp_path_factory.mktemp("stub-models")), max_context_tokens=4096)
+    pipe = MemoRAG(
+        mem_model_name_or_path=models["llm"], ret_model_name_or_path=models["encoder"], 
+        gen_model_name_or_path=models["llm"], retrieval_chunk_size=64, chunk_workers=1)
+    pipe.memorize(synthetic_context(1024))
+    return pipe
+
+
+def test_batch_matches_serial_call(pipe):
+    # greedy decoding, so both paths must produce the same clues, retrieval and answer
+    for query in synthetic_queries(synthetic_context(1024), 2):
+        assert pipe.batch([query], max_new_tokens=16) == [pipe(query, max_new_tokens=16)]
+
+
+def test_batch_matches_serial_qa(pipe):
+    query = synthetic_queries(synthetic_context(1024), 1)[0]
+    assert pipe.batch([query], task_type="qa", max_new_tokens=16) == [pipe(query, task_type="qa", max_new_tokens=16)]
@@ -0,0 +1,71 @@
+import pytest
+from .benchmark import build_stub_models, synthetic_context, synthetic_queries
+from .memorag import MemoRAG
+
+# opens every conversation with BOS and a system turn, which an extension must not repeat
+CHAT_TEMPLATE = (
+    "{{ bos_token }}<|im_start|> system w1 <|im_end|> "
+    "{% for m in messages %}<|im_start|> {{ m['role'] }} {{ m['content'] }} <|im_end|> {% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|> assistant {% endif %}")
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    return build_stub_models(str(tmp_path_factory.mktemp("stub-models")), max_context_tokens=4096)
+
+
+def _pipe(models, **kwargs):
+    pipe = MemoRAG(
+        mem_model_name_or_path=models["llm"], ret_model_name_or_path=models["encoder"], 
+        gen_model_name_or_path=models["llm"], retrieval_chunk_size=64, chunk_workers=1, **kwargs)
+    pipe.mem_model.tokenizer.chat_template = CHAT_TEMPLATE
+    return pipe
+
+
+def test_extend_matches_memorizing_everything(models):
+    first, second = synthetic_context(512, seed=1), synthetic_context(512, seed=2)
+    extended, whole = _pipe(models), _pipe(models)
+    extended.memorize(first)
+    old_length = extended.mem_model.memory.get_seq_length()
+    extended.extend(second)
+    whole.memorize(first + "\n\n" + second)
+
+    assert len(extended.retrieval_corpus) == len(whole.retrieval_corpus)
+    assert extended.retriever._index.ntotal == whole.retriever._index.ntotal
+
+    memory = extended.mem_model
+    continuation = (
+        f"<|im_start|> user {memory.prompts['context_continue'].format(context=second)} <|im_end|> "
+        f"<|im_start|> assistant {memory.prompts['dull_reply']} <|im_end|> ")
+    new_tokens = len(memory.tokenizer(continuation, add_special_tokens=False)["input_ids"])
+    assert memory.memory.get_seq_length() == old_length + new_tokens
+    assert memory.context_inputs["input_ids"].shape[1] == old_length + new_tokens
+    # the conversation is opened once
+    assert (memory.context_inputs["input_ids"] == memory.tokenizer.bos_token_id).sum() == 1
+
+
+def test_cached_answers_follow_the_store(models):
+    pipe = _pipe(models, response_cache_size=16)
+    first, second = synthetic_context(512, seed=1), synthetic_context(512, seed=2)
+    query = synthetic_queries(first, 1)[0]
+
+    def answer():
+        hits = pipe.response_cache.hits
+        pipe(query, max_new_tokens=8)
+        return pipe.response_cache.hits > hits
+
+    pipe.memorize(first)
+    assert not answer() and answer()
+    state = pipe.snapshot()
+
+    # another store never sees the first one's answers, which stay cached for it
+    pipe.restore()
+    pipe.memorize(second)
+    assert not answer()
+    pipe.restore(state)
+    assert answer()
+
+    # extending replaces the store, its answers are dropped
+    pipe.extend(second)
+    assert len(pipe.response_cache) == 1
+    assert not answer()
@@ -0,0 +1,42 @@
+import json
+import threading
+import pytest
+from .memorag_lite import MemoRAGLite
+
+
+class StubGenerator:
+    """Gists every prompt, failing from the `fail_at`-th call on."""
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.calls = 0
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def generate(self, prompts, batch_size, max_new_tokens, repetition_penalty):
+        with self._lock:
+            self.calls += 1
+            if self.fail_at is not None and self.calls >= self.fail_at:
+                raise RuntimeError("interrupted")
+            self.prompts.extend(prompts)
+        return [f"gist of {prompt}" for prompt in prompts]
+
+
+def _pipe(generator):
+    return MemoRAGLite(gen_model_name_or_path=None, customized_gen_model=generator, calibration_cache=None, chunk_workers=1)
+
+
+def test_form_gists_resumes_from_journal(tmp_path):
+    chunks = [f"chunk {i}" for i in range(10)]
+    journal_path = str(tmp_path / "gists.jsonl")
+
+    interrupted = StubGenerator(fail_at=3)
+    with pytest.raises(RuntimeError):
+        _pipe(interrupted)._form_gists(chunks, batch_size=2, journal_path=journal_path)
+    assert interrupted.prompts == chunks[:4]
+
+    resumed = StubGenerator()
+    gists = _pipe(resumed)._form_gists(chunks, batch_size=2, num_workers=2, journal_path=journal_path)
+    assert sorted(resumed.prompts) == sorted(chunks[4:])
+    assert gists == [f"gist of {chunk}" for chunk in chunks]
+    with open(journal_path) as f:
+        assert len([json.loads(line) for line in f]) == len(chunks)
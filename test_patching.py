@@ -0,0 +1,55 @@
+import types
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from .memorag import reversible_patch
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=16, intermediate_size=32, num_hidden_layers=2, num_attention_heads=2, 
+        num_key_value_heads=2, max_position_embeddings=64)
+    return LlamaForCausalLM(config).eval()
+
+
+def _patch(model):
+    """Rebinds attention forwards and flags on instances, like MInference does."""
+    for layer in model.model.layers:
+        forward = layer.self_attn.forward
+        layer.self_attn.forward = types.MethodType(
+            lambda self, *args, **kwargs: tuple(x * 0 if torch.is_tensor(x) else x for x in forward(*args, **kwargs)), 
+            layer.self_attn)
+        layer.add_module("sparse_pattern", torch.nn.Identity())
+    model.model.norm = torch.nn.Identity()
+    model.config.minference = True
+
+
+def _logits(model):
+    with torch.no_grad():
+        return model(torch.arange(8)[None]).logits
+
+
+def _assert_unpatched(model, logits):
+    for layer in model.model.layers:
+        assert "forward" not in vars(layer.self_attn) and not hasattr(layer, "sparse_pattern")
+    assert not isinstance(model.model.norm, torch.nn.Identity) and not hasattr(model.config, "minference")
+    torch.testing.assert_close(_logits(model), logits, rtol=0, atol=0)
+
+
+def test_reversible_patch_restores_forwards(model):
+    logits = _logits(model)
+    with reversible_patch(model):
+        _patch(model)
+        assert not torch.equal(_logits(model), logits)
+    _assert_unpatched(model, logits)
+
+
+def test_reversible_patch_restores_forwards_after_error(model):
+    logits = _logits(model)
+    with pytest.raises(RuntimeError):
+        with reversible_patch(model):
+            _patch(model)
+            raise RuntimeError("prefill failed")
+    _assert_unpatched(model, logits)
@@ -0,0 +1,29 @@
+import pytest
+import torch
+from transformers import DynamicCache
+from .benchmark import build_stub_models, synthetic_context, synthetic_queries
+from .memorag import Model, generate_from_prefix, merge_inputs
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    models = build_stub_models(str(tmp_path_factory.mktemp("stub-models")), max_context_tokens=4096)
+    return Model(models["llm"])
+
+
+def test_generations_from_one_prefix_match_scratch(model):
+    context = synthetic_context(256)
+    context_inputs = model.tokenizer([context], return_tensors="pt").to(model.model.device)
+    with torch.no_grad():
+        cache = model.model(**context_inputs, past_key_values=DynamicCache()).past_key_values
+    prefix_length = cache.get_seq_length()
+    keys = [key.clone() for key, _ in cache.to_legacy_cache()]
+
+    for prompt in synthetic_queries(context, 2):
+        sample_inputs = model.tokenizer([prompt], add_special_tokens=False, return_tensors="pt").to(model.model.device)
+        generated = generate_from_prefix(model, cache, context_inputs, sample_inputs, max_new_tokens=8, do_sample=False)
+        # the shared cache is cropped back to the memorized prefix, unchanged
+        assert cache.get_seq_length() == prefix_length
+        assert all(torch.equal(key, saved) for (key, _), saved in zip(cache.to_legacy_cache(), keys))
+        scratch = model.ids2text(merge_inputs(context_inputs, sample_inputs), max_new_tokens=8, do_sample=False)
+        assert generated == scratch
@@ -0,0 +1,59 @@
+import gc
+import torch
+from .registry import ModelRegistry
+
+# 256 KB of fp32 weights
+MODEL_MB = 0.25
+
+
+def _loader(loads, name):
+    def load():
+        loads.append(name)
+        return torch.nn.Linear(256, 256, bias=False)
+    return load
+
+
+class Owner:
+    pass
+
+
+def test_acquire_shares_one_instance():
+    registry, loads = ModelRegistry(), []
+    first = registry.acquire(("llm", "a"), _loader(loads, "a"))
+    second = registry.acquire(("llm", "a"), _loader(loads, "a"))
+    assert first is second and loads == ["a"]
+    assert registry.stats()["hits"] == 1 and registry._entries[("llm", "a")].refs == 2
+
+
+def test_over_budget_evicts_least_recently_used_idle_model():
+    registry, loads = ModelRegistry(memory_budget_mb=2.5 * MODEL_MB), []
+    for name in ["a", "b", "a"]:
+        registry.acquire(("llm", name), _loader(loads, name))
+        registry.release(("llm", name))
+    held = registry.acquire(("llm", "c"), _loader(loads, "c"))
+    # "b" was used longer ago than "a"
+    assert list(registry._entries) == [("llm", "a"), ("llm", "c")] and registry.evictions == 1
+
+    # referenced models are never evicted, even over budget
+    registry.acquire(("llm", "d"), _loader(loads, "d"))
+    registry.acquire(("llm", "e"), _loader(loads, "e"))
+    assert list(registry._entries) == [("llm", "c"), ("llm", "d"), ("llm", "e")]
+    assert registry.nbytes > registry.memory_budget_mb * 1024 ** 2
+    assert registry.acquire(("llm", "c"), _loader(loads, "c")) is held and loads == ["a", "b", "c", "d", "e"]
+
+
+def test_owner_collection_releases_reference():
+    registry, loads = ModelRegistry(memory_budget_mb=0), []
+    owners = [Owner(), Owner()]
+    for owner in owners:
+        registry.acquire(("llm", "a"), _loader(loads, "a"), owner=owner)
+    del owner
+    entry = registry._entries[("llm", "a")]
+    assert entry.refs == 2
+
+    owners.pop()
+    gc.collect()
+    assert entry.refs == 1 and ("llm", "a") in registry._entries
+    owners.pop()
+    gc.collect()
+    assert entry.refs == 0 and ("llm", "a") not in registry._entries
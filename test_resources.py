@@ -0,0 +1,54 @@
+import pytest
+import torch
+from . import resources
+from .resources import BatchCalibrator, ResourceProbe
+
+
+class FixedProbe(ResourceProbe):
+    def probe(self):
+        return {
+            "cpu_count": 8, "physical_cores": 4, "torch_threads": 4, "ram_available_mb": 1024.0,
+            "gpu_name": None, "gpu_free_mb": None, "gpu_total_mb": None}
+
+
+class FakeGeneration:
+    """Generation on a fake clock: `seconds(batch_size, num_threads)` per run, OOM from `oom_batch` on."""
+    def __init__(self, monkeypatch, seconds, oom_batch=None):
+        self.now, self.calls = 0.0, []
+        self.seconds, self.oom_batch = seconds, oom_batch
+        monkeypatch.setattr(resources.time, "perf_counter", lambda: self.now)
+
+    def __call__(self, batch, new_tokens):
+        num_threads = torch.get_num_threads()
+        self.calls.append((len(batch), num_threads))
+        if self.oom_batch is not None and len(batch) >= self.oom_batch:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory.")
+        self.now += self.seconds(len(batch), num_threads)
+
+
+def test_stops_at_first_slowdown(monkeypatch):
+    # throughput peaks at batch 4
+    run = FakeGeneration(monkeypatch, lambda bs, _: {1: 1.0, 2: 1.0, 4: 1.0, 8: 4.0}.get(bs, 100.0))
+    best = BatchCalibrator(FixedProbe(), cache_path=None).calibrate(run, ["a", "b", "c"], "k", max_batch=64, on_gpu=True)
+    assert best["batch_size"] == 4
+    assert [bs for bs, _ in run.calls] == [1, 2, 4, 8]
+
+
+def test_stops_at_oom_and_caches(monkeypatch, tmp_path):
+    run = FakeGeneration(monkeypatch, lambda bs, _: 1.0, oom_batch=8)
+    calibrator = BatchCalibrator(FixedProbe(), cache_path=str(tmp_path / "calibration.json"))
+    best = calibrator.calibrate(run, ["a"], "k", max_batch=64, on_gpu=True)
+    assert best["batch_size"] == 4
+    assert [bs for bs, _ in run.calls] == [1, 2, 4, 8]
+    run.calls.clear()
+    assert calibrator.calibrate(run, ["a"], "k", max_batch=64, on_gpu=True) == best
+    assert run.calls == []
+
+
+def test_picks_threads_at_batch_one(monkeypatch):
+    original_threads = torch.get_num_threads()
+    run = FakeGeneration(monkeypatch, lambda bs, threads: 1.0 / threads)
+    best = BatchCalibrator(FixedProbe(), cache_path=None).calibrate(run, ["a", "b"], "k", max_batch=4, on_gpu=False)
+    assert best == {"batch_size": 4, "num_threads": 8, "tokens_per_s": pytest.approx(4 * 32 * 8, rel=1e-3)}
+    assert run.calls == [(1, 8), (1, 4), (1, 2), (2, 8), (4, 8)]
+    assert torch.get_num_threads() == original_threads
@@ -0,0 +1,179 @@
+import os
+import gc
+import numpy as np
+import pytest
+from . import retrieval
+from .benchmark import build_stub_models, synthetic_docs
+from .retrieval import CrossEncoderReranker, DenseRetriever, FaissIndex, ShardedFaissIndex, load_index
+
+
+@pytest.mark.parametrize("quantize", ["int8", "binary"])
+def test_spilled_rescoring_matches_in_memory(quantize, tmp_path):
+    rng = np.random.default_rng(0)
+    keys = rng.standard_normal((3000, 64)).astype(np.float32)
+    queries = keys[:20] + 0.01
+    spill_dir = str(tmp_path / "spill")
+
+    in_memory, spilled = FaissIndex("cpu", quantize=quantize), FaissIndex("cpu", quantize=quantize, spill_dir=spill_dir)
+    for index in (in_memory, spilled):
+        index.build(keys[:2000], "auto", "ip")
+        index.add(keys[2000:])
+    assert isinstance(spilled.vectors, np.memmap) and len(spilled.vectors) == len(keys)
+    assert len(os.listdir(spill_dir)) == 1
+    np.testing.assert_array_equal(spilled.search(queries, 10)[1], in_memory.search(queries, 10)[1])
+
+    # saving maps the saved copy, appends after it spill to a new file seeded from it
+    spilled.save(str(tmp_path / "index.bin"))
+    assert os.listdir(spill_dir) == []
+    spilled.add(keys[:10])
+    in_memory.add(keys[:10])
+    assert len(spilled.vectors) == len(keys) + 10
+    np.testing.assert_array_equal(spilled.search(queries, 10)[1], in_memory.search(queries, 10)[1])
+
+    del spilled, index
+    gc.collect()
+    assert os.listdir(spill_dir) == []
+
+
+@pytest.fixture
+def small_thresholds(monkeypatch):
+    monkeypatch.setattr(retrieval, "FLAT_MAX_NTOTAL", 100)
+    monkeypatch.setattr(retrieval, "HNSW_MAX_NTOTAL", 1000)
+
+
+def test_auto_index_selection(small_thresholds):
+    keys = np.random.default_rng(0).standard_normal((2000, 64)).astype(np.float32)
+    for ntotal, prefix in [(50, "Flat"), (500, "HNSW"), (2000, "IVF")]:
+        index = FaissIndex("cpu")
+        index.build(keys[:ntotal], "auto", "ip")
+        assert index.index_factory.startswith(prefix) and index.ntotal == ntotal
+
+
+def test_auto_index_appends_then_retrains(small_thresholds, tmp_path):
+    keys = np.random.default_rng(0).standard_normal((300, 64)).astype(np.float32)
+    index = FaissIndex("cpu")
+    index.build(keys[:60], "auto", "ip")
+    trained = index.index
+
+    # below `retrain_growth` times the trained size the index only grows
+    index.add(keys[60:100])
+    assert index.index is trained and index.index_factory == "Flat" and index.ntotal == 100
+
+    # the threshold survives a save and load
+    index.save(str(tmp_path / "index.bin"))
+    index = FaissIndex("cpu")
+    index.load(str(tmp_path / "index.bin"))
+    assert index.auto and index._trained_ntotal == 60
+
+    index.add(keys[100:120])
+    # keys appended during the background retrain are replayed on the new index
+    index.add(keys[120:])
+    index.wait()
+    assert index.index_factory == "HNSW32" and index.ntotal == len(keys)
+    assert index._trained_ntotal >= 120 and index._pending is None
+    np.testing.assert_array_equal(index.search(keys, 1)[1][:, 0], np.arange(len(keys)))
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_sharded_search_matches_single_index(executor, tmp_path):
+    rng = np.random.default_rng(0)
+    keys = rng.standard_normal((3000, 32)).astype(np.float32)
+    # few enough queries that faiss scores them without BLAS, key by key
+    queries = rng.standard_normal((16, 32)).astype(np.float32)
+    single = FaissIndex("cpu")
+    single.build(keys, "Flat", "ip")
+    expected = single.search(queries, 20)
+
+    sharded = ShardedFaissIndex("cpu", 3, executor=executor)
+    sharded.build(keys[:2000], "Flat", "ip")
+    # appends continue the round robin from the global id
+    sharded.add(keys[2000:2501])
+    sharded.add(keys[2501:])
+    results = [sharded.search(queries, 20)]
+    # once saved, the process executor searches the shard files in worker processes
+    sharded.save(str(tmp_path / "index.bin"))
+    loaded = load_index(str(tmp_path / "index.bin"), "cpu", executor=executor)
+    assert isinstance(loaded, ShardedFaissIndex) and loaded.num_shards == 3
+    results += [sharded.search(queries, 20), loaded.search(queries, 20)]
+    assert (sharded._processes is not None) == (executor == "process")
+    sharded.close()
+    loaded.close()
+
+    for scores, indices in results:
+        np.testing.assert_array_equal(indices, expected[1])
+        np.testing.assert_array_equal(scores, expected[0])
+
+
+@pytest.fixture(scope="module")
+def encoder(tmp_path_factory):
+    return build_stub_models(str(tmp_path_factory.mktemp("stub-models")))["encoder"]
+
+
+@pytest.fixture(scope="module")
+def docs():
+    docs = synthetic_docs(40, max_words=60)
+    docs[7] += " NVDA"
+    docs[23] += " Okonkwo"
+    return docs
+
+
+def test_sparse_search_ranks_exact_terms_first_without_encoding(encoder, docs, monkeypatch):
+    retriever = DenseRetriever(encoder, dtype="fp32")
+    retriever.add(docs)
+
+    def encode(*args, **kwargs):
+        raise AssertionError("sparse search encoded a query")
+    monkeypatch.setattr(retriever, "encode", encode)
+
+    for query, expected in [("NVDA guidance", 7), ("what did okonkwo say", 23)]:
+        indices, _ = retriever.multi_search([query], mode="sparse")
+        assert indices[0] == expected
+    indices, _ = retriever.multi_search(["NVDA", "Okonkwo"], mode="sparse")
+    assert set(indices[:2]) == {7, 23}
+
+
+def test_hybrid_search_ranks_keys_found_by_both_first(encoder, docs, monkeypatch):
+    retriever = DenseRetriever(encoder, dtype="fp32")
+    retriever.add(docs)
+    monkeypatch.setattr(retriever, "_dense_search", lambda *args: ([1, 7, 3, 9, 4], [0.9, 0.8, 0.7, 0.6, 0.5]))
+    monkeypatch.setattr(retriever, "_sparse_search", lambda *args: ([8, 3, 2, 7], [12.0, 9.0, 5.0, 1.0]))
+
+    indices, scores = retriever.multi_search(["query"], mode="hybrid")
+    assert set(indices[:2]) == {3, 7} and set(indices) == {1, 2, 3, 4, 7, 8, 9}
+    assert scores == sorted(scores, reverse=True)
+
+
+RELEVANCE = [3, 9, 1, 7, 5, 11, 0, 8, 10, 2, 6, 4]
+
+
+def _stub_scorer(reranker, monkeypatch, clock):
+    """Scores "doc {j}" by `RELEVANCE[j]`, each batch taking a second of `clock`."""
+    scored = []
+
+    def score(queries, docs):
+        clock[0] += 1.0
+        scored.extend(docs)
+        return np.array([RELEVANCE[int(doc.split()[1])] for doc in docs], dtype=np.float32)
+    monkeypatch.setattr(reranker, "score", score)
+    return scored
+
+
+def test_reranker_orders_by_score_within_budget(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(retrieval.time, "perf_counter", lambda: clock[0])
+    docs = [f"doc {j}" for j in range(len(RELEVANCE))]
+
+    reranker = CrossEncoderReranker("stub", batch_size=4)
+    scored = _stub_scorer(reranker, monkeypatch, clock)
+    order, scores = reranker.rerank("query", docs, top_n=5)
+    assert order == [5, 8, 1, 7, 3] and scores == [11, 10, 9, 8, 7]
+    # scores are cached per (query, doc)
+    assert reranker.rerank("query", docs, top_n=5) == (order, scores) and len(scored) == len(docs)
+
+    # a budget of one and a half batches scores two, the rest keep their first-stage order
+    reranker = CrossEncoderReranker("stub", batch_size=4, latency_budget=1.5)
+    scored = _stub_scorer(reranker, monkeypatch, clock)
+    order, scores = reranker.rerank("query", docs, top_n=10)
+    assert scored == docs[:8]
+    assert order == [5, 1, 7, 3, 4, 0, 2, 6, 8, 9]
+    assert scores[:8] == [11, 9, 8, 7, 5, 3, 1, 0] and np.isnan(scores[8:]).all()
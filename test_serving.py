@@ -0,0 +1,103 @@
+import time
+import pytest
+from .benchmark import build_stub_models, synthetic_context, synthetic_queries
+from .memorag import MemoRAG
+from .serving import MemoRAGServer, ServerOverloaded
+
+CONTEXTS = {"a": synthetic_context(1024, seed=1), "b": synthetic_context(1024, seed=2)}
+
+
+@pytest.fixture(scope="module")
+def pipe(tmp_path_factory):
+    models = build_stub_models(str(tmp_path_factory.mktemp("stub-models")), max_context_tokens=4096)
+    return MemoRAG(
+        mem_model_name_or_path=models["llm"], ret_model_name_or_path=models["encoder"], 
+        gen_model_name_or_path=models["llm"], retrieval_chunk_size=64, chunk_workers=1)
+
+
+@pytest.fixture
+def server(pipe):
+    server = MemoRAGServer(pipe, max_queue_size=2, max_batch_size=4, batch_wait=0.05)
+    for store_id, context in CONTEXTS.items():
+        server.add_store(store_id, context)
+    yield server
+    server.close()
+
+
+def _serial(pipe, server, store_id, queries):
+    pipe.restore(server.stores[store_id])
+    return [pipe(query, max_new_tokens=16) for query in queries]
+
+
+def test_full_queue_raises_overloaded(server):
+    query = synthetic_queries(CONTEXTS["a"], 1)[0]
+    accepted = []
+    # the worker blocks on the pipeline, so the queue fills up
+    with server._lock:
+        with pytest.raises(ServerOverloaded):
+            for _ in range(100):
+                accepted.append(server.submit("a", query, max_new_tokens=4))
+                time.sleep(0.01)
+    assert len(accepted) >= server._queue.maxsize
+    for future in accepted:
+        assert isinstance(future.result(timeout=60), str)
+
+
+def test_coalesced_requests_match_serial_calls(pipe, server):
+    queries = synthetic_queries(CONTEXTS["a"], 2)
+    batch_sizes = []
+    batch = pipe.batch
+
+    def recording_batch(queries, **kwargs):
+        batch_sizes.append(len(queries))
+        return batch(queries, **kwargs)
+
+    pipe.batch = recording_batch
+    try:
+        with server._lock:
+            futures = [server.submit("a", query, max_new_tokens=16) for query in queries]
+        answers = [future.result(timeout=60) for future in futures]
+    finally:
+        del pipe.batch
+    assert batch_sizes == [2]
+    server.close()
+    assert answers == _serial(pipe, server, "a", queries)
+
+
+def test_expired_deadline_raises_timeout(server):
+    query = synthetic_queries(CONTEXTS["a"], 1)[0]
+    with server._lock:
+        # taken by the worker, which then waits for the pipeline
+        blocker = server.submit("a", query, max_new_tokens=4)
+        time.sleep(0.3)
+        expiring = server.submit("a", query, max_new_tokens=4, timeout=0.05)
+        time.sleep(0.2)
+    assert isinstance(blocker.result(timeout=60), str)
+    with pytest.raises(TimeoutError):
+        expiring.result(timeout=60)
+
+
+def test_alternating_stores_retrieve_from_their_own_corpus(pipe, server):
+    queries = {store_id: synthetic_queries(context, 2, seed=3) for store_id, context in CONTEXTS.items()}
+    store_of = {query: store_id for store_id, store_queries in queries.items() for query in store_queries}
+    retrieved = []
+    retrieve = pipe._retrieve
+
+    def recording_retrieve(retrieval_query, rerank_query=None):
+        chunks = retrieve(retrieval_query, rerank_query)
+        retrieved.append((store_of[rerank_query], chunks))
+        return chunks
+
+    pipe._retrieve = recording_retrieve
+    try:
+        futures = [
+            server.submit(store_id, query, max_new_tokens=8, block=True)
+            for pair in zip(queries["a"], queries["b"]) for store_id, query in zip("ab", pair)]
+        for future in futures:
+            future.result(timeout=60)
+    finally:
+        del pipe._retrieve
+    assert {store_id for store_id, _ in retrieved} == {"a", "b"}
+    for store_id, chunks in retrieved:
+        other = "b" if store_id == "a" else "a"
+        assert chunks and all(chunk in CONTEXTS[store_id] and chunk not in CONTEXTS[other] for chunk in chunks)